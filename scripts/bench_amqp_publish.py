@@ -0,0 +1,75 @@
+"""Benchmark publishing to a user's AMQP exchange.
+
+Times helpers.amqp_publish_user, that publishes over pooled connections,
+against opening a new connection and channel for every message, like
+amqp_publish used to. Needs a running RabbitMQ at config.AMQP_URI. Run it
+with the buildout python:
+
+    ./bin/python scripts/bench_amqp_publish.py [messages]
+
+"""
+import sys
+import json
+import time
+
+from amqp import Message
+from amqp.connection import Connection
+
+from mist.io import helpers
+from mist.io.helpers import config
+
+
+EMAIL = 'bench@mist.io'
+
+
+def previous_publish(exchange, routing_key, data):
+    """The connection per message publishing amqp_publish used to do"""
+    connection = Connection(config.AMQP_URI)
+    channel = connection.channel()
+    msg = Message(json.dumps(data))
+    channel.basic_publish(msg, exchange=exchange, routing_key=routing_key)
+    channel.close()
+    connection.close()
+
+
+def timeit(func, messages):
+    start = time.time()
+    for i in range(messages):
+        func(i)
+    return messages / (time.time() - start)
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    exchange = helpers._amqp_user_exchange(EMAIL)
+    data = {'cloud_id': 'bench', 'machines': [{'id': 'x' * 32}] * 10}
+
+    # declare the user's exchange, with a queue bound to it, like a sockjs
+    # connection of the user would
+    connection = Connection(config.AMQP_URI)
+    channel = connection.channel()
+    channel.exchange_declare(exchange, 'fanout', auto_delete=True)
+    queue = channel.queue_declare(exclusive=True, auto_delete=True).queue
+    channel.queue_bind(queue, exchange)
+
+    try:
+        print 'Publishing %d messages to %s' % (messages, exchange)
+        rate = timeit(lambda i: previous_publish(exchange, 'bench', data),
+                      messages)
+        print 'connection per message: %8.0f msg/s' % rate
+        for confirm in (True, False):
+            config.AMQP_PUBLISH_CONFIRM = confirm
+            helpers.amqp_pool.close()
+            rate = timeit(lambda i: helpers.amqp_publish_user(EMAIL, 'bench',
+                                                              data),
+                          messages)
+            print 'pooled, confirm=%-5s:   %8.0f msg/s' % (confirm, rate)
+        print 'pool stats:', helpers.amqp_pool.stats
+    finally:
+        channel.queue_delete(queue)
+        channel.close()
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Benchmark assembling OpenStack networks for list_networks.
+
+Builds synthetic OpenStack networks, subnets, floating ips and nodes and
+times methods.openstack_networks_to_dict against the previous per network
+filtering, for growing tenant sizes. Run it with the buildout python:
+
+    ./bin/python scripts/bench_openstack_networks.py
+
+"""
+import sys
+import time
+from collections import namedtuple
+
+from mist.io import methods
+
+
+Network = namedtuple('Network', 'id name status router_external extra subnets')
+Subnet = namedtuple('Subnet', 'id name cidr enable_dhcp dns_nameservers '
+                              'allocation_pools gateway_ip ip_version extra')
+FloatingIP = namedtuple('FloatingIP', 'id floating_network_id '
+                                      'floating_ip_address fixed_ip_address '
+                                      'status port_id extra')
+Node = namedtuple('Node', 'id private_ips')
+
+
+def make_tenant(num_networks, num_floating_ips, num_nodes, public_every=10):
+    networks = []
+    subnets = []
+    for i in range(num_networks):
+        subnet_ids = ['subnet-%d-%d' % (i, j) for j in range(2)]
+        networks.append(Network('net-%d' % i, 'net%d' % i, 'ACTIVE',
+                                i % public_every == 0, {}, subnet_ids))
+        for j, subnet_id in enumerate(subnet_ids):
+            subnets.append(Subnet(subnet_id, subnet_id,
+                                  '10.%d.%d.0/24' % (i % 256, j), True, [],
+                                  [], '10.%d.%d.1' % (i % 256, j), 4, {}))
+    public_ids = [net.id for net in networks if net.router_external]
+    nodes = [Node('node-%d' % i, ['192.168.%d.%d' % (i / 256, i % 256)])
+             for i in range(num_nodes)]
+    floating_ips = []
+    for i in range(num_floating_ips):
+        fixed_ip = nodes[i % num_nodes].private_ips[0] if num_nodes else None
+        floating_ips.append(FloatingIP('fip-%d' % i,
+                                       public_ids[i % len(public_ids)],
+                                       '172.16.%d.%d' % (i / 256, i % 256),
+                                       fixed_ip, 'ACTIVE', 'port-%d' % i, {}))
+    return networks, subnets, floating_ips, nodes
+
+
+def previous_networks_to_dict(networks, subnets, floating_ips, nodes):
+    """The per network filtering list_networks used to do"""
+    def floating_ip_to_dict(floating_ip):
+        ret = {'id': floating_ip.id, 'node_id': ''}
+        for node in nodes:
+            if floating_ip.fixed_ip_address in node.private_ips:
+                ret['node_id'] = node.id
+        return ret
+
+    def network_to_dict(network, floating_ips=[]):
+        return {
+            'id': network.id,
+            'subnets': [subnet.id for subnet in subnets
+                        if subnet.id in network.subnets],
+            'floating_ips': [floating_ip_to_dict(floating_ip)
+                             for floating_ip in floating_ips
+                             if floating_ip.floating_network_id == network.id],
+        }
+
+    networks = list(networks)
+    public_networks = []
+    for net in networks:
+        if net.router_external:
+            public_networks.append(networks.pop(networks.index(net)))
+    public = [network_to_dict(net, floating_ips) for net in public_networks]
+    private = [network_to_dict(net) for net in networks]
+    return public, private
+
+
+def timeit(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def main():
+    sizes = [(50, 200, 100), (200, 1000, 500), (500, 5000, 2000)]
+    if len(sys.argv) > 1:
+        sizes = sizes[:int(sys.argv[1])]
+    print '%8s %8s %8s %12s %12s' % ('networks', 'fips', 'nodes',
+                                     'previous(s)', 'indexed(s)')
+    for num_networks, num_floating_ips, num_nodes in sizes:
+        tenant = make_tenant(num_networks, num_floating_ips, num_nodes)
+        public, private = methods.openstack_networks_to_dict(*tenant)
+        prev_public, prev_private = previous_networks_to_dict(*tenant)
+        assert [net['id'] for net in public] == \
+            [net['id'] for net in prev_public]
+        assert [net['id'] for net in private] == \
+            [net['id'] for net in prev_private]
+        print '%8d %8d %8d %12.3f %12.3f' % (
+            num_networks, num_floating_ips, num_nodes,
+            timeit(previous_networks_to_dict, *tenant),
+            timeit(methods.openstack_networks_to_dict, *tenant),
+        )
+
+
+if __name__ == '__main__':
+    main()
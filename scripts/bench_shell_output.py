@@ -0,0 +1,73 @@
+"""Benchmark reading command output in ParamikoShell.
+
+Feeds 100 MB of output (in lines of 80 bytes by default) through a fake
+ssh channel and times ParamikoShell._read_stream, that reads raw chunks into
+a single buffer, against reading line by line and concatenating, like
+ParamikoShell.command used to. Run it with the buildout python:
+
+    ./bin/python scripts/bench_shell_output.py [megabytes] [line length]
+
+"""
+import sys
+import time
+from StringIO import StringIO
+
+from mist.io.shell import ParamikoShell
+
+
+class FakeChannel(object):
+    """Returns data like paramiko's Channel.recv, in chunks of up to nbytes
+    as received from the network"""
+
+    def __init__(self, data, packet_size=32768):
+        self.data = data
+        self.offset = 0
+        self.packet_size = packet_size
+
+    def recv(self, nbytes):
+        size = min(nbytes, self.packet_size)
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+
+def read_lines(data):
+    """The line by line reading ParamikoShell.command used to do"""
+    stdout = StringIO(data)
+    line = stdout.readline()
+    out = ''
+    while line:
+        out += line
+        line = stdout.readline()
+    return out
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    line_length = int(sys.argv[2]) if len(sys.argv) > 2 else 80
+    line = 'x' * (line_length - 1) + '\n'
+    data = line * (megabytes * 1024 * 1024 / line_length)
+    print 'Reading %d MB in lines of %d bytes' % (len(data) / 1024 / 1024,
+                                                  line_length)
+
+    start = time.time()
+    out = read_lines(data)
+    print 'line by line:   %.2fs' % (time.time() - start)
+    assert out == data
+    del out
+
+    start = time.time()
+    out, truncated = ParamikoShell._read_stream(FakeChannel(data).recv)
+    print 'chunked:        %.2fs' % (time.time() - start)
+    assert out == data and not truncated
+    del out
+
+    start = time.time()
+    out, truncated = ParamikoShell._read_stream(FakeChannel(data).recv,
+                                                max_output=len(data) / 2)
+    print 'chunked capped: %.2fs' % (time.time() - start)
+    assert out == data[:len(data) / 2] and truncated
+
+
+if __name__ == '__main__':
+    main()
@@ -106,6 +106,10 @@ def add_routes(configurator):
 
     configurator.add_route('api_v1_machines', '/api/v1/clouds/{cloud}/machines')
     configurator.add_route('machines', '/clouds/{cloud}/machines')
+    configurator.add_route('api_v1_machines_action', '/api/v1/clouds/{cloud}/machines/actions')
+    configurator.add_route('machines_action', '/clouds/{cloud}/machines/actions')
+    configurator.add_route('api_v1_machines_tags', '/api/v1/clouds/{cloud}/machines/tags')
+    configurator.add_route('machines_tags', '/clouds/{cloud}/machines/tags')
     configurator.add_route('api_v1_machine', '/api/v1/clouds/{cloud}/machines/{machine}')
     configurator.add_route('machine', '/clouds/{cloud}/machines/{machine}')
     configurator.add_route('api_v1_machine_rdp', '/api/v1/clouds/{cloud}/machines/{machine}/rdp')
@@ -154,6 +158,9 @@ def add_routes(configurator):
     configurator.add_route('api_v1_key_association', '/api/v1/clouds/{cloud}/machines/{machine}/keys/{key}')
     configurator.add_route('key_association', '/clouds/{cloud}/machines/{machine}/keys/{key}')
 
+    configurator.add_route('api_v1_commands', '/api/v1/commands')
+    configurator.add_route('commands', '/commands')
+
     configurator.add_route('api_v1_rules', '/api/v1/rules')
     configurator.add_route('rules', '/rules')
     configurator.add_route('api_v1_rule', '/api/v1/rules/{rule}')
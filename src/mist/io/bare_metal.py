@@ -1,6 +1,11 @@
 import os
+import time
+import errno
+import select
 import socket
 import httplib
+import threading
+import subprocess
 
 from libcloud.compute.types import NodeState
 from libcloud.compute.base import Node
@@ -42,7 +47,10 @@ class BareMetalDriver(object):
         return ('<BareMetalDriver>')
 
     def list_nodes(self):
-        nodes = [self._to_node(machine_id, machine)
+        states = self.check_hosts([(machine.dns_name, machine.ssh_port)
+                                   for machine in self.machines.values()])
+        nodes = [self._to_node(machine_id, machine,
+                               states[(machine.dns_name, machine.ssh_port)])
                  for machine_id, machine in self.machines.items()]
         return nodes
 
@@ -63,8 +71,9 @@ class BareMetalDriver(object):
         result = httplib.OK
         return result in VALID_RESPONSE_CODES
 
-    def _to_node(self, machine_id, machine):
-        state = self.check_host(machine.dns_name, machine.ssh_port)
+    def _to_node(self, machine_id, machine, state=None):
+        if state is None:
+            state = self.check_host(machine.dns_name, machine.ssh_port)
         extra = {}
         if hasattr(machine, 'os_type') and machine.os_type:
             extra['os_type'] = machine.os_type
@@ -77,38 +86,52 @@ class BareMetalDriver(object):
         return node
 
     def check_host(self, hostname, ssh_port=22):
-        """Check if host is running.
+        """Check if host is running. See check_hosts."""
+        return self.check_hosts([(hostname, ssh_port)])[(hostname, ssh_port)]
 
-        Initially attempt a connection to ssh port specified for host and
-        also to a list of common ports. If connection is successfull,
-         then consider host as running. If not, send an ICMP package
-        with ping. If this fails too, consider host state as stopped.
-        Still needs to be improved to perform more robust checks.
+    def check_hosts(self, hosts):
+        """Check which of the given hosts are running.
+
+        hosts is a list of (hostname, ssh_port) tuples. Connections are
+        attempted to the ssh port of every host and to a list of common
+        ports, all at the same time. Hosts that accept a connection on any
+        of them within config.BARE_METAL_CHECK_TIMEOUT secs are considered
+        running. The rest are pinged once, all at the same time, and the
+        ones that reply are considered running too. Still needs to be
+        improved to perform more robust checks.
+
+        Results are cached for config.BARE_METAL_CHECK_CACHE_TTL secs.
+
+        Returns a dict mapping every (hostname, ssh_port) tuple to the
+        host's state.
 
         """
+        states = {}
+        now = time.time()
+        with _host_states_lock:
+            for host in hosts:
+                if not host[0]:
+                    states[host] = NODE_STATE_MAP['unknown']
+                elif host in _host_states and _host_states[host][0] > now:
+                    states[host] = _host_states[host][1]
+        hosts = set(host for host in hosts if host not in states)
+        if not hosts:
+            return states
 
-        state = NODE_STATE_MAP['unknown']
-        if not hostname:
-            return state
-        socket.setdefaulttimeout(5)
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        ports_list = [22, 80, 443, 3389]
-        if ssh_port not in ports_list:
-            ports_list.insert(0, ssh_port, )
-        for port in ports_list:
-            try:
-                s.connect((hostname, port))
-                s.shutdown(2)
-                state = NODE_STATE_MAP['on']
-                break
-            except:
-                pass
-            if state == NODE_STATE_MAP['unknown']:
-                ping_response = self.ping_host(hostname)
-                if ping_response == 0:
-                    state = NODE_STATE_MAP['on']
-        return state
+        up = _check_ports(hosts, config.BARE_METAL_CHECK_TIMEOUT)
+        pinged = _ping_hosts(set(host[0] for host in hosts if host not in up))
+        expires = time.time() + config.BARE_METAL_CHECK_CACHE_TTL
+        with _host_states_lock:
+            for host in hosts:
+                if host in up or host[0] in pinged:
+                    states[host] = NODE_STATE_MAP['on']
+                else:
+                    states[host] = NODE_STATE_MAP['unknown']
+                _host_states[host] = (expires, states[host])
+            for host in [host for host in _host_states
+                         if _host_states[host][0] < now]:
+                del _host_states[host]
+        return states
 
     def ping_host(self, hostname):
         """Pings given host
@@ -120,11 +143,122 @@ class BareMetalDriver(object):
         """
         if not hostname:
             return 256
+        return 0 if _ping_hosts([hostname]) else 256
+
+
+# (hostname, ssh_port) -> (expiration timestamp, state)
+_host_states = {}
+_host_states_lock = threading.Lock()
+
+COMMON_PORTS = [22, 80, 443, 3389]
+
+
+def _check_ports(hosts, timeout):
+    """Attempt non blocking connections to the ssh port and the common ports
+    of all (hostname, ssh_port) tuples at once and return the set of those
+    that accepted any connection within timeout secs."""
+    import multiprocessing
+    from multiprocessing.dummy import Pool as ThreadPool
+
+    def resolve(hostname):
         try:
-            response = os.system("ping -c 1 -w5 " + hostname + " > /dev/null 2>&1")
-        except:
-            response = 256
-        return response
+            return socket.getaddrinfo(hostname, None, 0,
+                                      socket.SOCK_STREAM)[0]
+        except socket.error as exc:
+            log.debug("Can't resolve %s: %r", hostname, exc)
+
+    # resolution gets its own timeout secs, hostnames that take longer
+    # are treated as unresolvable
+    resolve_deadline = time.time() + timeout
+    hostnames = list(set(host[0] for host in hosts))
+    pool = ThreadPool(max(1, min(len(hostnames), 20)))
+    try:
+        results = [(hostname, pool.apply_async(resolve, (hostname, )))
+                   for hostname in hostnames]
+        addrinfo = {}
+        for hostname, result in results:
+            try:
+                addrinfo[hostname] = result.get(
+                    max(0, resolve_deadline - time.time())
+                )
+            except multiprocessing.TimeoutError:
+                log.debug("Timed out resolving %s", hostname)
+                addrinfo[hostname] = None
+    finally:
+        # don't wait for lookups that timed out, the threads are daemonic
+        pool.close()
+    deadline = time.time() + timeout
+
+    sockets = {}  # fd -> (socket, host)
+    for host in hosts:
+        hostname, ssh_port = host
+        if not addrinfo[hostname]:
+            continue
+        family, socktype, proto, _, sockaddr = addrinfo[hostname]
+        ports = list(COMMON_PORTS)
+        if ssh_port and ssh_port not in ports:
+            ports.insert(0, ssh_port)
+        for port in ports:
+            address = (sockaddr[0], port) + tuple(sockaddr[2:])
+            try:
+                sock = socket.socket(family, socktype, proto)
+            except socket.error as exc:
+                log.error("Can't create socket for %s: %r", hostname, exc)
+                break
+            sock.setblocking(0)
+            err = sock.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sock.close()
+                continue
+            sockets[sock.fileno()] = (sock, host)
+
+    up = set()
+    try:
+        while sockets and time.time() < deadline:
+            for fd in _wait_writable(sockets.keys(), deadline - time.time()):
+                if fd not in sockets:
+                    continue
+                sock, host = sockets.pop(fd)
+                if not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    up.add(host)
+                    # no need to wait for the other ports of this host
+                    for fd in [fd for fd in sockets
+                               if sockets[fd][1] == host]:
+                        sockets.pop(fd)[0].close()
+                sock.close()
+    finally:
+        for sock, host in sockets.values():
+            sock.close()
+    return up
+
+
+def _wait_writable(fds, timeout):
+    """Return the fds that became writable, or failed, within timeout"""
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLOUT)
+        return [fd for fd, event in poller.poll(max(0, timeout) * 1000)]
+    return select.select([], fds, fds, max(0, timeout))[1]
+
+
+def _ping_hosts(hostnames):
+    """Ping all hostnames once, at the same time, and return the set of
+    those that replied. Use the ping utility, since sending ICMP packets
+    requires root privileges."""
+    procs = {}
+    with open(os.devnull, 'w') as devnull:
+        for hostname in hostnames:
+            try:
+                procs[hostname] = subprocess.Popen(
+                    ['ping', '-c', '1', '-w',
+                     str(config.BARE_METAL_CHECK_TIMEOUT), hostname],
+                    stdout=devnull, stderr=devnull
+                )
+            except OSError as exc:
+                log.error("Error pinging %s: %r", hostname, exc)
+    return set(hostname for hostname, proc in procs.items()
+               if proc.wait() == 0)
 
 
 class CoreOSDriver(BareMetalDriver):
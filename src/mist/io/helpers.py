@@ -5,10 +5,14 @@ import re
 import sys
 import time
 import json
+import Queue
+import atexit
 import random
+import select
 import socket
 import tempfile
 import logging
+import threading
 import functools
 from hashlib import sha1
 from contextlib import contextmanager
@@ -17,6 +21,7 @@ import netaddr
 from amqp import Message
 from amqp.connection import Connection
 from amqp.exceptions import NotFound as AmqpNotFound
+from amqp.exceptions import ChannelError as AmqpChannelError
 
 from mist.io.model import User
 from mist.io.exceptions import MistError
@@ -150,16 +155,154 @@ def parse_ping(stdout):
     return {}
 
 
+class AmqpPool(object):
+    """Per process pool of AMQP connections, each with an open channel.
+
+    Use it like:
+    with amqp_pool.channel() as channel:
+        channel.basic_publish(msg, exchange=exchange)
+
+    Each connection is used by one thread at a time. Connections idle for
+    more than config.AMQP_POOL_IDLE_TIMEOUT secs, that the broker closed
+    while they were idle, or that fail, are closed and replaced by new ones. If the broker closes the channel, eg because
+    the exchange didn't exist, a new channel is opened on the same
+    connection. The pool is emptied after a fork, so that child processes
+    never share sockets with their parent.
+
+    With config.AMQP_PUBLISH_CONFIRM, publishing waits for the broker to
+    confirm each message, so that publishing to a missing exchange raises
+    NotFound right away. Otherwise the error is only raised by the next
+    operation on the channel.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.pid = None
+        self.lock = threading.Lock()
+        self.idle = []  # (connection, channel, last used timestamp)
+        self.stats = {'connections': 0, 'channels': 0, 'reused': 0}
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.lock = threading.Lock()
+            self.idle = []
+
+    def _connect(self):
+        connection = Connection(config.AMQP_URI,
+                                confirm_publish=config.AMQP_PUBLISH_CONFIRM)
+        with self.lock:
+            self.stats['connections'] += 1
+        return connection, self._open_channel(connection)
+
+    def _open_channel(self, connection):
+        with self.lock:
+            self.stats['channels'] += 1
+        return connection.channel()
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception as exc:
+            log.debug("Error closing AMQP connection: %r", exc)
+
+    @staticmethod
+    def _is_alive(connection):
+        """Check that the broker didn't close an idle connection, eg
+        because it restarted. Nothing is expected on idle connections, so
+        a readable socket means EOF or a connection.close from the broker"""
+        try:
+            if not connection.connected:
+                return False
+            readable = select.select([connection.sock], [], [], 0)[0]
+        except Exception:
+            return False
+        return not readable
+
+    def _acquire(self):
+        self._check_pid()
+        now = time.time()
+        with self.lock:
+            while self.idle:
+                connection, channel, last_used = self.idle.pop()
+                if now - last_used < config.AMQP_POOL_IDLE_TIMEOUT and \
+                        self._is_alive(connection):
+                    self.stats['reused'] += 1
+                    return connection, channel
+                self._close(connection)
+        return self._connect()
+
+    def _release(self, connection, channel):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((connection, channel, time.time()))
+                return
+        self._close(connection)
+
+    @contextmanager
+    def channel(self):
+        connection, channel = self._acquire()
+        try:
+            yield channel
+        except AmqpChannelError:
+            # the broker closed the channel, the connection is still fine
+            try:
+                channel = self._open_channel(connection)
+            except Exception:
+                self._close(connection)
+            else:
+                self._release(connection, channel)
+            raise
+        except BaseException:
+            self._close(connection)
+            raise
+        else:
+            self._release(connection, channel)
+
+    def close(self):
+        self._check_pid()
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, channel, last_used in idle:
+            self._close(connection)
+
+
+amqp_pool = AmqpPool(config.AMQP_POOL_SIZE)
+
+
+def _amqp_with_channel(func, retry=None):
+    """Run func with a pooled channel, retrying once with a new connection
+    if the pooled one has gone stale, eg after a broker restart. If given,
+    retry is called after a failure and the retry only happens if it
+    returns True, eg so that a message is never published twice"""
+    try:
+        with amqp_pool.channel() as channel:
+            return func(channel)
+    except AmqpChannelError:
+        raise
+    except Exception as exc:
+        if retry is not None and not retry():
+            raise
+        log.warning("AMQP error, retrying with a new connection: %r", exc)
+    with amqp_pool.channel() as channel:
+        return func(channel)
+
+
 def amqp_publish(exchange, routing_key, data,
                  ex_type='fanout', ex_declare=False):
-    connection = Connection(config.AMQP_URI)
-    channel = connection.channel()
-    if ex_declare:
-        channel.exchange_declare(exchange=exchange, type=ex_type)
     msg = Message(json.dumps(data))
-    channel.basic_publish(msg, exchange=exchange, routing_key=routing_key)
-    channel.close()
-    connection.close()
+    published = []
+
+    def publish(channel):
+        if ex_declare:
+            channel.exchange_declare(exchange=exchange, type=ex_type)
+        # the message may reach the broker even if basic_publish fails
+        published.append(True)
+        channel.basic_publish(msg, exchange=exchange, routing_key=routing_key)
+
+    _amqp_with_channel(publish, retry=lambda: not published)
 
 
 def amqp_subscribe(exchange, callback, queue='',
@@ -222,30 +365,123 @@ def amqp_subscribe_user(user, queue, callback):
 
 
 def amqp_user_listening(user):
-    connection = Connection(config.AMQP_URI)
-    channel = connection.channel()
-    try:
+    def declare(channel):
         channel.exchange_declare(exchange=_amqp_user_exchange(user),
                                  type='fanout', passive=True)
+
+    try:
+        _amqp_with_channel(declare)
     except AmqpNotFound:
         return False
     else:
         return True
-    finally:
-        channel.close()
-        connection.close()
 
 
 def trigger_session_update(email, sections=['clouds', 'keys', 'monitoring']):
     amqp_publish_user(email, routing_key='update', data=sections)
 
 
+class AmqpLogShipper(object):
+    """Ships amqp_log messages to the mist_debug exchange in the background.
+
+    Messages are put in a queue of up to max_size messages, and dropped if
+    it's full. A background thread publishes them in batches of up to
+    batch_size over a persistent connection, after checking once per batch
+    that someone is listening, ie that the exchange exists. Messages are
+    dropped, as before, if not. The thread is restarted after a fork.
+
+    """
+
+    exchange = 'mist_debug'
+
+    def __init__(self, max_size, batch_size):
+        self.queue = Queue.Queue(max_size)
+        self.batch_size = batch_size
+        self.pid = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.connection = None
+        self.channel = None
+        self.stats = {'queued': 0, 'sent': 0, 'dropped': 0,
+                      'no_listener': 0, 'failed': 0}
+
+    def _ensure_thread(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # the parent's thread and connection don't exist after a fork
+            self.queue = Queue.Queue(self.queue.maxsize)
+            self.connection = self.channel = None
+            self.thread = threading.Thread(target=self._run,
+                                           name='AmqpLogShipper')
+            self.thread.daemon = True
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def log(self, msg):
+        self._ensure_thread()
+        try:
+            self.queue.put_nowait((time.time(), msg))
+        except Queue.Full:
+            self.stats['dropped'] += 1
+        else:
+            self.stats['queued'] += 1
+
+    def flush(self, timeout=1):
+        """Wait up to timeout secs for queued messages to be shipped"""
+        deadline = time.time() + timeout
+        while self.pid == os.getpid() and not self.queue.empty() and \
+                time.time() < deadline:
+            time.sleep(0.05)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self._publish(batch)
+            except AmqpNotFound:
+                self.stats['no_listener'] += len(batch)
+                self.channel = None
+            except Exception as exc:
+                log.debug("Error shipping amqp_log messages: %r", exc)
+                self.stats['failed'] += len(batch)
+                if self.connection is not None:
+                    try:
+                        self.connection.close()
+                    except Exception:
+                        pass
+                self.connection = self.channel = None
+
+    def _publish(self, batch):
+        if self.connection is None:
+            self.connection = Connection(config.AMQP_URI)
+        if self.channel is None:
+            self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange=self.exchange, type='fanout',
+                                      passive=True)
+        for timestamp, msg in batch:
+            msg = "[%s] %s" % (time.strftime("%Y-%m-%d %H:%M:%S %Z",
+                                             time.localtime(timestamp)), msg)
+            self.channel.basic_publish(Message(json.dumps(msg)),
+                                       exchange=self.exchange, routing_key='')
+        self.stats['sent'] += len(batch)
+
+
+amqp_log_shipper = AmqpLogShipper(config.AMQP_LOG_BUFFER_SIZE,
+                                  config.AMQP_LOG_BATCH_SIZE)
+atexit.register(amqp_log_shipper.flush)
+
+
 def amqp_log(msg):
-    msg = "[%s] %s" % (time.strftime("%Y-%m-%d %H:%M:%S %Z"), msg)
-    try:
-        amqp_publish('mist_debug', '', msg)
-    except:
-        pass
+    if config.AMQP_LOG_ENABLED:
+        amqp_log_shipper.log(msg)
 
 
 def amqp_log_listen():
@@ -3,6 +3,7 @@ import shutil
 import random
 import socket
 import tempfile
+import threading
 import json
 import base64
 import requests
@@ -39,7 +40,7 @@ try:
 except ImportError:
     from mist.io import config, model
 
-from mist.io.shell import Shell
+from mist.io.shell import Shell, transport_pool
 from mist.io.helpers import get_temp_file
 from mist.io.helpers import get_auth_header
 from mist.io.helpers import parse_ping
@@ -50,6 +51,7 @@ from mist.io.exceptions import *
 
 from mist.io.helpers import trigger_session_update
 from mist.io.helpers import amqp_publish_user
+from mist.io import poller
 from mist.io.helpers import StdStreamCapture
 
 import mist.io.tasks
@@ -1558,7 +1560,7 @@ def create_machine(user, cloud_id, key_id, machine_name, location_id,
                    associate_floating_ip=False,
                    associate_floating_ip_subnet=None, project_id=None,
                    bare_metal=False, hourly=True,
-                   cronjob={}, command=None):
+                   cronjob={}, command=None, controller=None):
 
     """Creates a new virtual machine on the specified cloud.
 
@@ -1579,6 +1581,11 @@ def create_machine(user, cloud_id, key_id, machine_name, location_id,
     get them. Also, it will create inconsistencies for machines created
     through mist.io and those from the Linode interface.
 
+    If a ConcurrencyController is given, only the provider's create request
+    runs through it. Throttled requests are retried, but the key association
+    and post deploy steps that follow run once the machine exists, so that a
+    retry never creates duplicate machines.
+
     """
     log.info('Creating machine %s on cloud %s' % (machine_name, cloud_id))
 
@@ -1586,6 +1593,7 @@ def create_machine(user, cloud_id, key_id, machine_name, location_id,
     if cloud_id not in user.clouds:
         raise CloudNotFoundError(cloud_id)
     conn = connect_provider(user.clouds[cloud_id])
+    run = _provider_runner(controller)
 
     machine_name = machine_name_validator(conn.type, machine_name)
 
@@ -1616,14 +1624,14 @@ def create_machine(user, cloud_id, key_id, machine_name, location_id,
 
     if conn.type is Provider.DOCKER:
         if key_id:
-            node = _create_machine_docker(conn, machine_name, image_id, '', public_key=public_key,
-                                          docker_env=docker_env, docker_command=docker_command,
-                                          docker_port_bindings=docker_port_bindings,
-                                          docker_exposed_ports=docker_exposed_ports)
+            node = run(_create_machine_docker, conn, machine_name, image_id, '', public_key=public_key,
+                       docker_env=docker_env, docker_command=docker_command,
+                       docker_port_bindings=docker_port_bindings,
+                       docker_exposed_ports=docker_exposed_ports)
         else:
-            node = _create_machine_docker(conn, machine_name, image_id, script, docker_env=docker_env,
-                                          docker_command=docker_command, docker_port_bindings=docker_port_bindings,
-                                          docker_exposed_ports=docker_exposed_ports)
+            node = run(_create_machine_docker, conn, machine_name, image_id, script, docker_env=docker_env,
+                       docker_command=docker_command, docker_port_bindings=docker_port_bindings,
+                       docker_exposed_ports=docker_exposed_ports)
         if key_id and key_id in user.keypairs:
             node_info = conn.inspect_node(node)
             try:
@@ -1632,56 +1640,56 @@ def create_machine(user, cloud_id, key_id, machine_name, location_id,
                 pass
     elif conn.type in [Provider.RACKSPACE_FIRST_GEN,
                      Provider.RACKSPACE]:
-        node = _create_machine_rackspace(conn, public_key, machine_name, image,
-                                         size, location, user_data=cloud_init)
+        node = run(_create_machine_rackspace, conn, public_key, machine_name, image,
+                   size, location, user_data=cloud_init)
     elif conn.type in [Provider.OPENSTACK]:
-        node = _create_machine_openstack(conn, private_key, public_key,
-                                         machine_name, image, size, location, networks, cloud_init)
+        node = run(_create_machine_openstack, conn, private_key, public_key,
+                   machine_name, image, size, location, networks, cloud_init)
     elif conn.type in config.EC2_PROVIDERS and private_key:
         locations = conn.list_locations()
         for loc in locations:
             if loc.id == location_id:
                 location = loc
                 break
-        node = _create_machine_ec2(conn, key_id, private_key, public_key,
-                                   machine_name, image, size, location, cloud_init)
+        node = run(_create_machine_ec2, conn, key_id, private_key, public_key,
+                   machine_name, image, size, location, cloud_init)
     elif conn.type is Provider.NEPHOSCALE:
-        node = _create_machine_nephoscale(conn, key_id, private_key, public_key,
-                                          machine_name, image, size,
-                                          location, ips)
+        node = run(_create_machine_nephoscale, conn, key_id, private_key, public_key,
+                   machine_name, image, size,
+                   location, ips)
     elif conn.type is Provider.GCE:
         sizes = conn.list_sizes(location=location_name)
         for size in sizes:
             if size.id == size_id:
                 size = size
                 break
-        node = _create_machine_gce(conn, key_id, private_key, public_key,
-                                         machine_name, image, size, location, cloud_init)
+        node = run(_create_machine_gce, conn, key_id, private_key, public_key,
+                   machine_name, image, size, location, cloud_init)
     elif conn.type is Provider.SOFTLAYER:
-        node = _create_machine_softlayer(conn, key_id, private_key, public_key,
-                                         machine_name, image, size,
-                                         location, bare_metal, cloud_init, hourly)
+        node = run(_create_machine_softlayer, conn, key_id, private_key, public_key,
+                   machine_name, image, size,
+                   location, bare_metal, cloud_init, hourly)
     elif conn.type is Provider.DIGITAL_OCEAN:
-        node = _create_machine_digital_ocean(conn, key_id, private_key,
-                                             public_key, machine_name,
-                                             image, size, location, cloud_init)
+        node = run(_create_machine_digital_ocean, conn, key_id, private_key,
+                   public_key, machine_name,
+                   image, size, location, cloud_init)
     elif conn.type == Provider.AZURE:
-        node = _create_machine_azure(conn, key_id, private_key,
-                                     public_key, machine_name,
-                                     image, size, location, cloud_init=cloud_init,
-                                     cloud_service_name=None, azure_port_bindings=azure_port_bindings)
+        node = run(_create_machine_azure, conn, key_id, private_key,
+                   public_key, machine_name,
+                   image, size, location, cloud_init=cloud_init,
+                   cloud_service_name=None, azure_port_bindings=azure_port_bindings)
     elif conn.type in [Provider.VCLOUD, Provider.INDONESIAN_VCLOUD]:
-        node = _create_machine_vcloud(conn, machine_name, image, size, public_key, networks)
+        node = run(_create_machine_vcloud, conn, machine_name, image, size, public_key, networks)
     elif conn.type is Provider.LINODE and private_key:
-        node = _create_machine_linode(conn, key_id, private_key, public_key,
-                                      machine_name, image, size,
-                                      location)
+        node = run(_create_machine_linode, conn, key_id, private_key, public_key,
+                   machine_name, image, size,
+                   location)
     elif conn.type == Provider.HOSTVIRTUAL:
-        node = _create_machine_hostvirtual(conn, public_key, machine_name, image,
-                                         size, location)
+        node = run(_create_machine_hostvirtual, conn, public_key, machine_name, image,
+                   size, location)
     elif conn.type == Provider.VULTR:
-        node = _create_machine_vultr(conn, public_key, machine_name, image,
-                                         size, location, cloud_init)
+        node = run(_create_machine_vultr, conn, public_key, machine_name, image,
+                   size, location, cloud_init)
     elif conn.type is Provider.LIBVIRT:
         try:
             # size_id should have a format cpu:ram, eg 1:2048
@@ -1690,15 +1698,15 @@ def create_machine(user, cloud_id, key_id, machine_name, location_id,
         except:
             ram = 512
             cpu = 1
-        node = _create_machine_libvirt(conn, machine_name,
-                                       disk_size=disk_size, ram=ram, cpu=cpu,
-                                       image=image_id, disk_path=disk_path,
-                                       networks=networks,
-                                       public_key=public_key,
-                                       cloud_init=cloud_init)
+        node = run(_create_machine_libvirt, conn, machine_name,
+                   disk_size=disk_size, ram=ram, cpu=cpu,
+                   image=image_id, disk_path=disk_path,
+                   networks=networks,
+                   public_key=public_key,
+                   cloud_init=cloud_init)
     elif conn.type == Provider.PACKET:
-        node = _create_machine_packet(conn, public_key, machine_name, image,
-                                         size, location, cloud_init, project_id)
+        node = run(_create_machine_packet, conn, public_key, machine_name, image,
+                   size, location, cloud_init, project_id)
     else:
         raise BadRequestError("Provider unknown.")
 
@@ -1763,9 +1771,144 @@ def create_machine(user, cloud_id, key_id, machine_name, location_id,
            'job_id': job_id,
            }
 
+    poller.boost(user.email, cloud_id)
     return ret
 
 
+def _provider_runner(controller):
+    """Return a function that calls a provider request through controller,
+    or directly if there is no controller"""
+    if controller is not None:
+        return controller.run
+    return lambda func, *args, **kwargs: func(*args, **kwargs)
+
+
+def supports_batch_create(cloud):
+    """Check if many machines can be created in cloud with one request"""
+    if cloud.provider in config.EC2_PROVIDERS:
+        return True
+    # only API v2 of DigitalOcean accepts a list of names
+    return (cloud.provider == Provider.DIGITAL_OCEAN and
+            cloud.apikey == cloud.apisecret)
+
+
+def create_machines(user, cloud_id, key_id, machine_names, location_id,
+                    image_id, size_id, script, image_extra, disk, image_name,
+                    size_name, location_name, monitoring, ssh_port=22,
+                    script_id='', script_params='', job_id=None, hostname='',
+                    plugins=None, post_script_id='', post_script_params='',
+                    cloud_init='', cronjob={}, controller=None):
+    """Creates several machines on the specified cloud with one request.
+
+    Only clouds for which supports_batch_create is True are supported. The
+    provider connection, key import and security group checks happen once
+    for the whole batch and the machines are created using the provider's
+    bulk primitive (MinCount/MaxCount in EC2, a list of names in Digital
+    Ocean). The key associations of all new machines are saved at once,
+    while post deploy steps are still scheduled separately per machine.
+
+    As in create_machine, only the provider's create request runs through
+    the ConcurrencyController, if one is given.
+
+    Returns a list of dicts like the one returned by create_machine, one
+    for each machine that was actually created.
+
+    """
+    log.info('Creating machines %s on cloud %s' % (machine_names, cloud_id))
+
+    if cloud_id not in user.clouds:
+        raise CloudNotFoundError(cloud_id)
+    cloud = user.clouds[cloud_id]
+    if not supports_batch_create(cloud):
+        raise BadRequestError("Batch machine creation is not supported "
+                              "for provider %s" % cloud.provider)
+    conn = connect_provider(cloud)
+    run = _provider_runner(controller)
+
+    machine_names = [machine_name_validator(conn.type, machine_name)
+                     for machine_name in machine_names]
+
+    if key_id and key_id not in user.keypairs:
+        raise KeypairNotFoundError(key_id)
+    # if key_id not provided, search for default key
+    if not key_id:
+        for kid in user.keypairs:
+            if user.keypairs[kid].default:
+                key_id = kid
+                break
+    if not key_id:
+        raise KeypairNotFoundError("Couldn't find default keypair")
+    public_key = user.keypairs[key_id].public
+
+    size = NodeSize(size_id, name=size_name, ram='', disk=disk,
+                    bandwidth='', price='', driver=conn)
+    image = NodeImage(image_id, name=image_name, extra=image_extra, driver=conn)
+    location = NodeLocation(location_id, name=location_name, country='', driver=conn)
+
+    if conn.type in config.EC2_PROVIDERS:
+        for loc in conn.list_locations():
+            if loc.id == location_id:
+                location = loc
+                break
+        nodes = run(_create_machines_ec2, conn, key_id, public_key,
+                    machine_names, image, size, location, cloud_init)
+    else:
+        nodes = run(_create_machines_digital_ocean, conn, public_key,
+                    machine_names, image, size, location, cloud_init)
+
+    _associate_key_many(user, key_id, cloud_id,
+                        [node.id for node in nodes], port=ssh_port)
+
+    ret = []
+    for node in nodes:
+        mist.io.tasks.post_deploy_steps.delay(
+            user.email, cloud_id, node.id, monitoring, script=script,
+            key_id=key_id, script_id=script_id, script_params=script_params,
+            job_id=job_id, hostname=hostname, plugins=plugins,
+            post_script_id=post_script_id,
+            post_script_params=post_script_params, cronjob=cronjob,
+        )
+        ret.append({'id': node.id,
+                    'name': node.name,
+                    'extra': node.extra,
+                    'public_ips': node.public_ips,
+                    'private_ips': node.private_ips,
+                    'job_id': job_id})
+    # pick up the new machines quickly
+    poller.boost(user.email, cloud_id)
+    return ret
+
+
+def _associate_key_many(user, key_id, cloud_id, machine_ids, port=22):
+    """Associate key with many machines, saving the user only once.
+
+    Like associate_key without a host, this only records the association,
+    it doesn't deploy the key.
+
+    """
+    if not machine_ids:
+        return
+    for i in range(3):
+        try:
+            with user.lock_n_load():
+                machines = user.keypairs[key_id].machines
+                associated = set(tuple(machine[:2]) for machine in machines)
+                for machine_id in machine_ids:
+                    if (cloud_id, machine_id) not in associated:
+                        machines.append([cloud_id, machine_id, 0, None,
+                                         False, port])
+                user.save()
+        except:
+            if i == 2:
+                log.error('RACE CONDITION: failed to recover from previous race conditions')
+                raise
+            else:
+                log.error('RACE CONDITION: trying to recover from race condition')
+        else:
+            break
+    trigger_session_update(user.email, ['keys'])
+
+
 def _create_machine_rackspace(conn, public_key, machine_name,
                              image, size, location, user_data):
     """Create a machine in Rackspace.
@@ -1866,6 +2009,77 @@ def _create_machine_ec2(conn, key_name, private_key, public_key,
 
     """
 
+    _prepare_ec2_create(conn, key_name, public_key)
+
+    with get_temp_file(private_key) as tmp_key_path:
+        #deploy_node wants path for ssh private key
+        try:
+            node = conn.create_node(
+                name=machine_name,
+                image=image,
+                size=size,
+                location=location,
+                ssh_key=tmp_key_path,
+                max_tries=1,
+                ex_keyname=key_name,
+                ex_securitygroup=config.EC2_SECURITYGROUP['name'],
+                ex_userdata=user_data
+            )
+        except Exception as e:
+            raise MachineCreationError("EC2, got exception %s" % e, e)
+
+    return node
+
+
+def _create_machines_ec2(conn, key_name, public_key, machine_names, image,
+                         size, location, user_data):
+    """Create many machines in Amazon EC2 with a single RunInstances call.
+
+    EC2 tags all instances of the reservation with the same name, so every
+    instance but the first is renamed afterwards. Since MinCount is 1, EC2
+    may launch fewer instances than requested, so the returned list may be
+    shorter than machine_names.
+
+    """
+
+    _prepare_ec2_create(conn, key_name, public_key)
+
+    try:
+        nodes = conn.create_node(
+            name=machine_names[0],
+            image=image,
+            size=size,
+            location=location,
+            ex_keyname=key_name,
+            ex_securitygroup=config.EC2_SECURITYGROUP['name'],
+            ex_userdata=user_data,
+            ex_mincount=1,
+            ex_maxcount=len(machine_names)
+        )
+    except Exception as e:
+        raise MachineCreationError("EC2, got exception %s" % e, e)
+    if not isinstance(nodes, list):
+        nodes = [nodes]
+
+    for node, machine_name in zip(nodes, machine_names):
+        if node.name != machine_name:
+            try:
+                conn.ex_create_tags(node, {'Name': machine_name})
+                node.name = machine_name
+            except Exception as exc:
+                log.error("Failed to rename EC2 machine %s to %s: %r",
+                          node.id, machine_name, exc)
+    return nodes
+
+
+def _prepare_ec2_create(conn, key_name, public_key):
+    """Import the key and create the security group needed by EC2 machines.
+
+    Both are idempotent, so this only needs to run once per creation request
+    regardless of the number of machines created.
+
+    """
+
     # import key. This is supported only for EC2 at the moment.
     with get_temp_file(public_key) as tmp_key_path:
         try:
@@ -1892,25 +2106,6 @@ def _create_machine_ec2(conn, key_name, private_key, public_key,
         else:
             raise InternalServerError("Couldn't create security group", exc)
 
-    with get_temp_file(private_key) as tmp_key_path:
-        #deploy_node wants path for ssh private key
-        try:
-            node = conn.create_node(
-                name=machine_name,
-                image=image,
-                size=size,
-                location=location,
-                ssh_key=tmp_key_path,
-                max_tries=1,
-                ex_keyname=key_name,
-                ex_securitygroup=config.EC2_SECURITYGROUP['name'],
-                ex_userdata=user_data
-            )
-        except Exception as e:
-            raise MachineCreationError("EC2, got exception %s" % e, e)
-
-    return node
-
 
 def _create_machine_nephoscale(conn, key_name, private_key, public_key,
                               machine_name, image, size, location, ips):
@@ -2076,6 +2271,66 @@ def _create_machine_digital_ocean(conn, key_name, private_key, public_key,
     Here there is no checking done, all parameters are expected to be
     sanitized by create_machine.
 
+    """
+    ex_ssh_key_ids, private_networking = _prepare_digital_ocean_create(
+        conn, machine_name, public_key, location
+    )
+
+    with get_temp_file(private_key) as tmp_key_path:
+        try:
+            node = conn.create_node(
+                name=machine_name,
+                image=image,
+                size=size,
+                ex_ssh_key_ids=ex_ssh_key_ids,
+                location=location,
+                ssh_key=tmp_key_path,
+                private_networking=private_networking,
+                user_data=user_data
+            )
+        except Exception as e:
+            raise MachineCreationError("Digital Ocean, got exception %s" % e, e)
+
+        return node
+
+
+def _create_machines_digital_ocean(conn, public_key, machine_names, image,
+                                   size, location, user_data):
+    """Create many droplets in Digital Ocean with a single request.
+
+    The v2 API accepts a list of names instead of a single name and creates
+    one droplet per name. libcloud has no support for this, so the request
+    is made directly through the driver's connection.
+
+    """
+    ex_ssh_key_ids, private_networking = _prepare_digital_ocean_create(
+        conn, machine_names[0], public_key, location
+    )
+
+    params = {'names': machine_names,
+              'size': size.id,
+              'image': image.id,
+              'region': location.id,
+              'ssh_keys': ex_ssh_key_ids,
+              'private_networking': private_networking}
+    if user_data:
+        params['user_data'] = user_data
+    try:
+        resp = conn.connection.request('/v2/droplets',
+                                       data=json.dumps(params),
+                                       method='POST')
+        nodes = [conn._to_node(droplet)
+                 for droplet in resp.object['droplets']]
+    except Exception as e:
+        raise MachineCreationError("Digital Ocean, got exception %s" % e, e)
+    return nodes
+
+
+def _prepare_digital_ocean_create(conn, machine_name, public_key, location):
+    """Find or upload the ssh key and check for private networking.
+
+    Returns a (ex_ssh_key_ids, private_networking) tuple.
+
     """
     key = public_key.replace('\n', '')
 
@@ -2117,22 +2372,7 @@ def _create_machine_digital_ocean(conn, key_name, private_key, public_key,
         # do not break if this fails for some reason
         pass
 
-    with get_temp_file(private_key) as tmp_key_path:
-        try:
-            node = conn.create_node(
-                name=machine_name,
-                image=image,
-                size=size,
-                ex_ssh_key_ids=ex_ssh_key_ids,
-                location=location,
-                ssh_key=tmp_key_path,
-                private_networking=private_networking,
-                user_data=user_data
-            )
-        except Exception as e:
-            raise MachineCreationError("Digital Ocean, got exception %s" % e, e)
-
-        return node
+    return ex_ssh_key_ids, private_networking
 
 
 def _create_machine_libvirt(conn, machine_name, disk_size, ram, cpu,
@@ -2429,61 +2669,85 @@ def _create_machine_linode(conn, key_name, private_key, public_key,
     return node
 
 
+MACHINE_ACTIONS = ('start', 'stop', 'reboot', 'destroy', 'resize', 'rename',
+                   'undefine', 'suspend', 'resume')
+
+# actions that need no extra per machine parameters and can run in bulk
+BULK_MACHINE_ACTIONS = ('start', 'stop', 'reboot', 'destroy', 'undefine',
+                        'suspend', 'resume')
+
+
 def _machine_action(user, cloud_id, machine_id, action, plan_id=None, name=None):
     """Start, stop, reboot, resize, undefine and destroy have the same logic underneath, the only
     thing that changes is the action. This helper function saves us some code.
 
     """
-    actions = ('start', 'stop', 'reboot', 'destroy', 'resize', 'rename', 'undefine', 'suspend', 'resume')
-
-    if action not in actions:
+    if action not in MACHINE_ACTIONS:
         raise BadRequestError("Action '%s' should be one of %s" % (action,
-                                                                   actions))
-
-    if cloud_id not in user.clouds:
-        raise CloudNotFoundError()
+                                                                   MACHINE_ACTIONS))
 
-    bare_metal = False
-    if user.clouds[cloud_id].provider == 'bare_metal':
-        bare_metal = True
-
-    try:
-        conn = connect_provider(user.clouds[cloud_id])
-    except InvalidCredsError:
-        raise CloudUnauthorizedError()
-    except Exception as exc:
-        log.error("Error while connecting to cloud")
-        raise CloudUnavailableError(exc=exc)
+    conn = _machine_action_connect(user, cloud_id)
 
     # GCE needs machine.extra as well, so we need the real machine object
     machine = None
+    cloud_service = None
     try:
         if conn.type == 'azure':
             # Azure needs the cloud service specified as well as the node
             cloud_service = conn.get_cloud_service_from_node_id(machine_id)
             nodes = conn.list_nodes(ex_cloud_service_name=cloud_service)
-            for node in nodes:
-                if node.id == machine_id:
-                    machine = node
-                    break
         else:
-            for node in conn.list_nodes():
-                if node.id == machine_id:
-                    machine = node
-                    break
+            nodes = conn.list_nodes()
+        for node in nodes:
+            if node.id == machine_id:
+                machine = node
+                break
         if machine is None:
             # did not find the machine_id on the list of nodes, still do not fail
             raise MachineUnavailableError("Error while attempting to %s machine"
                                   % action)
     except:
-        machine = Node(machine_id,
-                   name=machine_id,
-                   state=0,
-                   public_ips=[],
-                   private_ips=[],
-                   driver=conn)
+        machine = _unlisted_node(machine_id, conn)
+    ret = _apply_machine_action(user, cloud_id, conn, machine, action,
+                                plan_id=plan_id, name=name,
+                                cloud_service=cloud_service)
+    # pick up the new state of the machine quickly
+    poller.boost(user.email, cloud_id)
+    return ret
+
+
+def _machine_action_connect(user, cloud_id):
+    """Connect to the cloud a machine action is run on"""
+    if cloud_id not in user.clouds:
+        raise CloudNotFoundError()
+    try:
+        return connect_provider(user.clouds[cloud_id])
+    except InvalidCredsError:
+        raise CloudUnauthorizedError()
+    except Exception as exc:
+        log.error("Error while connecting to cloud")
+        raise CloudUnavailableError(exc=exc)
+
+
+def _unlisted_node(machine_id, conn):
+    """Node to act upon when a machine can't be found in the listing"""
+    return Node(machine_id,
+                name=machine_id,
+                state=0,
+                public_ips=[],
+                private_ips=[],
+                driver=conn)
+
+
+def _apply_machine_action(user, cloud_id, conn, machine, action,
+                          plan_id=None, name=None, cloud_service=None):
+    """Run action on an already looked up machine, see _machine_action"""
+    machine_id = machine.id
+    bare_metal = user.clouds[cloud_id].provider == 'bare_metal'
+    if conn.type == 'azure' and cloud_service is None:
+        cloud_service = conn.get_cloud_service_from_node_id(machine_id)
     try:
-        if action is 'start':
+        if action == 'start':
             # In liblcoud it is not possible to call this with machine.start()
             if conn.type == 'azure':
                 conn.ex_start_node(machine, ex_cloud_service_name=cloud_service)
@@ -2491,44 +2755,30 @@ def _machine_action(user, cloud_id, machine_id, action, plan_id=None, name=None)
                 conn.ex_start_node(machine)
 
             if conn.type is Provider.DOCKER:
-                node_info = conn.inspect_node(node)
-                try:
-                    port = node_info.extra['network_settings']['Ports']['22/tcp'][0]['HostPort']
-                except KeyError:
-                    port = 22
+                _update_docker_ssh_port(user, cloud_id, conn, machine)
 
-                with user.lock_n_load():
-                    machine_uid = [cloud_id, machine_id]
-
-                    for keypair in user.keypairs:
-                        for machine in user.keypairs[keypair].machines:
-                            if machine[:2] == machine_uid:
-                                key_id = keypair
-                                machine[-1] = int(port)
-                    user.save()
-
-        elif action is 'stop':
+        elif action == 'stop':
             # In libcloud it is not possible to call this with machine.stop()
             if conn.type == 'azure':
                 conn.ex_stop_node(machine, ex_cloud_service_name=cloud_service)
             else:
                 conn.ex_stop_node(machine)
-        elif action is 'undefine':
+        elif action == 'undefine':
             # In libcloud undefine means destroy machine and delete XML configuration
             if conn.type == 'libvirt':
                 conn.ex_undefine_node(machine)
-        elif action is 'suspend':
+        elif action == 'suspend':
             if conn.type == 'libvirt':
                 conn.ex_suspend_node(machine)
-        elif action is 'resume':
+        elif action == 'resume':
             if conn.type == 'libvirt':
                 conn.ex_resume_node(machine)
 
-        elif action is 'resize':
-            conn.ex_resize_node(node, plan_id)
-        elif action is 'rename':
-            conn.ex_rename_node(node, name)
-        elif action is 'reboot':
+        elif action == 'resize':
+            conn.ex_resize_node(machine, plan_id)
+        elif action == 'rename':
+            conn.ex_rename_node(machine, name)
+        elif action == 'reboot':
             if bare_metal:
                 try:
                     hostname = user.clouds[cloud_id].machines[machine_id].public_ips[0]
@@ -2558,25 +2808,11 @@ def _machine_action(user, cloud_id, machine_id, action, plan_id=None, name=None)
                 else:
                     machine.reboot()
                 if conn.type is Provider.DOCKER:
-                    node_info = conn.inspect_node(node)
-                    try:
-                        port = node_info.extra['network_settings']['Ports']['22/tcp'][0]['HostPort']
-                    except KeyError:
-                        port = 22
+                    _update_docker_ssh_port(user, cloud_id, conn, machine)
 
-                    with user.lock_n_load():
-                        machine_uid = [cloud_id, machine_id]
-
-                        for keypair in user.keypairs:
-                            for machine in user.keypairs[keypair].machines:
-                                if machine[:2] == machine_uid:
-                                    key_id = keypair
-                                    machine[-1] = int(port)
-                        user.save()
-
-        elif action is 'destroy':
-            if conn.type is Provider.DOCKER and node.state == 0:
-                conn.ex_stop_node(node)
+        elif action == 'destroy':
+            if conn.type is Provider.DOCKER and machine.state == 0:
+                conn.ex_stop_node(machine)
                 machine.destroy()
             elif conn.type == 'azure':
                 conn.destroy_node(machine, ex_cloud_service_name=cloud_service)
@@ -2590,8 +2826,124 @@ def _machine_action(user, cloud_id, machine_id, action, plan_id=None, name=None)
 
     except Exception as e:
         log.error("%r", e)
+        # keep the original exception, so that the ConcurrencyController
+        # of bulk actions can tell if the provider throttled us
         raise MachineUnavailableError("Error while attempting to %s machine"
-                                  % action)
+                                      % action, exc=e)
+
+
+def _update_docker_ssh_port(user, cloud_id, conn, machine):
+    """Update the ssh port of a container's key associations.
+
+    Docker maps the container's ssh port to a new host port every time the
+    container is (re)started.
+
+    """
+    node_info = conn.inspect_node(machine)
+    try:
+        port = node_info.extra['network_settings']['Ports']['22/tcp'][0]['HostPort']
+    except KeyError:
+        port = 22
+
+    with user.lock_n_load():
+        machine_uid = [cloud_id, machine.id]
+
+        for keypair in user.keypairs:
+            for assoc in user.keypairs[keypair].machines:
+                if assoc[:2] == machine_uid:
+                    assoc[-1] = int(port)
+        user.save()
+
+
+def bulk_machine_action(user, cloud_id, machine_ids, action):
+    """Run the same action on many machines of a cloud.
+
+    The nodes are listed once for all machines (once per cloud service in
+    Azure) and the actions run concurrently, with the rate and parallelism
+    limited by the cloud's ConcurrencyController. libcloud connections are
+    not thread safe, so every worker thread opens its own connection, which
+    it then reuses for all the machines it handles.
+
+    Returns a dict mapping every machine id to a result dict with a
+    'success' boolean and an 'error' string in case of failure.
+
+    """
+    from multiprocessing.dummy import Pool as ThreadPool
+    from mist.io.ratelimit import get_controller
+
+    if action not in BULK_MACHINE_ACTIONS:
+        raise BadRequestError("Action '%s' should be one of %s"
+                              % (action, BULK_MACHINE_ACTIONS))
+    if not machine_ids:
+        return {}
+    machine_ids = list(set(machine_ids))
+
+    conn = _machine_action_connect(user, cloud_id)
+
+    # find all machines with a single listing
+    nodes = {}
+    cloud_services = {}
+    try:
+        if conn.type == 'azure':
+            for machine_id in machine_ids:
+                service = conn.get_cloud_service_from_node_id(machine_id)
+                cloud_services[machine_id] = service
+            for service in set(cloud_services.values()):
+                for node in conn.list_nodes(ex_cloud_service_name=service):
+                    nodes[node.id] = node
+        else:
+            for node in conn.list_nodes():
+                nodes[node.id] = node
+    except Exception as exc:
+        log.error("Error while listing nodes for bulk %s: %r", action, exc)
+    if conn.type == 'libvirt':
+        conn.disconnect()
+
+    controller = get_controller(cloud_id, user.clouds[cloud_id].provider)
+    local = threading.local()
+
+    def run_action(machine_id):
+        if not hasattr(local, 'conn'):
+            local.conn = _machine_action_connect(user, cloud_id)
+        conn = local.conn
+        machine = nodes.get(machine_id)
+        if machine is None:
+            machine = _unlisted_node(machine_id, conn)
+        else:
+            # bind the listed node to this thread's connection
+            machine.driver = conn
+        try:
+            if action == 'destroy':
+                _disable_monitoring_before_destroy(user, cloud_id, machine_id)
+            ret = controller.run(_apply_machine_action, user, cloud_id, conn,
+                                 machine, action,
+                                 cloud_service=cloud_services.get(machine_id))
+            if ret is False:
+                return machine_id, {'success': False,
+                                    'error': "Failed to %s machine" % action}
+        except Exception as exc:
+            log.error("Bulk %s failed for machine %s: %r",
+                      action, machine_id, exc)
+            return machine_id, {'success': False, 'error': str(exc)}
+        return machine_id, {'success': True}
+
+    pool = ThreadPool(max(1, min(len(machine_ids),
+                                 controller.max_concurrency)))
+    try:
+        results = dict(pool.map(run_action, machine_ids))
+    finally:
+        pool.close()
+        pool.join()
+    if action == 'destroy':
+        # update key associations serially, they all modify the same user
+        for machine_id, result in results.items():
+            if result['success']:
+                _disassociate_destroyed_machine(user, cloud_id, machine_id)
+    log.info("Bulk %s on %d machines of cloud %s, stats: %s", action,
+             len(machine_ids), cloud_id, controller.get_stats())
+    # pick up the new state of the machines quickly
+    poller.boost(user.email, cloud_id)
+    return results
 
 
 def start_machine(user, cloud_id, machine_id):
@@ -2658,6 +3010,13 @@ def destroy_machine(user, cloud_id, machine_id):
     """
 
     log.info('Destroying machine %s in cloud %s' % (machine_id, cloud_id))
+    _disable_monitoring_before_destroy(user, cloud_id, machine_id)
+    _machine_action(user, cloud_id, machine_id, 'destroy')
+    _disassociate_destroyed_machine(user, cloud_id, machine_id)
+
+
+def _disable_monitoring_before_destroy(user, cloud_id, machine_id):
+    """Disable monitoring, if possible, of a machine about to be destroyed"""
     # if machine has monitoring, disable it. the way we disable depends on
     # whether this is a standalone io installation or not
     disable_monitoring_function = None
@@ -2681,8 +3040,9 @@ def destroy_machine(user, cloud_id, machine_id):
             log.warning("Didn't manage to disable monitoring, maybe the "
                         "machine never had monitoring enabled. Error: %r", exc)
 
-    _machine_action(user, cloud_id, machine_id, 'destroy')
 
+def _disassociate_destroyed_machine(user, cloud_id, machine_id):
+    """Delete all key associations of a destroyed machine"""
     pair = [cloud_id, machine_id]
     with user.lock_n_load():
         for key_id in user.keypairs:
@@ -2715,6 +3075,101 @@ def ssh_command(user, cloud_id, machine_id, host, command,
     return output
 
 
+def ssh_command_many(user, targets, command, callback=None):
+    """Run the same command on many machines over SSH.
+
+    targets is a list of dicts with the cloud_id, the machine_id and,
+    optionally, the host of each machine. If the host is missing, the first
+    public ip of the machine in the cached machine listing is used.
+
+    The command runs concurrently on up to config.SSH_FLEET_CONCURRENCY
+    machines at a time. If callback is given, it is called with the result
+    dict of each machine as soon as it's available.
+
+    Returns a list with the result dict of each target, in the same order,
+    and a dict with the aggregate timing.
+
+    """
+    from multiprocessing.dummy import Pool as ThreadPool
+
+    cached_hosts = {}
+
+    def find_host(cloud_id, machine_id):
+        if cloud_id not in cached_hosts:
+            cached_hosts[cloud_id] = {}
+            cached = mist.io.tasks.ListMachines().get_cached(user.email,
+                                                            cloud_id)
+            for machine in cached['payload']['machines'] if cached else []:
+                ips = [ip for ip in machine.get('public_ips') or []
+                       if ':' not in ip]
+                ips += [ip for ip in machine.get('private_ips') or []
+                        if ':' not in ip]
+                if ips:
+                    cached_hosts[cloud_id][machine['id']] = ips[0]
+        return cached_hosts[cloud_id].get(machine_id)
+
+    jobs = []
+    for target in targets:
+        cloud_id = target.get('cloud_id')
+        machine_id = target.get('machine_id')
+        host = target.get('host')
+        if cloud_id in user.clouds and machine_id and not host:
+            host = find_host(cloud_id, machine_id)
+        jobs.append((cloud_id, machine_id, host))
+
+    def run(job):
+        cloud_id, machine_id, host = job
+        result = {'cloud_id': cloud_id, 'machine_id': machine_id,
+                  'host': host, 'retval': None, 'output': '', 'error': ''}
+        started_at = time()
+        shell = None
+        try:
+            if cloud_id not in user.clouds:
+                raise CloudNotFoundError(cloud_id)
+            if not host:
+                raise BadRequestError("No host found for machine %s"
+                                      % machine_id)
+            shell = Shell(host)
+            shell.autoconfigure(user, cloud_id, machine_id)
+            result['retval'], result['output'] = shell.command(command)
+        except Exception as exc:
+            log.error("Command on %s %s failed: %r", cloud_id, machine_id, exc)
+            result['error'] = str(exc) or repr(exc)
+        finally:
+            if shell is not None:
+                shell.disconnect()
+        result['duration'] = time() - started_at
+        if callback is not None:
+            try:
+                callback(result)
+            except Exception as exc:
+                log.error("Error in ssh_command_many callback: %r", exc)
+        return result
+
+    started_at = time()
+    pool = ThreadPool(max(1, min(len(jobs), config.SSH_FLEET_CONCURRENCY)))
+    try:
+        results = pool.map(run, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    durations = [result['duration'] for result in results]
+    stats = {
+        'total': len(results),
+        'succeeded': len([result for result in results
+                          if result['retval'] == 0]),
+        'failed': len([result for result in results
+                       if result['retval'] != 0]),
+        'duration': time() - started_at,
+        'min_duration': min(durations) if durations else 0,
+        'max_duration': max(durations) if durations else 0,
+        'avg_duration': sum(durations) / len(durations) if durations else 0,
+        'ssh_pool': transport_pool.get_stats(),
+    }
+    return results, stats
+
+
 def list_images(user, cloud_id, term=None):
     """List images from each cloud.
 
@@ -2769,8 +3224,9 @@ def list_images(user, cloud_id, term=None):
             rest_images = conn.list_images(location=cloud.images_location)
         else:
             rest_images = conn.list_images()
+            starred_ids = set(starred)
             starred_images = [image for image in rest_images
-                              if image.id in starred]
+                              if image.id in starred_ids]
         if term and conn.type in config.EC2_PROVIDERS:
             ec2_images += conn.list_images(ex_owner="aws-marketplace")
 
@@ -2793,33 +3249,56 @@ def list_images(user, cloud_id, term=None):
     except Exception as e:
         log.error(repr(e))
         raise CloudUnavailableError(cloud_id, e)
+    image_starred = _image_starred_checker(cloud)
     ret = [{'id': image.id,
             'extra': image.extra,
             'name': image.name,
-            'star': _image_starred(user, cloud_id, image.id)}
+            'star': image_starred(image.id)}
            for image in images]
 
     return ret
 
 
-def _image_starred(user, cloud_id, image_id):
-    """Check if an image should appear as starred or not to the user"""
-    cloud = user.clouds[cloud_id]
+def _image_starred_checker(cloud):
+    """Return a function that checks if an image of cloud is starred
+
+    The starred/unstarred lists and the default images of the cloud are
+    turned into sets once, so that checking thousands of images doesn't
+    require a list lookup for each one of them.
+
+    """
     if cloud.provider.startswith('ec2'):
-        default = False
-        if cloud.provider in config.EC2_IMAGES:
-            if image_id in config.EC2_IMAGES[cloud.provider]:
-                default = True
+        default_ids = frozenset(config.EC2_IMAGES.get(cloud.provider, ()))
     else:
         # consider all images default for clouds with few images
-        default = True
-    starred = image_id in cloud.starred
-    unstarred = image_id in cloud.unstarred
-    return starred or (default and not unstarred)
+        default_ids = None
+    starred_ids = frozenset(cloud.starred)
+    unstarred_ids = frozenset(cloud.unstarred)
+
+    def image_starred(image_id):
+        if image_id in starred_ids:
+            return True
+        if image_id in unstarred_ids:
+            return False
+        return default_ids is None or image_id in default_ids
+
+    return image_starred
+
+
+def _image_starred(user, cloud_id, image_id):
+    """Check if an image should appear as starred or not to the user"""
+    return _image_starred_checker(user.clouds[cloud_id])(image_id)
 
 
 def star_image(user, cloud_id, image_id):
-    """Toggle image star (star/unstar)"""
+    """Toggle image star (star/unstar)
+
+    The cached image listing is updated in place, so that toggling a star
+    doesn't trigger a full image listing from the provider. The listing is
+    only refreshed if the image is not part of the cached listing at all,
+    eg when starring an EC2 image found through search.
+
+    """
 
     with user.lock_n_load():
         cloud = user.clouds[cloud_id]
@@ -2836,6 +3315,15 @@ def star_image(user, cloud_id, image_id):
                 cloud.unstarred.remove(image_id)
         user.save()
     task = mist.io.tasks.ListImages()
+    cached = task.get_cached(user.email, cloud_id)
+    if cached is not None:
+        for image in cached['payload']['images']:
+            if image['id'] == image_id:
+                image['star'] = not star
+                task.set_cached(cached, user.email, cloud_id)
+                amqp_publish_user(user, routing_key=task.task_key,
+                                  data=cached['payload'])
+                return not star
     task.clear_cache(user.email, cloud_id)
     task.delay(user.email, cloud_id)
     return not star
@@ -2987,27 +3475,35 @@ def list_networks(user, cloud_id):
                 'extra': network.extra,
             })
     elif conn.type in (Provider.OPENSTACK,):
-        networks = conn.ex_list_networks()
-        subnets = conn.ex_list_subnets()
-        routers = conn.ex_list_routers()
+        # list floating ips first, authenticating conn, to only list nodes
+        # if there are floating ips to map to them
         floating_ips = conn.ex_list_floating_ips()
         if conn.connection.tenant_id:
             floating_ips = [floating_ip for floating_ip in floating_ips if floating_ip.extra.get('tenant_id') == conn.connection.tenant_id]
+        methods = ['ex_list_networks', 'ex_list_subnets', 'ex_list_routers']
         if floating_ips:
-            nodes = conn.list_nodes()
-        else:
-            nodes = []
+            methods.append('list_nodes')
 
-        public_networks = []
-        for net in networks:
-            if net.router_external:
-                net_index = networks.index(net)
-                public_networks.append(networks.pop(net_index))
+        # The rest of the calls are independent, so issue them concurrently.
+        # libcloud connections are not thread safe, so each call gets its
+        # own, reusing the auth token of conn.
+        from multiprocessing.dummy import Pool as ThreadPool
 
-        for pub_net in public_networks:
-            ret['public'].append(openstack_network_to_dict(pub_net, subnets, floating_ips, nodes))
-        for network in networks:
-            ret['private'].append(openstack_network_to_dict(network, subnets))
+        def list_resources(method):
+            return getattr(_openstack_connection_copy(cloud, conn), method)()
+
+        pool = ThreadPool(len(methods))
+        try:
+            results = pool.map(list_resources, methods)
+        finally:
+            pool.close()
+            pool.join()
+        networks, subnets, routers = results[:3]
+        nodes = results[3] if floating_ips else []
+
+        ret['public'], ret['private'] = openstack_networks_to_dict(
+            networks, subnets, floating_ips, nodes
+        )
         for router in routers:
             ret['routers'].append(openstack_router_to_dict(router))
     elif conn.type in [Provider.GCE]:
@@ -3029,6 +3525,18 @@ def list_networks(user, cloud_id):
     return ret
 
 
+def _openstack_connection_copy(cloud, conn):
+    """Return a new connection to an OpenStack cloud, that reuses the auth
+    token and service catalog of the already authenticated conn instead of
+    authenticating again"""
+    new_conn = connect_provider(cloud)
+    for attr in ('_osa', 'auth_token', 'auth_token_expires', 'auth_user_info',
+                 'service_catalog'):
+        if getattr(conn.connection, attr, None) is not None:
+            setattr(new_conn.connection, attr, getattr(conn.connection, attr))
+    return new_conn
+
+
 def list_projects(user, cloud_id):
     """List projects for each account.
     Currently supported for Packet.net. For other providers
@@ -3093,7 +3601,56 @@ def gce_network_to_dict(network):
     return net
 
 
-def openstack_network_to_dict(network, subnets=[], floating_ips=[], nodes=[]):
+def openstack_networks_to_dict(networks, subnets=[], floating_ips=[], nodes=[]):
+    """Return the (public, private) lists of network dicts of an OpenStack
+    tenant.
+
+    Subnets, floating ips and nodes are grouped by network and private ip
+    in a single pass over each list, so that matching them with networks
+    takes linear time. Private networks don't include floating ips.
+
+    """
+    subnet_networks = {}
+    for network in networks:
+        for subnet_id in network.subnets:
+            subnet_networks.setdefault(subnet_id, []).append(network.id)
+    subnets_by_network = {}
+    for subnet in subnets:
+        for network_id in subnet_networks.get(subnet.id, []):
+            subnets_by_network.setdefault(network_id, []).append(subnet)
+    floating_ips_by_network = {}
+    for floating_ip in floating_ips:
+        floating_ips_by_network.setdefault(floating_ip.floating_network_id,
+                                           []).append(floating_ip)
+    nodes_by_ip = _index_nodes_by_private_ip(nodes)
+
+    public = []
+    private = []
+    for network in networks:
+        if network.router_external:
+            public.append(openstack_network_to_dict(
+                network, subnets_by_network.get(network.id, []),
+                floating_ips_by_network.get(network.id, []),
+                nodes_by_ip=nodes_by_ip
+            ))
+        else:
+            private.append(openstack_network_to_dict(
+                network, subnets_by_network.get(network.id, [])
+            ))
+    return public, private
+
+
+def _index_nodes_by_private_ip(nodes):
+    """Map each private ip of the given nodes to the node's id"""
+    nodes_by_ip = {}
+    for node in nodes:
+        for ip in node.private_ips:
+            nodes_by_ip[ip] = node.id
+    return nodes_by_ip
+
+
+def openstack_network_to_dict(network, subnets=[], floating_ips=[], nodes=[],
+                              nodes_by_ip=None):
     net = {}
     net['name'] = network.name
     net['id'] = network.id
@@ -3103,13 +3660,18 @@ def openstack_network_to_dict(network, subnets=[], floating_ips=[], nodes=[]):
     net['public'] = bool(network.router_external)
     net['subnets'] = [openstack_subnet_to_dict(subnet) for subnet in subnets if subnet.id in network.subnets]
     net['floating_ips'] = []
+    if floating_ips and nodes_by_ip is None:
+        nodes_by_ip = _index_nodes_by_private_ip(nodes)
     for floating_ip in floating_ips:
         if floating_ip.floating_network_id == network.id:
-            net['floating_ips'].append(openstack_floating_ip_to_dict(floating_ip, nodes))
+            net['floating_ips'].append(
+                openstack_floating_ip_to_dict(floating_ip,
+                                              nodes_by_ip=nodes_by_ip)
+            )
     return net
 
 
-def openstack_floating_ip_to_dict(floating_ip, nodes=[]):
+def openstack_floating_ip_to_dict(floating_ip, nodes=[], nodes_by_ip=None):
     ret = {}
     ret['id'] = floating_ip.id
     ret['floating_network_id'] = floating_ip.floating_network_id
@@ -3118,11 +3680,9 @@ def openstack_floating_ip_to_dict(floating_ip, nodes=[]):
     ret['status'] = str(floating_ip.status)
     ret['port_id'] = floating_ip.port_id
     ret['extra'] = floating_ip.extra
-    ret['node_id'] = ''
-
-    for node in nodes:
-        if floating_ip.fixed_ip_address in node.private_ips:
-            ret['node_id'] = node.id
+    if nodes_by_ip is None:
+        nodes_by_ip = _index_nodes_by_private_ip(nodes)
+    ret['node_id'] = nodes_by_ip.get(floating_ip.fixed_ip_address, '')
 
     return ret
 
@@ -3346,6 +3906,10 @@ def delete_network(user, cloud_id, network_id):
         pass
 
 
+# max number of EC2 resources tagged with a single CreateTags/DeleteTags call
+EC2_TAGS_BATCH_SIZE = 200
+
+
 def set_machine_tags(user, cloud_id, machine_id, tags):
     """Sets metadata for a machine, given the cloud and machine id.
 
@@ -3356,6 +3920,48 @@ def set_machine_tags(user, cloud_id, machine_id, tags):
     comparing in ifs. u'f' is 'f' returns false and 'in' is too broad.
 
     Tags is expected to be a list of key-value dicts
+    """
+    exc = _set_tags(user, cloud_id, {machine_id: tags})[machine_id]
+    if exc is not None:
+        raise exc
+
+
+def set_machines_tags(user, cloud_id, machines_tags):
+    """Sets metadata for many machines of a cloud.
+
+    machines_tags is a dict mapping machine ids to lists of key-value dicts,
+    like the tags argument of set_machine_tags.
+
+    Returns a dict mapping every machine id to a result dict with a
+    'success' boolean and an 'error' string in case of failure.
+
+    """
+    results = {}
+    for machine_id, exc in _set_tags(user, cloud_id, machines_tags).items():
+        if exc is None:
+            results[machine_id] = {'success': True}
+        else:
+            results[machine_id] = {'success': False, 'error': str(exc)}
+    return results
+
+
+def _set_tags(user, cloud_id, machines_tags):
+    """Sync the tags of many machines, sending only what has changed.
+
+    The current tags of the machines are fetched from the provider, never
+    taken from the cached machine listing, which may be stale and also
+    holds mist.io tags. In EC2 the minimal sets of tags to add and to
+    remove are computed for each machine and machines with the same
+    changes are updated together, with a single CreateTags and a single
+    DeleteTags request, so that the tags that remain the same are never
+    removed. Other providers can only replace all metadata of a single
+    machine. In GCE, where the nodes have to be listed anyway to get their
+    metadata fingerprint, only machines whose tags have changed are
+    updated.
+
+    Returns a dict mapping machine ids to the exception raised while
+    updating each machine or None.
+
     """
 
     if cloud_id not in user.clouds:
@@ -3364,9 +3970,191 @@ def set_machine_tags(user, cloud_id, machine_id, tags):
 
     conn = connect_provider(cloud)
 
+    desired_tags = {}
+    for machine_id, tags in machines_tags.items():
+        tags_dict = _tags_to_dict(tags)
+        if conn.type in config.EC2_PROVIDERS and len(tags_dict) > 9:
+            # ec2 resource can have up to 10 tags, with one of them being the Name
+            tags_dict = dict(tags_dict.items()[:9])
+        desired_tags[machine_id] = tags_dict
+
+    errors = dict((machine_id, None) for machine_id in machines_tags)
+    # machine id -> (to_add, to_remove), where the provider's tags are known
+    diffs = {}
+
+    if conn.type in config.EC2_PROVIDERS:
+        current_tags = _ec2_current_tags(conn, desired_tags.keys())
+        # group machines that need the exact same changes
+        additions = {}
+        removals = {}
+        for machine_id, tags_dict in desired_tags.items():
+            current = current_tags.get(machine_id)
+            if isinstance(current, Exception):
+                errors[machine_id] = CloudUnavailableError(cloud_id, current)
+                continue
+            to_add, to_remove = diffs[machine_id] = _diff_tags(current,
+                                                               tags_dict)
+            if to_add:
+                key = tuple(sorted(to_add.items()))
+                additions.setdefault(key, []).append(machine_id)
+            if to_remove:
+                key = tuple(sorted(to_remove))
+                removals.setdefault(key, []).append(machine_id)
+        for action, groups in (('DeleteTags', removals),
+                               ('CreateTags', additions)):
+            for tags, machine_ids in groups.items():
+                try:
+                    _ec2_batch_tags(conn, action, machine_ids, dict(
+                        tag if isinstance(tag, tuple) else (tag, None)
+                        for tag in tags
+                    ))
+                except Exception as exc:
+                    for machine_id in machine_ids:
+                        errors[machine_id] = CloudUnavailableError(cloud_id,
+                                                                   exc)
+    else:
+        nodes = {}
+        if conn.type == 'gce':
+            try:
+                for node in conn.list_nodes():
+                    if node.id in desired_tags:
+                        nodes[node.id] = node
+            except Exception as exc:
+                for machine_id in desired_tags:
+                    errors[machine_id] = CloudUnavailableError(cloud_id, exc)
+        for machine_id, tags_dict in desired_tags.items():
+            if errors[machine_id] is not None:
+                continue
+            node = nodes.get(machine_id)
+            if node is not None:
+                current = _tags_to_dict(
+                    [{item['key']: item.get('value')} for item in
+                     node.extra.get('metadata', {}).get('items') or []]
+                )
+                diffs[machine_id] = _diff_tags(current, tags_dict)
+                if current == tags_dict:
+                    continue
+            try:
+                _set_machine_metadata(conn, cloud_id, machine_id,
+                                      machines_tags[machine_id], tags_dict,
+                                      node)
+            except MistError as exc:
+                errors[machine_id] = exc
+
+    # keep the cached machine listing up to date, and drop the cached
+    # mist.io tags, so the listing doesn't wait MACHINE_TAGS_CACHE_TTL to
+    # pick up changes to them
+    task = mist.io.tasks.ListMachines()
+    task.clear_mist_tags_cache(user.email, cloud_id)
+    cached = task.get_cached(user.email, cloud_id)
+    if cached is not None:
+        cached_machines = dict((machine['id'], machine)
+                               for machine in cached['payload']['machines'])
+        updated = False
+        for machine_id, tags_dict in desired_tags.items():
+            machine = cached_machines.get(machine_id)
+            if errors[machine_id] is not None or machine is None:
+                continue
+            if machine_id in diffs:
+                to_add, to_remove = diffs[machine_id]
+            else:
+                # all metadata was replaced, diff against the metadata of
+                # the cached listing
+                to_add, to_remove = _diff_tags(_cached_metadata(machine),
+                                               tags_dict)
+            if to_add or to_remove:
+                # keep the tags list_machines derives from other fields
+                machine['tags'] = _apply_tags_diff(machine['tags'], to_add,
+                                                   to_remove)
+                updated = True
+        if updated:
+            task.set_cached(cached, user.email, cloud_id)
+    return errors
+
+
+def _cached_metadata(machine):
+    """Return the provider's tags of a machine of the cached listing, as
+    list_machines found them in the node's extra"""
+    extra = machine.get('extra') or {}
+    metadata = extra.get('tags') or extra.get('metadata') or {}
+    if not isinstance(metadata, dict):
+        return {}
+    if 'items' in metadata:
+        # GCE
+        return _tags_to_dict([{item['key']: item.get('value')}
+                              for item in metadata['items'] or []])
+    return _tags_to_dict([metadata])
+
+
+def _apply_tags_diff(tags, to_add, to_remove):
+    """Apply the changes of _diff_tags to a list of key-value dicts, like
+    the tags of the machine listing"""
+    ret = []
+    for tag in tags:
+        key = tag.get('key')
+        if type(key) == unicode:
+            key = key.encode('utf-8')
+        if key not in to_add and key not in to_remove:
+            ret.append(tag)
+    ret.extend({'key': key, 'value': value}
+               for key, value in sorted(to_add.items()))
+    return ret
+
+
+def _ec2_current_tags(conn, machine_ids):
+    """Return a dict mapping EC2 machine ids to their tags, except Name, as
+    the provider has them, or to the exception raised while fetching them.
+
+    All machines are described with a single request. If that fails, eg
+    because one of them no longer exists, they are described one by one.
+
+    """
+    current_tags = {}
+    try:
+        for node in conn.list_nodes(ex_node_ids=list(machine_ids)):
+            current_tags[node.id] = node.extra.get('tags') or {}
+    except Exception as exc:
+        log.warning("Error describing %d EC2 machines, describing them one "
+                    "by one: %r", len(machine_ids), exc)
+    for machine_id in machine_ids:
+        if machine_id in current_tags:
+            continue
+        machine = Node(machine_id, name='', state=0, public_ips=[],
+                       private_ips=[], driver=conn)
+        try:
+            current_tags[machine_id] = conn.ex_describe_tags(machine)
+        except Exception as exc:
+            current_tags[machine_id] = exc
+    for machine_id, tags in current_tags.items():
+        if isinstance(tags, dict):
+            tags = _tags_to_dict([tags])
+            tags.pop('Name', None)
+            current_tags[machine_id] = tags
+    return current_tags
+
+
+def _set_machine_metadata(conn, cloud_id, machine_id, tags, tags_dict,
+                          node=None):
+    """Replace all metadata of a single, non EC2, machine. In GCE node is
+    the freshly listed machine, needed for its metadata fingerprint"""
     machine = Node(machine_id, name='', state=0, public_ips=[],
                    private_ips=[], driver=conn)
+    if conn.type == 'gce':
+        if not node:
+            raise MachineNotFoundError(machine_id)
+        try:
+            conn.ex_set_node_metadata(node, tags)
+        except Exception as exc:
+            raise InternalServerError("error setting tags", exc)
+    else:
+        try:
+            conn.ex_set_metadata(machine, tags_dict)
+        except Exception as exc:
+            raise InternalServerError("error creating tags", exc)
 
+
+def _tags_to_dict(tags):
+    """Convert a list of key-value dicts to a utf-8 encoded dict"""
     tags_dict = {}
     for tag in tags:
         for tag_key, tag_value in tag.items():
@@ -3375,52 +4163,36 @@ def set_machine_tags(user, cloud_id, machine_id, tags):
             if type(tag_value) ==  unicode:
                 tag_value = tag_value.encode('utf-8')
             tags_dict[tag_key] = tag_value
+    return tags_dict
 
-    if conn.type in config.EC2_PROVIDERS:
-        try:
-            # first get a list of current tags. Make sure
-            # the response dict gets utf-8 encoded
-            # then delete tags and update with the new ones
-            ec2_tags = conn.ex_describe_tags(machine)
-            ec2_tags.pop('Name')
-            encoded_ec2_tags = {}
-            for ec2_key, ec2_value in ec2_tags.items():
-                if type(ec2_key) ==  unicode:
-                    ec2_key = ec2_key.encode('utf-8')
-                if type(ec2_value) ==  unicode:
-                    ec2_value = ec2_value.encode('utf-8')
-                encoded_ec2_tags[ec2_key] = ec2_value
-            conn.ex_delete_tags(machine, encoded_ec2_tags)
-            # ec2 resource can have up to 10 tags, with one of them being the Name
-            if len(tags_dict) > 9:
-                tags_keys = tags_dict.keys()[:9]
-                pop_keys = [key for key in tags_dict.keys() if key not in tags_keys]
-                for key in pop_keys:
-                    tags_dict.pop(key)
 
-            conn.ex_create_tags(machine, tags_dict)
-        except Exception as exc:
-            raise CloudUnavailableError(cloud_id, exc)
-    else:
-        if conn.type == 'gce':
-            try:
-                for node in conn.list_nodes():
-                    if node.id == machine_id:
-                        machine = node
-                        break
-            except Exception as exc:
-                raise CloudUnavailableError(cloud_id, exc)
-            if not machine:
-                raise MachineNotFoundError(machine_id)
-            try:
-                conn.ex_set_node_metadata(machine, tags)
-            except Exception as exc:
-                raise InternalServerError("error setting tags", exc)
-        else:
-            try:
-                conn.ex_set_metadata(machine, tags_dict)
-            except Exception as exc:
-                raise InternalServerError("error creating tags", exc)
+def _diff_tags(current, desired):
+    """Return the (to_add, to_remove) dicts that turn current into desired"""
+    to_add = dict((key, value) for key, value in desired.iteritems()
+                  if key not in current or current[key] != value)
+    to_remove = dict((key, value) for key, value in current.iteritems()
+                     if key not in desired)
+    return to_add, to_remove
+
+
+def _ec2_batch_tags(conn, action, resource_ids, tags):
+    """Create or delete the same tags on many EC2 resources at once.
+
+    libcloud's ex_create_tags and ex_delete_tags accept a single resource,
+    while the EC2 API accepts many, so the request is built here. When
+    deleting, values are omitted so that tags are deleted regardless of
+    their value.
+
+    """
+    for i in range(0, len(resource_ids), EC2_TAGS_BATCH_SIZE):
+        params = {'Action': action}
+        for j, resource_id in enumerate(resource_ids[i:i + EC2_TAGS_BATCH_SIZE]):
+            params['ResourceId.%d' % (j + 1)] = resource_id
+        for j, (key, value) in enumerate(sorted(tags.items())):
+            params['Tag.%d.Key' % (j + 1)] = key
+            if action == 'CreateTags':
+                params['Tag.%d.Value' % (j + 1)] = value
+        conn.connection.request(conn.path, params=params)
 
 
 def delete_machine_tag(user, cloud_id, machine_id, tag):
@@ -3514,6 +4286,8 @@ def delete_machine_tag(user, cloud_id, machine_id, tag):
                 conn.ex_set_metadata(machine, tags)
             except:
                 raise CloudUnavailableError("Error while updating metadata")
+    # the listing shouldn't wait MACHINE_TAGS_CACHE_TTL for the change
+    mist.io.tasks.ListMachines().clear_mist_tags_cache(user.email, cloud_id)
 
 
 def check_monitoring(user):
@@ -3625,10 +4399,7 @@ def probe(user, cloud_id, machine_id, host, key_id='', ssh_user=''):
 
     # start pinging the machine in the background
     log.info("Starting ping in the background for host %s", host)
-    ping = subprocess.Popen(
-        ["ping", "-c", "10", "-i", "0.4", "-W", "1", "-q", host],
-        stdout=subprocess.PIPE
-    )
+    ping = subprocess.Popen(PING_COMMAND + [host], stdout=subprocess.PIPE)
     try:
         ret = probe_ssh_only(user, cloud_id, machine_id, host,
                              key_id=key_id, ssh_user=ssh_user)
@@ -3642,81 +4413,222 @@ def probe(user, cloud_id, machine_id, host, key_id='', ssh_user=''):
     return ret
 
 
-def probe_ssh_only(user, cloud_id, machine_id, host, key_id='', ssh_user='',
-                   shell=None):
-    """Ping and SSH to machine and collect various metrics."""
+# Collects all probe metrics with a single command. It prints one key=value
+# line per metric, plus the output of df and, when the ip command is not
+# available, ifconfig between begin/end markers. It's run with sh -c and
+# contains no single quotes, so that it works regardless of the login shell.
+PROBE_COMMAND = "sh -c '%s'" % "; ".join([
+    "echo mist-probe-v1",
+    "if [ -f /proc/loadavg ]; then echo loadavg=$(cat /proc/loadavg); "
+    "else echo loadavg=$(sysctl -n vm.loadavg); fi",
+    "echo users=$(who | wc -l)",
+    "if [ -f /proc/uptime ]; then echo uptime=$(cat /proc/uptime); "
+    "else echo uptime=$(expr $(date +%s) - $(sysctl kern.boottime | "
+    "sed -En \"s/[^0-9]*([0-9]+).*/\\1/p\")); fi",
+    "if [ -f /proc/cpuinfo ]; then "
+    "echo cores=$(grep -c processor /proc/cpuinfo); "
+    "else echo cores=$(sysctl -n hw.ncpu); fi",
+    "if command -v ip >/dev/null 2>&1 && [ -d /sys/class/net ]; then "
+    "for i in $(ls /sys/class/net); do "
+    "for a in $(ip -o -4 addr show dev $i | awk \"{print \\$4}\"); do "
+    "echo inet=${a%/*} $(cat /sys/class/net/$i/address); done; done; "
+    "else echo ifconfig-begin; /sbin/ifconfig; echo ifconfig-end; fi",
+    "echo df-begin; /bin/df -Pah; echo df-end",
+])
+
+_PROBE_LINE_RE = re.compile(r'^([a-z]+)=(.*)$')
+_PROBE_NUMBER_RE = re.compile(r'\d+(?:\.\d+)?')
+_PROBE_IP_RE = re.compile(r'inet (?:addr:)?(\d{1,3}(?:\.\d{1,3}){3})')
+_PROBE_MAC_RE = re.compile(r'((?:[0-9a-fA-F]{1,2}:){5}[0-9a-fA-F]{1,2})')
+_PROBE_IFACE_RE = re.compile(r'\n(?=\S)')
+
+
+def parse_probe_output(output):
+    """Parse the output of PROBE_COMMAND into a probe result dict.
+
+    Raises ValueError if output doesn't come from PROBE_COMMAND.
 
-    # run SSH commands
-    command = (
-       "echo \""
-       "sudo -n uptime 2>&1|"
-       "grep load|"
-       "wc -l && "
-       "echo -------- && "
-       "uptime && "
-       "echo -------- && "
-       "if [ -f /proc/uptime ]; then cat /proc/uptime; "
-       "else expr `date '+%s'` - `sysctl kern.boottime | sed -En 's/[^0-9]*([0-9]+).*/\\1/p'`;"
-       "fi; "
-       "echo -------- && "
-       "if [ -f /proc/cpuinfo ]; then grep -c processor /proc/cpuinfo;"
-       "else sysctl hw.ncpu | awk '{print $2}';"
-       "fi;"
-       "echo -------- && "
-       "/sbin/ifconfig;"
-       "echo -------- &&"
-       "/bin/df -Pah;"
-       "echo --------"
-       "\"|sh" # In case there is a default shell other than bash/sh (e.g. csh)
-    )
+    """
+    lines = output.replace('\r', '').split('\n')
+    if 'mist-probe-v1' not in lines:
+        raise ValueError("Unexpected probe output: %r" % output[:200])
+    values = {}
+    sections = {'df': [], 'ifconfig': []}
+    section = None
+    macs = {}
+    for line in lines:
+        if section is not None:
+            if line == section + '-end':
+                section = None
+            else:
+                sections[section].append(line)
+            continue
+        if line.endswith('-begin') and line[:-6] in sections:
+            section = line[:-6]
+            continue
+        match = _PROBE_LINE_RE.match(line)
+        if not match:
+            continue
+        key, value = match.groups()
+        if key == 'inet':
+            parts = value.split()
+            if parts:
+                macs[parts[0]] = parts[1] if len(parts) > 1 else ''
+        else:
+            values[key] = value
 
-    if key_id:
-        log.warn('probing with key %s' % key_id)
+    # fall back to ifconfig, one block per interface
+    for block in _PROBE_IFACE_RE.split('\n'.join(sections['ifconfig'])):
+        mac = _PROBE_MAC_RE.search(block)
+        for ip in _PROBE_IP_RE.findall(block):
+            macs[ip] = mac.group(1) if mac else ''
 
-    if not shell:
-        cmd_output = ssh_command(user, cloud_id, machine_id,
-                                 host, command, key_id=key_id)
-    else:
-        retval, cmd_output = shell.command(command)
-
-    cmd_output = cmd_output.replace('\r','').split('--------')
-    log.warn(cmd_output)
-    uptime_output = cmd_output[1]
-    loadavg = re.split('load averages?: ', uptime_output)[1].split(', ')
-    users = re.split(' users?', uptime_output)[0].split(', ')[-1].strip()
-    uptime = cmd_output[2]
-    cores = cmd_output[3]
-    ips = re.findall('inet addr:(\S+)', cmd_output[4])
-    m = re.findall('((?:[0-9a-fA-F]{1,2}:){5}[0-9a-fA-F]{1,2})', cmd_output[4])
-    if '127.0.0.1' in ips:
-        ips.remove('127.0.0.1')
-    macs = {}
-    for i in range(0, len(ips)):
-        macs[ips[i]] = m[i]
+    macs.pop('127.0.0.1', None)
+    ips = macs.keys()
     pub_ips = find_public_ips(ips)
     priv_ips = [ip for ip in ips if ip not in pub_ips]
 
     return {
-        'uptime': uptime,
-        'loadavg': loadavg,
-        'cores': cores,
-        'users': users,
+        'uptime': values.get('uptime', ''),
+        'loadavg': _PROBE_NUMBER_RE.findall(values.get('loadavg', ''))[:3],
+        'cores': values.get('cores', '').strip(),
+        'users': values.get('users', '').strip(),
         'pub_ips': pub_ips,
         'priv_ips': priv_ips,
         'macs': macs,
-        'df': cmd_output[5],
+        'df': '\n'.join(sections['df']),
         'timestamp': time(),
     }
 
 
+def probe_ssh_only(user, cloud_id, machine_id, host, key_id='', ssh_user='',
+                   shell=None):
+    """Ping and SSH to machine and collect various metrics."""
+
+    if key_id:
+        log.warn('probing with key %s' % key_id)
+
+    if not shell:
+        cmd_output = ssh_command(user, cloud_id, machine_id,
+                                 host, PROBE_COMMAND, key_id=key_id)
+    else:
+        retval, cmd_output = shell.command(PROBE_COMMAND)
+
+    return parse_probe_output(cmd_output)
+
+
+def probe_many(user, targets, callback=None):
+    """Probe many machines concurrently over SSH.
+
+    targets is a list of dicts with the cloud_id, machine_id and optionally
+    the host of each machine, like in ssh_command_many, which is used to
+    run the probe command on all machines.
+
+    If callback is given, it's called with a dict with the cloud_id,
+    machine_id, host and either the probe result or an error of each
+    machine, as soon as it's available.
+
+    Returns a list of such dicts, one per target, and the aggregate timing.
+
+    """
+
+    def on_result(result):
+        probe = {'cloud_id': result['cloud_id'],
+                 'machine_id': result['machine_id'],
+                 'host': result['host']}
+        if result['error']:
+            probe['error'] = result['error']
+        else:
+            try:
+                probe['result'] = parse_probe_output(result['output'])
+            except ValueError as exc:
+                probe['error'] = str(exc)
+        result['probe'] = probe
+        if callback is not None:
+            callback(probe)
+
+    results, stats = ssh_command_many(user, targets, PROBE_COMMAND, on_result)
+    return [result['probe'] for result in results], stats
+
+
+PING_COMMAND = ["ping", "-c", "10", "-i", "0.4", "-W", "1", "-q"]
+
+
 def ping(host):
-    ping = subprocess.Popen(
-        ["ping", "-c", "10", "-i", "0.4", "-W", "1", "-q", host],
-        stdout=subprocess.PIPE
-    )
-    ping_out = ping.stdout.read()
-    ping.wait()
-    return parse_ping(ping_out)
+    return ping_many([host])[host]
+
+
+def ping_many(hosts, callback=None):
+    """Ping many hosts concurrently.
+
+    Up to config.PING_CONCURRENCY ping processes run at the same time and
+    their output is read from a single select loop, so that pinging a
+    whole cloud takes about as long as pinging a single host and doesn't
+    need a thread or a celery worker per host. Pings still running after
+    config.PING_TIMEOUT secs are killed.
+
+    If callback is given, it is called with each host and its parsed ping
+    metrics as soon as that host's ping is over.
+
+    Returns a dict mapping every host to its parsed ping metrics, which is
+    empty if pinging the host failed.
+
+    """
+    import select
+
+    results = {}
+    pending = []
+    for host in hosts:
+        if host not in pending:
+            pending.append(host)
+    pending.reverse()
+    running = {}  # stdout fd -> (host, process, output chunks, deadline)
+
+    def finish(host, output):
+        results[host] = parse_ping(output) if output else {}
+        if callback is not None:
+            try:
+                callback(host, results[host])
+            except Exception as exc:
+                log.error("Error in ping_many callback: %r", exc)
+
+    while pending or running:
+        while pending and len(running) < config.PING_CONCURRENCY:
+            host = pending.pop()
+            try:
+                proc = subprocess.Popen(PING_COMMAND + [host],
+                                        stdout=subprocess.PIPE)
+            except OSError as exc:
+                log.error("Error starting ping for %s: %r", host, exc)
+                finish(host, '')
+                continue
+            running[proc.stdout.fileno()] = (host, proc, [],
+                                             time() + config.PING_TIMEOUT)
+        if not running:
+            continue
+        timeout = max(0, min(item[3] for item in running.values()) - time())
+        readable, _, _ = select.select(running.keys(), [], [], timeout)
+        for fd in readable:
+            data = os.read(fd, 4096)
+            if data:
+                running[fd][2].append(data)
+                continue
+            host, proc, chunks, deadline = running.pop(fd)
+            proc.stdout.close()
+            proc.wait()
+            finish(host, ''.join(chunks))
+        now = time()
+        for fd in [fd for fd in running if running[fd][3] <= now]:
+            host, proc, chunks, deadline = running.pop(fd)
+            log.warning("Ping for %s timed out, killing it", host)
+            try:
+                proc.kill()
+            except OSError:
+                pass
+            proc.stdout.close()
+            proc.wait()
+            finish(host, '')
+    return results
 
 
 def find_public_ips(ips):
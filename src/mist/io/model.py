@@ -158,22 +158,32 @@ class Keypair(OODict):
         self.public = key.exportKey('OpenSSH')
 
     def isvalid(self):
-        """Checks if self is a valid RSA keypair."""
+        """Checks if self is a valid keypair."""
         from Crypto import Random
         Random.atfork()
         message = 'Message 1234567890'
-        if 'ssh-rsa' in self.public:
+        if 'ssh-rsa' in self.public and 'RSA' in self.private:
             public_key_container = RSA.importKey(self.public)
             private_key_container = RSA.importKey(self.private)
             encr_message = public_key_container.encrypt(message, 0)
             decr_message = private_key_container.decrypt(encr_message)
             if message == decr_message:
                 return True
+        elif self.public and self.private:
+            # other key types and formats, check that the public key
+            # matches the private one
+            from mist.io.shell import private_key_cache
+            try:
+                pkey = private_key_cache.get(self.private)
+            except Exception:
+                return False
+            return self.public.split()[:2] == [pkey.get_name(),
+                                               pkey.get_base64()]
         return False
 
     def construct_public_from_private(self):
         """Constructs pub key from self.private and assignes to self.public.
-        Only works for RSA.
+        Non RSA keys are parsed with paramiko.
 
         """
         from Crypto import Random
@@ -186,6 +196,14 @@ class Keypair(OODict):
                 return True
             except:
                 pass
+        else:
+            from mist.io.shell import private_key_cache
+            try:
+                pkey = private_key_cache.get(self.private)
+                self.public = '%s %s' % (pkey.get_name(), pkey.get_base64())
+                return True
+            except:
+                pass
         return False
 
     def __repr__(self):
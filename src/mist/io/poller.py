@@ -0,0 +1,264 @@
+"""mist.io.poller
+
+Centralised, adaptive poller of the clouds users are looking at.
+
+Polling tasks like ListMachines used to reschedule themselves for every
+user, cloud and machine, checking over AMQP on every run if the user was
+still listening. With POLLER_ENABLED, sockjs connections instead subscribe
+the clouds of their user to this service, renewing the subscription every
+POLLER_SUBSCRIPTION_TTL / 3 secs, and the poller dispatches each polling
+task of a subscribed cloud only when it's due.
+
+ListMachines is polled every Cloud.poll_interval. Every time the listing
+comes back unchanged the interval is multiplied by POLLER_BACKOFF, up to
+POLLER_MAX_INTERVAL, and it's reset as soon as something changes. After a
+machine action, the cloud is polled every POLLER_BOOST_INTERVAL secs for
+POLLER_BOOST_PERIOD secs, to pick up the new state of the machine quickly.
+
+Run it with:
+
+    ./bin/cloudpy src/mist/io/poller.py
+
+It exits right away if POLLER_ENABLED is False. buildout only adds it to
+supervisor when asked to, see README.rst.
+
+"""
+
+import json
+import time
+import socket
+import logging
+
+import amqp
+
+try:  # Multi-user environment
+    from mist.core import config
+except ImportError:  # Standalone mist.io
+    from mist.io import config
+
+from mist.io.helpers import amqp_publish
+
+
+EXCHANGE = 'mist-poller'
+
+
+log = logging.getLogger(__name__)
+
+
+def _publish(data):
+    if not config.POLLER_ENABLED:
+        return
+    try:
+        amqp_publish(EXCHANGE, '', data, ex_type='fanout', ex_declare=True)
+    except Exception as exc:
+        log.error("Error publishing %s to poller: %r", data['action'], exc)
+
+
+def subscribe(email, session_id, clouds):
+    """Subscribe a session to the given clouds of a user. clouds is a dict
+    mapping cloud ids to their poll intervals, in secs"""
+    _publish({'action': 'subscribe', 'email': email,
+              'session_id': session_id, 'clouds': clouds})
+
+
+def unsubscribe(email, session_id):
+    _publish({'action': 'unsubscribe', 'email': email,
+              'session_id': session_id})
+
+
+def boost(email, cloud_id):
+    """Poll a cloud more often for a while, eg after a machine action"""
+    _publish({'action': 'boost', 'email': email, 'cloud_id': cloud_id})
+
+
+def report(email, task_key, cloud_id, changed):
+    """Report that a polling task dispatched by the poller has finished and
+    whether its result has changed since its previous run"""
+    _publish({'action': 'report', 'email': email, 'task_key': task_key,
+              'cloud_id': cloud_id, 'changed': changed})
+
+
+class Schedule(object):
+    """When a polling task is next due for a cloud"""
+
+    def __init__(self, base_interval, adaptive=False):
+        self.base_interval = base_interval
+        self.interval = base_interval
+        self.adaptive = adaptive
+        self.boost_until = 0
+        self.next_run = time.time() + base_interval
+
+    def dispatched(self, now):
+        # in case the task never reports back, eg if it failed or was
+        # dropped because it was already running
+        self.next_run = now + max(self.interval, 60)
+
+    def finished(self, now, changed):
+        if now < self.boost_until:
+            self.interval = config.POLLER_BOOST_INTERVAL
+        elif changed or not self.adaptive:
+            self.interval = self.base_interval
+        else:
+            self.interval = min(self.interval * config.POLLER_BACKOFF,
+                                max(config.POLLER_MAX_INTERVAL,
+                                    self.base_interval))
+        self.next_run = now + self.interval
+
+    def boost(self, now):
+        self.boost_until = now + config.POLLER_BOOST_PERIOD
+        self.interval = config.POLLER_BOOST_INTERVAL
+        self.next_run = min(self.next_run, now + self.interval)
+
+
+class Poller(object):
+
+    def __init__(self):
+        from mist.io import tasks
+        # task key -> (task, adaptive)
+        self.tasks = {
+            'list_machines': (tasks.ListMachines(), True),
+            'probe_machines': (tasks.ProbeMachines(), False),
+            'ping_machines': (tasks.PingMachines(), False),
+        }
+        self.subscriptions = {}  # (email, cloud_id) -> {session_id: expires}
+        self.schedules = {}  # (email, cloud_id, task_key) -> Schedule
+        self.dispatched = 0
+        self.get_queue_depths = tasks.get_queue_depths
+        self.connection = None
+
+    def on_subscribe(self, msg):
+        now = time.time()
+        for cloud_id, poll_interval in msg['clouds'].items():
+            sub = (msg['email'], cloud_id)
+            sessions = self.subscriptions.setdefault(sub, {})
+            sessions[msg['session_id']] = now + config.POLLER_SUBSCRIPTION_TTL
+            for task_key, (task, adaptive) in self.tasks.items():
+                if adaptive:
+                    base_interval = max(poll_interval, task.result_fresh)
+                else:
+                    base_interval = task.result_fresh
+                schedule = self.schedules.get(sub + (task_key, ))
+                if schedule is None:
+                    self.schedules[sub + (task_key, )] = Schedule(
+                        base_interval, adaptive
+                    )
+                elif schedule.base_interval != base_interval:
+                    schedule.base_interval = base_interval
+                    schedule.interval = base_interval
+        # the session may have been subscribed to clouds since removed
+        for sub, sessions in self.subscriptions.items():
+            if sub[0] == msg['email'] and sub[1] not in msg['clouds']:
+                sessions.pop(msg['session_id'], None)
+        self.expire(now)
+
+    def on_unsubscribe(self, msg):
+        for sub, sessions in self.subscriptions.items():
+            if sub[0] == msg['email']:
+                sessions.pop(msg['session_id'], None)
+        self.expire(time.time())
+
+    def on_boost(self, msg):
+        schedule = self.schedules.get((msg['email'], msg['cloud_id'],
+                                       'list_machines'))
+        if schedule is not None:
+            schedule.boost(time.time())
+
+    def on_report(self, msg):
+        schedule = self.schedules.get((msg['email'], msg['cloud_id'],
+                                       msg['task_key']))
+        if schedule is not None:
+            schedule.finished(time.time(), msg['changed'])
+
+    def on_message(self, msg):
+        try:
+            data = json.loads(msg.body)
+            getattr(self, 'on_' + data['action'])(data)
+        except Exception as exc:
+            log.error("Error processing poller message %r: %r", msg.body, exc)
+
+    def expire(self, now):
+        """Drop expired sessions and subscriptions left without sessions"""
+        for sub, sessions in self.subscriptions.items():
+            for session_id, expires in sessions.items():
+                if expires < now:
+                    del sessions[session_id]
+            if not sessions:
+                del self.subscriptions[sub]
+                for task_key in self.tasks:
+                    self.schedules.pop(sub + (task_key, ), None)
+
+    def dispatch(self, now):
+        """Send the tasks that are due to celery"""
+        for (email, cloud_id, task_key), schedule in self.schedules.items():
+            if schedule.next_run > now:
+                continue
+            task = self.tasks[task_key][0]
+            try:
+                task.apply_async((email, cloud_id), {'scheduled': True},
+                                 priority=config.CELERY_PRIORITY_PERIODIC)
+            except Exception as exc:
+                log.error("Error dispatching %s for %s %s: %r",
+                          task_key, email, cloud_id, exc)
+            else:
+                self.dispatched += 1
+            schedule.dispatched(now)
+
+    def connect(self):
+        self.connection = amqp.Connection(config.AMQP_URI)
+        channel = self.connection.channel()
+        # declared with the same (default) arguments as in _publish, else
+        # whichever declares it second is refused by the broker
+        channel.exchange_declare(EXCHANGE, 'fanout')
+        queue = channel.queue_declare(exclusive=True).queue
+        channel.queue_bind(queue, EXCHANGE)
+        channel.basic_consume(queue, callback=self.on_message, no_ack=True)
+
+    def run(self):
+        last_stats = time.time()
+        while True:
+            try:
+                if self.connection is None:
+                    self.connect()
+                    log.info("Poller connected")
+                now = time.time()
+                next_run = min([schedule.next_run
+                                for schedule in self.schedules.values()] +
+                               [now + 1])
+                try:
+                    self.connection.drain_events(timeout=max(next_run - now,
+                                                             0.01))
+                except socket.timeout:
+                    pass
+            except Exception as exc:
+                log.error("Poller AMQP connection error: %r", exc)
+                self.connection = None
+                time.sleep(5)
+            now = time.time()
+            self.expire(now)
+            self.dispatch(now)
+            if now - last_stats > 60:
+                log.info("Polling %d clouds, dispatched %d tasks",
+                         len(self.subscriptions), self.dispatched)
+                try:
+                    log.info("Celery queue depths: %s", ', '.join(
+                        '%s %d (%d workers)' % (name, messages, consumers)
+                        for name, (messages, consumers)
+                        in sorted(self.get_queue_depths().items())
+                    ))
+                except Exception as exc:
+                    log.error("Error getting celery queue depths: %r", exc)
+                last_stats = now
+
+
+def main():
+    logging.basicConfig(level=config.PY_LOG_LEVEL,
+                        format=config.PY_LOG_FORMAT,
+                        datefmt=config.PY_LOG_FORMAT_DATE)
+    if not config.POLLER_ENABLED:
+        log.warning("POLLER_ENABLED is False, the poller isn't needed")
+        return
+    Poller().run()
+
+
+if __name__ == '__main__':
+    main()
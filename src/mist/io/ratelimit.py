@@ -0,0 +1,224 @@
+"""mist.io.ratelimit
+
+Provider aware concurrency control for bulk operations against clouds.
+
+Bulk operations (creating many machines, running an action on many machines)
+issue lots of API calls towards the same cloud. Each cloud gets a
+ConcurrencyController that limits both the request rate (token bucket) and the
+number of calls in flight. The concurrency limit adapts AIMD style: it grows by
+one every time a full window of calls succeeds and is halved whenever the
+provider throttles us. Throttled calls are retried after a backoff.
+
+Limits are configured per provider in config.BULK_CONCURRENCY. Controllers are
+kept per process, so every celery worker process throttles independently.
+
+"""
+
+import random
+import threading
+from time import time, sleep
+from collections import deque
+
+try:
+    from mist.core import config
+except ImportError:
+    from mist.io import config
+
+import logging
+logging.basicConfig(level=config.PY_LOG_LEVEL,
+                    format=config.PY_LOG_FORMAT,
+                    datefmt=config.PY_LOG_FORMAT_DATE)
+log = logging.getLogger(__name__)
+
+
+# substrings of provider errors that mean we are being throttled, HTTP 429
+# responses are recognized by their status instead, see is_throttle_error
+THROTTLE_ERRORS = (
+    'RequestLimitExceeded',  # EC2
+    'Throttling',
+    'rate limit',
+    'ratelimit',
+    'Rate exceeded',
+    '429 Too Many Requests',
+    'OverLimit',  # OpenStack, Rackspace
+    'overLimit',
+    'too_many_requests',  # DigitalOcean
+)
+
+
+def is_throttle_error(exc):
+    """Check if an exception, or the exception it wraps, means the provider
+    throttled the request"""
+    while exc is not None:
+        for attr in ('http_code', 'status', 'code'):
+            if getattr(exc, attr, None) in (429, '429'):
+                return True
+        msg = ('%s %r' % (exc, exc)).lower()
+        for pattern in THROTTLE_ERRORS:
+            if pattern.lower() in msg:
+                return True
+        exc = getattr(exc, 'orig_exc', None)
+    return False
+
+
+class TokenBucket(object):
+    """Thread safe token bucket allowing `rate` calls per sec on average
+    with bursts of up to `burst` calls."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.timestamp = time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def acquire(self):
+        """Block until a token is available and consume it"""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def drain(self):
+        """Drop all available tokens, eg after being throttled"""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0)
+
+
+class ConcurrencyController(object):
+    """Runs calls towards a single cloud with adaptive concurrency
+
+    Use it like:
+    controller = get_controller(cloud_id, cloud.provider)
+    node = controller.run(create_machine, user, cloud_id, ...)
+
+    """
+
+    def __init__(self, name, rate, burst, concurrency, max_concurrency,
+                 min_concurrency=1, retries=3, backoff=2):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.limit = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        # counters
+        self.succeeded = 0
+        self.failed = 0
+        self.throttled = 0
+        self._completed = deque()
+
+    def _acquire_slot(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def _release_slot(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def _on_success(self):
+        with self.cond:
+            self.succeeded += 1
+            now = time()
+            self._completed.append(now)
+            while self._completed and self._completed[0] < now - 60:
+                self._completed.popleft()
+            # additive increase: +1 per window of successful calls
+            self.limit = min(self.max_concurrency,
+                             self.limit + 1.0 / int(self.limit))
+            self.cond.notify_all()
+
+    def _on_throttle(self):
+        with self.cond:
+            self.throttled += 1
+            # multiplicative decrease
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            log.warning("%s: throttled by provider, concurrency limit "
+                        "lowered to %d", self.name, int(self.limit))
+        self.bucket.drain()
+
+    def run(self, func, *args, **kwargs):
+        """Call func respecting the rate and concurrency limits.
+
+        Calls that fail because of throttling are retried with exponential
+        backoff, any other exception is raised immediately.
+
+        """
+        attempt = 0
+        while True:
+            self._acquire_slot()
+            try:
+                self.bucket.acquire()
+                result = func(*args, **kwargs)
+            except Exception as exc:
+                if not is_throttle_error(exc):
+                    with self.cond:
+                        self.failed += 1
+                    raise
+                self._on_throttle()
+                if attempt >= self.retries:
+                    with self.cond:
+                        self.failed += 1
+                    raise
+            else:
+                self._on_success()
+                return result
+            finally:
+                self._release_slot()
+            attempt += 1
+            sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def get_stats(self):
+        with self.cond:
+            now = time()
+            return {
+                'concurrency_limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'succeeded': self.succeeded,
+                'failed': self.failed,
+                'throttled': self.throttled,
+                'per_minute': len([t for t in self._completed
+                                   if t >= now - 60]),
+            }
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_provider_limits(provider):
+    """Return the BULK_CONCURRENCY settings that apply to provider"""
+    limits = dict(config.BULK_CONCURRENCY['default'])
+    if provider in config.EC2_PROVIDERS:
+        provider = 'ec2'
+    elif provider and provider.startswith('rackspace'):
+        provider = 'rackspace'
+    limits.update(config.BULK_CONCURRENCY.get(provider, {}))
+    return limits
+
+
+def get_controller(cloud_id, provider):
+    """Return the process wide ConcurrencyController of a cloud"""
+    with _controllers_lock:
+        if cloud_id not in _controllers:
+            _controllers[cloud_id] = ConcurrencyController(
+                cloud_id, **get_provider_limits(provider)
+            )
+        return _controllers[cloud_id]
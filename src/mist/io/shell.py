@@ -7,12 +7,17 @@ SSH.
 
 from time import time, sleep
 from StringIO import StringIO
+from collections import OrderedDict
 
 import paramiko
+import requests
 import websocket
 import socket
+import struct
 import uuid
-import thread
+import threading
+import hashlib
+import os
 import ssl
 import tempfile
 
@@ -35,6 +40,282 @@ logging.basicConfig(level=config.PY_LOG_LEVEL,
 log = logging.getLogger(__name__)
 
 
+def _last_good_login_key(user, cloud_id, machine_id):
+    return 'ssh-last-good-%s' % _secret_fingerprint(
+        '%s:%s:%s' % (user.email, cloud_id, machine_id)
+    )
+
+
+def _get_last_good_login(user, cloud_id, machine_id):
+    """Return the (key_id, ssh_user, port) last used to connect to a
+    machine, as cached in memcache, or None"""
+    try:
+        cached = _get_memcache().get(_last_good_login_key(user, cloud_id,
+                                                          machine_id))
+    except Exception as exc:
+        log.warning("Error getting last good ssh login: %r", exc)
+        return None
+    if cached:
+        return tuple(cached)
+
+
+def _set_last_good_login(user, cloud_id, machine_id, key_id, ssh_user, port):
+    try:
+        _get_memcache().set(_last_good_login_key(user, cloud_id, machine_id),
+                            [key_id, ssh_user, port],
+                            time=config.SSH_LAST_GOOD_LOGIN_TTL)
+    except Exception as exc:
+        log.warning("Error caching last good ssh login: %r", exc)
+
+
+_memcache = None
+
+
+def _get_memcache():
+    global _memcache
+    if _memcache is None:
+        from memcache import Client as MemcacheClient
+        _memcache = MemcacheClient(config.MEMCACHED_HOST)
+    return _memcache
+
+
+def _secret_fingerprint(secret):
+    """Hash a private key or password, to use it as part of a cache key"""
+    if secret is None:
+        return None
+    if isinstance(secret, unicode):
+        secret = secret.encode('utf-8')
+    return hashlib.sha256(secret).hexdigest()
+
+
+# docker exec output stream types
+DOCKER_STREAMS = {1: 'stdout', 2: 'stderr'}
+DOCKER_API_TIMEOUT = 30
+DOCKER_EXEC_INSPECT_RETRIES = 8
+
+# max bytes read from an ssh channel at once
+COMMAND_CHUNK_SIZE = 32768
+
+# paramiko key classes tried, in order, when parsing a private key
+PKEY_CLASSES = [getattr(paramiko, name)
+                for name in ('RSAKey', 'ECDSAKey', 'Ed25519Key', 'DSSKey')
+                if hasattr(paramiko, name)]
+
+
+def parse_private_key(private, password=None):
+    """Parse an OpenSSH private key of any type paramiko supports.
+
+    password is only used to decrypt the key if it has a passphrase.
+
+    Raises paramiko.SSHException if the key can't be parsed.
+
+    """
+    for pkey_class in PKEY_CLASSES:
+        try:
+            return pkey_class.from_private_key(StringIO(private))
+        except paramiko.PasswordRequiredException:
+            if not password:
+                raise
+            return pkey_class.from_private_key(StringIO(private), password)
+        except (paramiko.SSHException, ValueError, TypeError, IndexError):
+            continue
+    raise paramiko.SSHException("Unsupported or invalid private key")
+
+
+class PrivateKeyCache(object):
+    """Process wide LRU of parsed private keys
+
+    Parsing a private key is CPU intensive and it used to happen on every
+    connection attempt. Parsed keys are kept here, keyed by a hash of the
+    key text, so that they're parsed once per process.
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, private, password=None):
+        """Return the parsed private key, parsing it if needed"""
+        key = (_secret_fingerprint(private), _secret_fingerprint(password))
+        with self.lock:
+            pkey = self.keys.pop(key, None)
+            if pkey is not None:
+                self.keys[key] = pkey
+                self.hits += 1
+                return pkey
+            self.misses += 1
+        pkey = parse_private_key(private, password)
+        with self.lock:
+            self.keys[key] = pkey
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+        return pkey
+
+    def get_stats(self):
+        with self.lock:
+            return {'size': len(self.keys), 'hits': self.hits,
+                    'misses': self.misses}
+
+
+private_key_cache = PrivateKeyCache(config.SSH_KEY_CACHE_SIZE)
+
+
+class TransportPool(object):
+    """Process wide pool of authenticated paramiko transports
+
+    Transports are keyed by (host, port, username, key fingerprint, password
+    fingerprint). A ParamikoShell that connects with the same credentials
+    as a pooled transport reuses it, so that running a command only needs
+    to open a new channel instead of a full SSH handshake. Many shells can
+    use the same transport at once, since every command opens its own
+    channel.
+
+    Pooled transports send keepalives and are closed once they've been
+    unused for config.SSH_POOL_IDLE_TIMEOUT secs, by a reaper thread that is
+    started when the first transport is pooled. The pool is reset after a
+    fork, since transports can't be shared across processes.
+
+    """
+
+    def __init__(self, idle_timeout, keepalive, max_size):
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        # key -> dict(transport, users, last_used, discard)
+        self.entries = {}
+        self.reaper = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            self._reset()
+
+    def acquire(self, key):
+        """Return an active transport for key and mark it in use or None"""
+        with self.lock:
+            self._check_pid()
+            entry = self.entries.get(key)
+            if entry is not None and not entry['discard']:
+                transport = entry['transport']
+                if transport.is_active() and transport.is_authenticated():
+                    entry['users'] += 1
+                    entry['last_used'] = time()
+                    self.hits += 1
+                    return transport
+                self._evict(key)
+            self.misses += 1
+            return None
+
+    def add(self, key, transport):
+        """Pool a newly authenticated transport, marked in use.
+
+        Returns False if it was not pooled, because another transport with
+        the same key was pooled in the meantime, or was discarded but is still
+        in use, or the pool is full.
+
+        """
+        with self.lock:
+            self._check_pid()
+            if key in self.entries:
+                if self.entries[key]['transport'].is_active():
+                    return False
+                self._evict(key)
+            if len(self.entries) >= self.max_size:
+                idle = [(entry['last_used'], entry_key)
+                        for entry_key, entry in self.entries.items()
+                        if not entry['users']]
+                if not idle:
+                    return False
+                self._evict(min(idle)[1])
+            transport.set_keepalive(self.keepalive)
+            self.entries[key] = {'transport': transport, 'users': 1,
+                                 'last_used': time(), 'discard': False}
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self._reap,
+                                               name='ssh-pool-reaper')
+                self.reaper.daemon = True
+                self.reaper.start()
+            return True
+
+    def release(self, key, close=False):
+        """Mark a transport acquired with acquire or add as no longer used.
+
+        If close is True, the transport is no longer handed out and it is
+        closed and removed from the pool once its last user releases it, so
+        that the channels other shells opened on it aren't cut off.
+
+        """
+        with self.lock:
+            self._check_pid()
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry['users'] = max(0, entry['users'] - 1)
+            entry['last_used'] = time()
+            if close:
+                entry['discard'] = True
+            if entry['discard'] and not entry['users']:
+                self._evict(key)
+
+    def _evict(self, key):
+        entry = self.entries.pop(key)
+        self.evictions += 1
+        try:
+            entry['transport'].close()
+        except Exception as exc:
+            log.warning("Error closing pooled ssh transport: %r", exc)
+
+    def evict_idle(self):
+        """Close transports unused for more than idle_timeout secs"""
+        with self.lock:
+            self._check_pid()
+            now = time()
+            for key, entry in self.entries.items():
+                if not entry['transport'].is_active() or (
+                        not entry['users'] and
+                        now - entry['last_used'] > self.idle_timeout):
+                    log.info("Closing idle ssh connection to %s@%s:%s",
+                             key[2], key[0], key[1])
+                    self._evict(key)
+
+    def _reap(self):
+        pid = os.getpid()
+        while pid == self.pid:
+            sleep(min(self.idle_timeout, 60))
+            try:
+                self.evict_idle()
+            except Exception as exc:
+                log.error("Error evicting idle ssh connections: %r", exc)
+
+    def get_stats(self):
+        with self.lock:
+            self._check_pid()
+            return {
+                'size': len(self.entries),
+                'in_use': len([entry for entry in self.entries.values()
+                               if entry['users']]),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+transport_pool = TransportPool(config.SSH_POOL_IDLE_TIMEOUT,
+                               config.SSH_POOL_KEEPALIVE,
+                               config.SSH_POOL_MAX_SIZE)
+
+
 class ParamikoShell(object):
     """sHell
 
@@ -69,6 +350,8 @@ class ParamikoShell(object):
             raise RequiredParameterMissingError('host not given')
         self.host = host
         self.sudo = False
+        # key of the pooled transport in use, if any
+        self.pool_key = None
 
         self.ssh = paramiko.SSHClient()
         self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -82,7 +365,8 @@ class ParamikoShell(object):
 
         Tries to connect and configure self. If only password is provided, it
         will be used for authentication. If key is provided, it is treated as
-        and OpenSSH private RSA key and used for authentication. If both key
+        an OpenSSH private key (RSA, ECDSA, Ed25519 or DSA) and used for
+        authentication. If both key
         and password are provided, password is used as a passphrase to unlock
         the private key.
 
@@ -93,10 +377,23 @@ class ParamikoShell(object):
         if not key and not password:
             raise RequiredParameterMissingError("neither key nor password "
                                                 "provided.")
+        self.disconnect()
+        pool_key = (self.host, port, username,
+                    _secret_fingerprint(key), _secret_fingerprint(password))
+        if config.SSH_POOL_ENABLED:
+            transport = transport_pool.acquire(pool_key)
+            if transport is not None:
+                log.info("Reusing ssh connection to %s@%s:%s",
+                         username, self.host, port)
+                # SSHClient only needs the transport to open channels
+                self.ssh._transport = transport
+                self.pool_key = pool_key
+                return
+
         if key:
-            rsa_key = paramiko.RSAKey.from_private_key(StringIO(key))
+            pkey = private_key_cache.get(key, password)
         else:
-            rsa_key = None
+            pkey = None
 
         attempts = 3
         while attempts:
@@ -107,11 +404,14 @@ class ParamikoShell(object):
                     port=port,
                     username=username,
                     password=password,
-                    pkey=rsa_key,
+                    pkey=pkey,
                     allow_agent=False,
                     look_for_keys=False,
                     timeout=10
                 )
+                if config.SSH_POOL_ENABLED and transport_pool.add(
+                        pool_key, self.ssh.get_transport()):
+                    self.pool_key = pool_key
                 break
             except paramiko.AuthenticationException as exc:
                 log.error("ssh exception %r", exc)
@@ -129,8 +429,19 @@ class ParamikoShell(object):
                     raise ServiceUnavailableError(repr(exc))
 
 
-    def disconnect(self):
-        """Close the SSH connection."""
+    def disconnect(self, close=False):
+        """Close the SSH connection.
+
+        A pooled connection is given back to the pool instead, unless close
+        is True.
+
+        """
+        if self.pool_key is not None:
+            transport_pool.release(self.pool_key, close=close)
+            self.pool_key = None
+            # don't let SSHClient close the pooled transport
+            self.ssh._transport = None
+            return
         try:
             log.info("Closing ssh connection to %s", self.host)
             self.ssh.close()
@@ -150,21 +461,45 @@ class ParamikoShell(object):
             return True
 
     def _command(self, cmd, pty=True):
-        """Helper method used by command and stream_command."""
+        """Helper method used by command and the streaming methods."""
         channel = self.ssh.get_transport().open_session()
         channel.settimeout(10800)
-        stdout = channel.makefile()
-        stderr = channel.makefile_stderr()
         if pty:
             # this combines the stdout and stderr streams as if in a pty
-            # if enabled both streams are combined in stdout and stderr file
-            # descriptor isn't used
+            # if enabled both streams are combined in stdout and stderr
+            # isn't used
             channel.get_pty()
         # command starts being executed in the background
         channel.exec_command(cmd)
-        return stdout, stderr, channel
+        return channel
 
-    def command(self, cmd, pty=True):
+    @staticmethod
+    def _read_chunks(recv, chunk_size=COMMAND_CHUNK_SIZE):
+        """Yield chunks returned by recv until the stream is closed"""
+        chunk = recv(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = recv(chunk_size)
+
+    @staticmethod
+    def _read_stream(recv, max_output=None):
+        """Read a stream of the channel in chunks into a single buffer.
+
+        If more than max_output bytes are received, the rest of the stream
+        is read but discarded, so that the command can finish. Returns the
+        output and whether it was truncated.
+
+        """
+        buf = bytearray()
+        truncated = False
+        for chunk in ParamikoShell._read_chunks(recv):
+            if max_output and len(buf) + len(chunk) > max_output:
+                chunk = chunk[:max(0, max_output - len(buf))]
+                truncated = True
+            buf.extend(chunk)
+        return str(buf), truncated
+
+    def command(self, cmd, pty=True, max_output=None):
         """Run command and return output.
 
         If pty is True, then it returns a string object that contains the
@@ -173,28 +508,60 @@ class ParamikoShell(object):
         If pty is False, then it returns a two string tupple, consisting of
         stdout and stderr.
 
+        Each stream is truncated to max_output bytes, which defaults to
+        config.SSH_COMMAND_MAX_OUTPUT.
+
         """
         log.info("running command: '%s'", cmd)
-        stdout, stderr, channel = self._command(cmd, pty)
-        line = stdout.readline()
-        out = ''
-        while line:
-            out += line
-            line = stdout.readline()
+        if max_output is None:
+            max_output = config.SSH_COMMAND_MAX_OUTPUT
+        channel = self._command(cmd, pty)
+
+        if not pty:
+            # read stderr at the same time, otherwise the command may block
+            # once the channel's window is filled with unread stderr
+            stderr = {}
+
+            def read_stderr():
+                stderr['output'], stderr['truncated'] = self._read_stream(
+                    channel.recv_stderr, max_output
+                )
+            stderr_thread = threading.Thread(target=read_stderr)
+            stderr_thread.daemon = True
+            stderr_thread.start()
+
+        out, truncated = self._read_stream(channel.recv, max_output)
+        if truncated:
+            log.warning("Output of '%s' truncated to %d bytes",
+                        cmd, max_output)
 
         if pty:
             retval = channel.recv_exit_status()
             return retval, out
         else:
-            line = stderr.readline()
-            err = ''
-            while line:
-                err += line
-                line = stderr.readline()
+            stderr_thread.join()
+            err = stderr.get('output', '')
+            if stderr.get('truncated'):
+                log.warning("Stderr of '%s' truncated to %d bytes",
+                            cmd, max_output)
             retval = channel.recv_exit_status()
 
             return retval, out, err
 
+    def command_chunks(self, cmd, chunk_size=COMMAND_CHUNK_SIZE):
+        """Run command and stream output in raw chunks of bytes.
+
+        This function is a generator that returns the commands output, with
+        stdout and stderr combined, as soon as it's received, in chunks of up
+        to chunk_size bytes. Use like:
+        for chunk in command_chunks(cmd): sys.stdout.write(chunk)
+
+        """
+        log.info("running command: '%s'", cmd)
+        channel = self._command(cmd)
+        for chunk in self._read_chunks(channel.recv, chunk_size):
+            yield chunk
+
     def command_stream(self, cmd):
         """Run command and stream output line by line.
 
@@ -202,12 +569,14 @@ class ParamikoShell(object):
         by line. Use like: for line in command_stream(cmd): print line.
 
         """
-        log.info("running command: '%s'", cmd)
-        stdout, stderr, channel = self._command(cmd)
-        line = stdout.readline()
-        while line:
-            yield line
-            line = stdout.readline()
+        partial = ''
+        for chunk in self.command_chunks(cmd):
+            lines = (partial + chunk).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if partial:
+            yield partial
 
     def autoconfigure(self, user, cloud_id, machine_id,
                       key_id=None, username=None, password=None, port=22):
@@ -255,7 +624,8 @@ class ParamikoShell(object):
             if default_keys and default_keys[0] not in pref_keys:
                 pref_keys.append(default_keys[0])
 
-        # try to connect
+        # find candidate logins
+        candidates = []
         for key_id in pref_keys:
             keypair = user.keypairs[key_id]
 
@@ -286,85 +656,173 @@ class ParamikoShell(object):
                     if name not in users:
                         users.append(name)
             for ssh_user in users:
+                candidates.append((key_id, ssh_user, port))
+
+        # try the login that worked last time first, on its own
+        result = None
+        last_good = _get_last_good_login(user, cloud_id, machine_id)
+        if last_good and last_good[0] in pref_keys and \
+                (not username or last_good[1] == username):
+            if last_good in candidates:
+                candidates.remove(last_good)
+            result = self._try_logins(user, [last_good], password)
+        if result is None:
+            result = self._try_logins(user, candidates, password)
+        if result is None:
+            raise MachineUnauthorizedError("%s:%s" % (cloud_id, machine_id))
+        key_id, ssh_user, port = result
+
+        # we managed to connect succesfully, return
+        # but first update key and remember it for next time
+        _set_last_good_login(user, cloud_id, machine_id,
+                             key_id, ssh_user, port)
+        assoc = [cloud_id,
+                 machine_id,
+                 time(),
+                 ssh_user,
+                 self.check_sudo(),
+                 port]
+        trigger_session_update_flag = False
+        for i in range(3):
+            try:
+                with user.lock_n_load():
+                    updated = False
+                    for i in range(len(user.keypairs[key_id].machines)):
+                        machine = user.keypairs[key_id].machines[i]
+                        if [cloud_id, machine_id] == machine[:2]:
+                            old_assoc = user.keypairs[key_id].machines[i]
+                            user.keypairs[key_id].machines[i] = assoc
+                            updated = True
+                            old_ssh_user = None
+                            old_port = None
+                            if len(old_assoc) > 3:
+                                old_ssh_user = old_assoc[3]
+                            if len(old_assoc) > 5:
+                                old_port = old_assoc[5]
+                            if old_ssh_user != ssh_user or old_port != port:
+                                trigger_session_update_flag = True
+                    # if association didn't exist, create it!
+                    if not updated:
+                        user.keypairs[key_id].machines.append(assoc)
+                        trigger_session_update_flag = True
+                    user.save()
+            except:
+                if i == 2:
+                    log.error('RACE CONDITION: shell failed to recover from previous race conditions')
+                    raise
+                else:
+                    log.error('RACE CONDITION: shell trying to recover from race condition')
+            else:
+                break
+        if trigger_session_update_flag:
+            trigger_session_update(user.email, ['keys'])
+        return key_id, ssh_user
+
+    def _try_login(self, user, key_id, ssh_user, password, port):
+        """Connect a new ParamikoShell to self.host and check that it's
+        usable. Returns the shell and the username it's logged in as."""
+        keypair = user.keypairs[key_id]
+        shell = ParamikoShell(self.host)
+        log.info("ssh -i %s %s@%s:%s", key_id, ssh_user, self.host, port)
+        shell.connect(username=ssh_user, key=keypair.private,
+                      password=password, port=port)
+        try:
+            # this is a hack: if you try to login to ec2 with the wrong
+            # username, it won't fail the connection, so a
+            # MachineUnauthorizedException won't be raised. Instead, it
+            # will prompt you to login as some other user.
+            # This hack tries to identify when such a thing is happening
+            # and then tries to connect with the username suggested in
+            # the prompt.
+            retval, resp = shell.command('uptime')
+            new_ssh_user = None
+            if 'Please login as the user ' in resp:
+                new_ssh_user = resp.split()[5].strip('"')
+            elif 'Please login as the' in resp:
+                # for EC2 Amazon Linux machines, usually with ec2-user
+                new_ssh_user = resp.split()[4].strip('"')
+            if new_ssh_user:
+                log.info("retrying as %s", new_ssh_user)
+                # the connection is of no use, don't pool it
+                shell.disconnect(close=True)
+                shell.connect(username=new_ssh_user, key=keypair.private,
+                              password=password, port=port)
+                ssh_user = new_ssh_user
+        except:
+            # don't leak the connection of a login that turned out unusable
+            shell.disconnect(close=True)
+            raise
+        return shell, ssh_user
+
+    def _try_logins(self, user, candidates, password=None):
+        """Try candidate (key_id, ssh_user, port) logins, in order.
+
+        Up to config.SSH_AUTH_CONCURRENCY logins are attempted at the same
+        time. Once one succeeds, no more are started and self takes over its
+        connection. Returns the (key_id, ssh_user, port) that succeeded or
+        None if none did. If some logins failed for reasons other than
+        authentication and none succeeded, the first such error is raised.
+
+        """
+        lock = threading.Lock()
+        done = threading.Event()
+        pending = list(candidates)
+        winner = {}
+        errors = []
+
+        def worker():
+            while not done.is_set():
+                with lock:
+                    if not pending:
+                        return
+                    key_id, ssh_user, port = pending.pop(0)
                 try:
-                    log.info("ssh -i %s %s@%s:%s",
-                             key_id, ssh_user, self.host, port)
-                    self.connect(username=ssh_user,
-                                 key=keypair.private,
-                                 password=password,
-                                 port=port)
+                    shell, ssh_user = self._try_login(user, key_id, ssh_user,
+                                                      password, port)
                 except MachineUnauthorizedError:
                     continue
-                # this is a hack: if you try to login to ec2 with the wrong
-                # username, it won't fail the connection, so a
-                # MachineUnauthorizedException won't be raised. Instead, it
-                # will prompt you to login as some other user.
-                # This hack tries to identify when such a thing is happening
-                # and then tries to connect with the username suggested in
-                # the prompt.
-                retval, resp = self.command('uptime')
-                new_ssh_user = None
-                if 'Please login as the user ' in resp:
-                    new_ssh_user = resp.split()[5].strip('"')
-                elif 'Please login as the' in resp:
-                    # for EC2 Amazon Linux machines, usually with ec2-user
-                    new_ssh_user = resp.split()[4].strip('"')
-                if new_ssh_user:
-                    log.info("retrying as %s", new_ssh_user)
-                    try:
-                        self.disconnect()
-                        self.connect(username=new_ssh_user,
-                                     key=keypair.private,
-                                     password=password,
-                                     port=port)
-                        ssh_user = new_ssh_user
-                    except MachineUnauthorizedError:
-                        continue
-                # we managed to connect succesfully, return
-                # but first update key
-                assoc = [cloud_id,
-                         machine_id,
-                         time(),
-                         ssh_user,
-                         self.check_sudo(),
-                         port]
-                trigger_session_update_flag = False
-                for i in range(3):
-                    try:
-                        with user.lock_n_load():
-                            updated = False
-                            for i in range(len(user.keypairs[key_id].machines)):
-                                machine = user.keypairs[key_id].machines[i]
-                                if [cloud_id, machine_id] == machine[:2]:
-                                    old_assoc = user.keypairs[key_id].machines[i]
-                                    user.keypairs[key_id].machines[i] = assoc
-                                    updated = True
-                                    old_ssh_user = None
-                                    old_port = None
-                                    if len(old_assoc) > 3:
-                                        old_ssh_user = old_assoc[3]
-                                    if len(old_assoc) > 5:
-                                        old_port = old_assoc[5]
-                                    if old_ssh_user != ssh_user or old_port != port:
-                                        trigger_session_update_flag = True
-                            # if association didn't exist, create it!
-                            if not updated:
-                                user.keypairs[key_id].machines.append(assoc)
-                                trigger_session_update_flag = True
-                            user.save()
-                    except:
-                        if i == 2:
-                            log.error('RACE CONDITION: shell failed to recover from previous race conditions')
-                            raise
-                        else:
-                            log.error('RACE CONDITION: shell trying to recover from race condition')
-                    else:
-                        break
-                if trigger_session_update_flag:
-                    trigger_session_update(user.email, ['keys'])
-                return key_id, ssh_user
-
-        raise MachineUnauthorizedError("%s:%s" % (cloud_id, machine_id))
+                except Exception as exc:
+                    log.error("ssh %s@%s:%s failed: %r",
+                              ssh_user, self.host, port, exc)
+                    with lock:
+                        errors.append(exc)
+                    continue
+                with lock:
+                    if not winner:
+                        winner['login'] = key_id, ssh_user, port
+                        winner['shell'] = shell
+                        done.set()
+                        return
+                # another login succeeded in the meantime
+                shell.disconnect()
+                return
+
+        num_threads = max(1, min(len(candidates), config.SSH_AUTH_CONCURRENCY))
+        if num_threads == 1:
+            worker()
+        else:
+            threads = [threading.Thread(target=worker)
+                       for i in range(num_threads)]
+            for thread_ in threads:
+                thread_.daemon = True
+                thread_.start()
+            # return as soon as a login succeeds or all have failed
+            while not done.is_set() and any(thread_.is_alive()
+                                            for thread_ in threads):
+                done.wait(0.1)
+        if not winner:
+            if errors:
+                raise errors[0]
+            return None
+
+        # take over the connection of the winning shell
+        shell = winner['shell']
+        self.disconnect()
+        self.ssh._transport = shell.ssh._transport
+        self.pool_key = shell.pool_key
+        shell.ssh._transport = None
+        shell.pool_key = None
+        return winner['login']
 
     def __del__(self):
         self.disconnect()
@@ -372,7 +830,9 @@ class ParamikoShell(object):
 
 class DockerShell(object):
     """
-    Docker Shell achieved through the docker hosts API, by opening a websocket
+    Docker Shell achieved through the docker hosts API. Interactive shells
+    attach to the container over a websocket, while commands run through
+    the exec API.
     """
     def __init__(self, host):
         self.host = host
@@ -380,7 +840,13 @@ class DockerShell(object):
         self.protocol = "ws"
         self.uri = ""
         self.sslopt = {}
-        self.buffer = ""
+        # docker remote API settings, used to run commands
+        self.base_url = ""
+        self.container_id = None
+        self.auth = None
+        self.cert = None
+        # reuse http connections across API calls
+        self.session = requests.Session()
 
     def autoconfigure(self, user, cloud_id, machine_id, **kwargs):
         log.info("autoconfiguring DockerShell for machine %s:%s",
@@ -395,11 +861,14 @@ class DockerShell(object):
         if cloud.apikey and cloud.apisecret:
             self.uri = "://%s:%s@%s:%s/containers/%s/attach/ws?logs=0&stream=1&stdin=1&stdout=1&stderr=1" % \
                        (cloud.apikey, cloud.apisecret, self.host, docker_port, machine_id)
+            auth = (cloud.apikey, cloud.apisecret)
         else:
             self.uri = "://%s:%s/containers/%s/attach/ws?logs=0&stream=1&stdin=1&stdout=1&stderr=1" % \
                        (self.host, docker_port, machine_id)
+            auth = None
 
         # For tls
+        cert = None
         if cloud.key_file and cloud.cert_file:
             self.protocol = "wss"
             tempkey = tempfile.NamedTemporaryFile(delete=False)
@@ -415,8 +884,12 @@ class DockerShell(object):
                 'certfile': tempcert.name
             }
             self.ws = websocket.WebSocket(sslopt=self.sslopt)
+            cert = (tempcert.name, tempkey.name)
 
         self.uri = self.protocol + self.uri
+        self.configure_api("%s://%s:%s" % ('https' if cert else 'http',
+                                           self.host, docker_port),
+                           machine_id, auth=auth, cert=cert)
 
         log.info(self.uri)
 
@@ -425,6 +898,18 @@ class DockerShell(object):
         # This need in order to be consistent with the ParamikoShell
         return None, None
 
+    def configure_api(self, base_url, container_id, auth=None, cert=None):
+        """Set the docker remote API used to run commands in the container.
+
+        auth is an optional (username, password) tuple for basic auth and
+        cert an optional (cert file, key file) tuple for tls.
+
+        """
+        self.base_url = base_url.rstrip('/')
+        self.container_id = container_id
+        self.auth = auth
+        self.cert = cert
+
     def connect(self):
         try:
             self.ws.connect(self.uri)
@@ -438,49 +923,113 @@ class DockerShell(object):
         except:
             pass
 
-    def _wrap_command(self, cmd):
-        if cmd[-1] is not "\n":
-            cmd = cmd + "\n"
-        return cmd
-
-    def command(self, cmd):
-        self.cmd = self._wrap_command(cmd)
-        log.error(self.cmd)
+    def _api_request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', DOCKER_API_TIMEOUT)
+        try:
+            resp = self.session.request(method, self.base_url + path,
+                                        auth=self.auth, cert=self.cert,
+                                        verify=False, **kwargs)
+        except requests.exceptions.RequestException as exc:
+            raise ServiceUnavailableError("Docker API error: %r" % exc)
+        if resp.status_code == 401:
+            raise MachineUnauthorizedError()
+        if not resp.ok:
+            raise ServiceUnavailableError("Docker API error %s: %s"
+                                          % (resp.status_code, resp.text))
+        return resp
 
-        self.ws = websocket.WebSocketApp(self.uri,
-                                         on_message=self._on_message,
-                                         on_error=self._on_error,
-                                         on_close=self._on_close)
+    def exec_stream(self, cmd):
+        """Run command in the container and stream its output.
 
-        log.error(self.ws)
-        self.ws.on_open = self._on_open
-        self.ws.run_forever(ping_interval=3, ping_timeout=10)
-        self.ws.close()
-        retval = 0
-        output = self.buffer.split("\n")[1:-1]
-        return retval, "\n".join(output)
+        This function is a generator that yields (stream, data) tuples, with
+        stream being 'stdout' or 'stderr', as output is received. The exec
+        id is available in self.exec_id, to get the exit code afterwards
+        with exec_exit_code.
 
-    def _on_message(self, ws, message):
-        self.buffer = self.buffer + message
+        """
+        log.info("running command in container %s: '%s'",
+                 self.container_id, cmd)
+        resp = self._api_request(
+            'POST', '/containers/%s/exec' % self.container_id,
+            json={'AttachStdin': False, 'AttachStdout': True,
+                  'AttachStderr': True, 'Tty': False,
+                  'Cmd': ['/bin/sh', '-c', cmd]}
+        )
+        self.exec_id = resp.json()['Id']
+        resp = self._api_request('POST', '/exec/%s/start' % self.exec_id,
+                                 json={'Detach': False, 'Tty': False},
+                                 stream=True, timeout=None)
+        try:
+            for stream, data in _docker_demux(resp.raw):
+                yield stream, data
+        finally:
+            resp.close()
+
+    def exec_exit_code(self, exec_id):
+        """Return the exit code of a finished exec"""
+        for i in range(DOCKER_EXEC_INSPECT_RETRIES):
+            info = self._api_request('GET', '/exec/%s/json' % exec_id).json()
+            if not info.get('Running'):
+                return info.get('ExitCode')
+            # the output stream may close slightly before the exec finishes
+            sleep(0.01 * 2 ** i)
+        return info.get('ExitCode')
 
-    def _on_close(self, ws):
-        ws.close()
-        self.ws.close()
+    def command(self, cmd, pty=True):
+        """Run command and return output.
 
-    def _on_error(self, ws, error):
-        log.error("Got Websocker error: %s" % error)
+        If pty is True, then it returns the exit code and a string with the
+        combined output of stdout and stderr, in the order it was received.
 
-    def _on_open(self, ws):
-        def run(*args):
-            ws.send(self.cmd)
-            sleep(1)
-        thread.start_new_thread(run, ())
+        If pty is False, it returns the exit code, stdout and stderr.
 
+        """
+        out = []
+        err = []
+        for stream, data in self.exec_stream(cmd):
+            if pty or stream == 'stdout':
+                out.append(data)
+            else:
+                err.append(data)
+        retval = self.exec_exit_code(self.exec_id)
+        if pty:
+            return retval, ''.join(out)
+        return retval, ''.join(out), ''.join(err)
 
     def __del__(self):
         self.disconnect()
 
 
+def _docker_demux(raw):
+    """Split a multiplexed docker attach/exec stream into (stream, data).
+
+    Every frame starts with an 8 byte header, the first byte of which is
+    the stream (1 for stdout, 2 for stderr) and the last 4 the size of the
+    payload as a big endian unsigned int.
+
+    """
+    while True:
+        header = _read_exactly(raw, 8)
+        if len(header) < 8:
+            return
+        stream_type, size = struct.unpack('>BxxxL', header)
+        data = _read_exactly(raw, size)
+        yield DOCKER_STREAMS.get(stream_type, 'stdout'), data
+        if len(data) < size:
+            return
+
+
+def _read_exactly(raw, size):
+    chunks = []
+    while size:
+        chunk = raw.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
 class Shell(object):
     """
     Proxy Shell Class to distinguish weather we are talking about Docker or Paramiko Shell
@@ -544,8 +1093,14 @@ class Shell(object):
         if isinstance(self._shell, ParamikoShell):
             return self._shell.command(cmd, pty=pty)
         elif isinstance(self._shell, DockerShell):
-            return self._shell.command(cmd)
+            return self._shell.command(cmd, pty=pty)
 
     def command_stream(self, cmd):
         if isinstance(self._shell, ParamikoShell):
-            yield self._shell.command_stream(cmd)
+            for line in self._shell.command_stream(cmd):
+                yield line
+
+    def command_chunks(self, cmd):
+        if isinstance(self._shell, ParamikoShell):
+            for chunk in self._shell.command_chunks(cmd):
+                yield chunk
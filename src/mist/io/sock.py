@@ -18,6 +18,7 @@ from time import time
 
 from sockjs.tornado import SockJSConnection, SockJSRouter
 from mist.io.sockjs_mux import MultiplexConnection
+import tornado.ioloop
 import tornado.iostream
 
 import requests
@@ -41,6 +42,7 @@ from mist.io.amqp_tornado import Consumer
 
 from mist.io import methods
 from mist.io import tasks
+from mist.io import poller
 from mist.io.shell import Shell
 from mist.io.hub.tornado_shell_client import ShellHubClient
 
@@ -194,6 +196,7 @@ class MainConnection(MistConnection):
         super(MainConnection, self).on_open(conn_info)
         self.running_machines = set()
         self.consumer = None
+        self.poller_pc = None
 
     def on_ready(self):
         log.info("Ready to go!")
@@ -207,6 +210,20 @@ class MainConnection(MistConnection):
         self.list_keys()
         self.list_clouds()
         self.check_monitoring()
+        if config.POLLER_ENABLED:
+            # keep the poller subscription alive
+            self.poller_pc = tornado.ioloop.PeriodicCallback(
+                self.subscribe_poller,
+                config.POLLER_SUBSCRIPTION_TTL * 1000 / 3
+            )
+            self.poller_pc.start()
+
+    def subscribe_poller(self):
+        if config.POLLER_ENABLED:
+            clouds = dict((cloud_id, cloud.poll_interval / 1000.0)
+                          for cloud_id, cloud in self.user.clouds.items()
+                          if cloud.enabled)
+            poller.subscribe(self.user.email, self.session_id, clouds)
 
     def list_keys(self):
         self.send('list_keys', methods.list_keys(self.user))
@@ -214,6 +231,8 @@ class MainConnection(MistConnection):
     def list_clouds(self):
         clouds = methods.list_clouds(self.user)
         self.send('list_clouds', clouds)
+        keys = []
+        calls = []
         for key, task in (('list_machines', tasks.ListMachines()),
                           ('list_images', tasks.ListImages()),
                           ('list_sizes', tasks.ListSizes()),
@@ -221,10 +240,14 @@ class MainConnection(MistConnection):
                           ('list_locations', tasks.ListLocations()), ('list_projects', tasks.ListProjects()),):
             for cloud_id in self.user.clouds:
                 if self.user.clouds[cloud_id].enabled:
-                    cached = task.smart_delay(self.user.email, cloud_id)
-                    if cached is not None:
-                        log.info("Emitting %s from cache", key)
-                        self.send(key, cached)
+                    keys.append(key)
+                    calls.append((task, (self.user.email, cloud_id)))
+        # fetch all cached results in a single memcache round trip
+        for key, cached in zip(keys, tasks.smart_delay_many(calls)):
+            if cached is not None:
+                log.info("Emitting %s from cache", key)
+                self.send(key, cached)
+        self.subscribe_poller()
 
     def check_monitoring(self):
         try:
@@ -271,7 +294,15 @@ class MainConnection(MistConnection):
         log.info("Got %s", routing_key)
         if routing_key in set(['notify', 'probe', 'list_sizes', 'list_images',
                                'list_networks', 'list_machines',
-                               'list_locations', 'list_projects', 'ping']):
+                               'list_locations', 'list_projects', 'ping',
+                               'command', 'command_finished']):
+            # a fresher result is on its way to memcache, drop the one in
+            # this process' local cache
+            try:
+                tasks.invalidate_local_cache(routing_key, self.user.email,
+                                             result)
+            except Exception as exc:
+                log.error("Error invalidating local cache: %r", exc)
             self.send(routing_key, result)
             if routing_key == 'probe':
                 log.warn('send probe')
@@ -294,6 +325,7 @@ class MainConnection(MistConnection):
                 except Exception as exc:
                     log.warning("Error while update_machine_count.delay: %r",
                                 exc)
+                ping_targets = []
                 for machine in machines:
                     bmid = (cloud_id, machine['id'])
                     if bmid in self.running_machines:
@@ -328,11 +360,23 @@ class MainConnection(MistConnection):
                         if cached is not None:
                             self.send('probe', cached)
 
-                    cached = tasks.Ping().smart_delay(
+                    cached = tasks.Ping().get_cached(
                         self.user.email, cloud_id, machine['id'], ips[0]
                     )
-                    if cached is not None:
-                        self.send('ping', cached)
+                    if cached is None or \
+                            time() - cached['timestamp'] > \
+                            tasks.Ping.result_fresh:
+                        ping_targets.append((cloud_id, machine['id'], ips[0]))
+                    if cached is not None and \
+                            time() - cached['timestamp'] < \
+                            tasks.Ping.result_expires:
+                        self.send('ping', cached['payload'])
+
+                # ping the machines that just started running all at once,
+                # the rest are pinged periodically by PingMachines
+                if ping_targets:
+                    tasks.ping_many.delay(self.user.email, ping_targets)
+                tasks.PingMachines().smart_delay(self.user.email, cloud_id)
 
         elif routing_key == 'update':
             self.user.refresh()
@@ -350,6 +394,9 @@ class MainConnection(MistConnection):
                 self.consumer.stop()
             except Exception as exc:
                 log.error("Error closing pika consumer: %r", exc)
+        if self.poller_pc is not None:
+            self.poller_pc.stop()
+            poller.unsubscribe(self.user.email, self.session_id)
         super(MainConnection, self).on_close(stale=stale)
 
 
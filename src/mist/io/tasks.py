@@ -1,7 +1,9 @@
 import paramiko
 import json
 import uuid
+import zlib
 import tempfile
+import threading
 import functools
 
 import libcloud.security
@@ -10,7 +12,8 @@ from libcloud.compute.types import NodeState
 from time import time, sleep
 from uuid import uuid4
 
-from base64 import b64encode
+from hashlib import sha1
+from collections import Counter, OrderedDict
 
 from memcache import Client as MemcacheClient
 
@@ -49,6 +52,7 @@ except ImportError:  # Standalone mist.io
 from mist.io.helpers import amqp_publish_user
 from mist.io.helpers import amqp_user_listening
 from mist.io.helpers import amqp_log
+from mist.io import poller
 
 
 # libcloud certificate fix for OS X
@@ -65,6 +69,27 @@ app = Celery('tasks')
 app.conf.update(**config.CELERY_SETTINGS)
 
 
+def get_queue_depths():
+    """Return the number of messages waiting in each celery queue and the
+    number of workers consuming from it, as {queue: (messages, consumers)}"""
+    depths = {}
+    with app.connection() as connection:
+        for queue in app.amqp.queues.values():
+            # the broker closes the channel if the queue doesn't exist
+            channel = connection.channel()
+            try:
+                name, messages, consumers = queue(channel).queue_declare(
+                    passive=True
+                )
+            except connection.channel_errors:
+                # not declared yet, no worker has consumed from it
+                messages, consumers = 0, 0
+            finally:
+                channel.close()
+            depths[queue.name] = (messages, consumers)
+    return depths
+
+
 @app.task
 def update_machine_count(email, cloud_id, machine_count):
     if not multi_user:
@@ -94,6 +119,73 @@ def ssh_command(email, cloud_id, machine_id, host, command,
                     (machine_id, host), output)
 
 
+@app.task
+def ssh_command_many(email, job_id, targets, command):
+    """Run command on many machines, publishing each machine's result to
+    the user's sockjs connections as soon as it's available.
+
+    Long output is split in 'command' messages of up to
+    config.SSH_COMMAND_PUBLISH_CHUNK bytes, each with the rest of the
+    result and its 'chunk' index out of 'chunks'.
+
+    """
+    from mist.io.methods import ssh_command_many as _ssh_command_many
+    user = user_from_email(email)
+
+    def publish(result):
+        result['job_id'] = job_id
+        output = result['output']
+        size = config.SSH_COMMAND_PUBLISH_CHUNK
+        chunks = max(1, (len(output) + size - 1) // size)
+        for i in range(chunks):
+            data = dict(result, output=output[i * size:(i + 1) * size],
+                        chunk=i, chunks=chunks)
+            if not amqp_publish_user(user, routing_key='command', data=data):
+                # no one is listening
+                break
+
+    results, stats = _ssh_command_many(user, targets, command, publish)
+    stats['job_id'] = job_id
+    log.info("Command ran on %d machines in %.2fs, %d failed",
+             stats['total'], stats['duration'], stats['failed'])
+    amqp_publish_user(user, routing_key='command_finished', data=stats)
+
+
+def _probe_targets(email, targets):
+    """Probe many machines at once with methods.probe_many, publishing each
+    machine's result to the user's sockjs connections and caching it like
+    ProbeSSH does. Returns the aggregate timing."""
+    from mist.io.methods import probe_many as _probe_many
+    user = user_from_email(email)
+    task = ProbeSSH()
+
+    def publish(probe):
+        if 'error' in probe:
+            log.warning("Probing %s %s failed: %s", probe['cloud_id'],
+                        probe['machine_id'], probe['error'])
+            return
+        amqp_publish_user(user, routing_key='probe', data=probe)
+        args = (email, probe['cloud_id'], probe['machine_id'], probe['host'])
+        cached = task.get_cached(*args)
+        # keep the seq_id of the periodic ProbeSSH tasks, if any, so that
+        # they carry on
+        task.set_cached({'timestamp': time(), 'payload': probe,
+                         'seq_id': cached['seq_id'] if cached else ''},
+                        *args)
+
+    probes, stats = _probe_many(user, targets, publish)
+    log.info("Probed %d machines in %.2fs, %d failed",
+             stats['total'], stats['duration'], stats['failed'])
+    return stats
+
+
+@app.task
+def probe_many(email, targets):
+    """Probe many machines at once, publishing each machine's result to the
+    user's sockjs connections and caching it like ProbeSSH does."""
+    _probe_targets(email, targets)
+
+
 @app.task(bind=True, default_retry_delay=3*60)
 def post_deploy_steps(self, email, cloud_id, machine_id, monitoring, command='',
                       key_id=None, username=None, password=None, port=22,
@@ -510,9 +602,251 @@ def rackspace_first_gen_post_create_steps(
             raise
 
 
+# Version of the memcache keys of all UserTasks, bump it to invalidate all
+# their cached results. To only invalidate the results of one task, eg
+# after changing the format of its payload, bump its cache_version instead.
+CACHE_KEY_VERSION = 1
+MEMCACHE_MAX_KEY_LENGTH = 250
+
+# counters of this process' UserTask cache, see get_cache_stats
+cache_stats = Counter()
+
+
+def get_cache_stats():
+    """Return the counters of this process' UserTask cache"""
+    stats = dict(cache_stats)
+    if stats.get('encoded_bytes'):
+        stats['compression_ratio'] = (float(stats['stored_bytes']) /
+                                      stats['encoded_bytes'])
+    for tier in ('l1', 'l2'):
+        lookups = stats.get(tier + '_hits', 0) + stats.get(tier + '_misses', 0)
+        if lookups:
+            stats[tier + '_hit_ratio'] = (float(stats[tier + '_hits']) /
+                                          lookups)
+    stats['l1_size'] = local_cache.size
+    stats['l1_items'] = len(local_cache.items)
+    return stats
+
+
+class LocalCache(object):
+    """In-process LRU cache, used in front of memcache.
+
+    It holds values as stored in memcache, so that every hit is decoded to
+    a new copy that the caller is free to modify. Entries expire after ttl
+    secs and the least recently used ones are evicted when the total size
+    of the values exceeds max_size bytes.
+
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = 0
+        self.items = OrderedDict()  # key -> (expiration timestamp, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return None
+            if item[0] < time():
+                self.size -= len(item[1])
+                return None
+            self.items[key] = item
+            return item[1]
+
+    def set(self, key, value):
+        if not self.ttl or len(value) > self.max_size / 4:
+            return self.delete(key)
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is not None:
+                self.size -= len(item[1])
+            self.items[key] = (time() + self.ttl, value)
+            self.size += len(value)
+            while self.size > self.max_size:
+                _, (_, evicted) = self.items.popitem(last=False)
+                self.size -= len(evicted)
+                cache_stats['l1_evictions'] += 1
+
+    def delete(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is not None:
+                self.size -= len(item[1])
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+local_cache = LocalCache(config.LOCAL_CACHE_TTL, config.LOCAL_CACHE_MAX_SIZE)
+
+
+# Cached values are stored as JSON, zlib compressed if they're larger than
+# config.MEMCACHED_COMPRESS_MIN_SIZE, and split in chunks stored under
+# separate keys if they're still larger than config.MEMCACHED_ITEM_SIZE.
+# Every stored string starts with a marker telling how to decode it. Values
+# that aren't strings with a marker, eg results cached before, are returned
+# as they are.
+CACHE_JSON = 'mist-json:'
+CACHE_ZLIB = 'mist-zlib:'
+CACHE_CHUNKS = 'mist-chunks:'
+
+
+def _cache_encode(value):
+    """Serialize value for memcache and return it, with the size of the
+    uncompressed encoding"""
+    try:
+        data = json.dumps(value, separators=(',', ':'))
+    except (TypeError, ValueError) as exc:
+        # not JSON serializable, let memcache pickle it
+        log.warning("Caching %s with pickle: %r", type(value), exc)
+        cache_stats['pickled'] += 1
+        return value, 0
+    if len(data) < config.MEMCACHED_COMPRESS_MIN_SIZE:
+        return CACHE_JSON + data, len(data)
+    cache_stats['compressed'] += 1
+    return CACHE_ZLIB + zlib.compress(data, 6), len(data)
+
+
+def _cache_decode(value):
+    if not isinstance(value, str):
+        return value
+    if value.startswith(CACHE_JSON):
+        return json.loads(value[len(CACHE_JSON):])
+    if value.startswith(CACHE_ZLIB):
+        return json.loads(zlib.decompress(value[len(CACHE_ZLIB):]))
+    return value
+
+
+def cache_get_multi(memcache, keys):
+    """Return a dict with the decoded values of the given keys that exist
+    in the local cache or in memcache. Keys missing from the local cache,
+    and all of their chunks, are fetched from memcache with at most two
+    round trips."""
+    keys = [key for key in set(keys) if key]
+    if not keys:
+        return {}
+    local_values = {}
+    for key in keys:
+        value = local_cache.get(key)
+        if value is not None:
+            local_values[key] = value
+    cache_stats['l1_hits'] += len(local_values)
+    cache_stats['l1_misses'] += len(keys) - len(local_values)
+    keys = [key for key in keys if key not in local_values]
+    values = memcache.get_multi(keys) if keys else {}
+    manifests = {}
+    for key, value in values.items():
+        if isinstance(value, str) and value.startswith(CACHE_CHUNKS):
+            manifests[key] = json.loads(value[len(CACHE_CHUNKS):])
+    if manifests:
+        chunks = memcache.get_multi([
+            '%s:%s:%d' % (key, manifest['id'], i)
+            for key, manifest in manifests.items()
+            for i in range(manifest['chunks'])
+        ])
+        for key, manifest in manifests.items():
+            parts = [chunks.get('%s:%s:%d' % (key, manifest['id'], i))
+                     for i in range(manifest['chunks'])]
+            if None in parts:
+                # some chunk got evicted
+                cache_stats['missing_chunks'] += 1
+                values.pop(key)
+            else:
+                values[key] = ''.join(parts)
+    cache_stats['l2_hits'] += len(values)
+    cache_stats['l2_misses'] += len(keys) - len(values)
+    for key, value in values.items():
+        if isinstance(value, str):
+            local_cache.set(key, value)
+    values.update(local_values)
+    ret = {}
+    for key, value in values.items():
+        try:
+            ret[key] = _cache_decode(value)
+        except Exception as exc:
+            log.error("Error decoding cached value of '%s': %r", key, exc)
+            cache_stats['decode_errors'] += 1
+            local_cache.delete(key)
+    return ret
+
+
+def cache_get(memcache, key):
+    """Return the decoded value of key, or None if it's not in memcache"""
+    return cache_get_multi(memcache, [key]).get(key)
+
+
+def cache_set(memcache, key, value, time=0):
+    """Store value in memcache under key, compressing it and splitting it in
+    chunks if needed. Returns whether it was stored."""
+    data, size = _cache_encode(value)
+    cache_stats['sets'] += 1
+    local_cache.delete(key)
+    if not isinstance(data, str):
+        return memcache.set(key, data, time=time)
+    encoded = data
+    cache_stats['encoded_bytes'] += size
+    cache_stats['stored_bytes'] += len(data)
+    chunk_size = config.MEMCACHED_ITEM_SIZE - 1024  # room for item overhead
+    if len(data) > chunk_size:
+        if len(data) > config.MEMCACHED_MAX_CACHED_SIZE:
+            log.error("Not caching '%s', it's %d bytes", key, len(data))
+            cache_stats['too_large'] += 1
+            return False
+        # chunk keys contain a random id, so readers never mix the chunks
+        # of different versions of the value
+        chunks_id = uuid4().hex[:8]
+        chunks = {}
+        for i in range(0, len(data), chunk_size):
+            chunks['%s:%s:%d' % (key, chunks_id, i / chunk_size)] = \
+                data[i:i + chunk_size]
+        if memcache.set_multi(chunks, time=time):
+            cache_stats['set_failures'] += 1
+            return False
+        cache_stats['chunked'] += 1
+        data = CACHE_CHUNKS + json.dumps({'id': chunks_id,
+                                          'chunks': len(chunks)})
+    log.debug("Caching '%s', %d bytes, %d stored", key, size, len(data))
+    ok = memcache.set(key, data, time=time)
+    if ok:
+        local_cache.set(key, encoded)
+    else:
+        cache_stats['set_failures'] += 1
+    return ok
+
+
+def cache_delete(memcache, key):
+    """Delete key from the local cache and from memcache"""
+    local_cache.delete(key)
+    return memcache.delete(key)
+
+
+def invalidate_local_cache(task_key, email, payload):
+    """Drop the result of the task with the given task_key, that produced
+    payload, from this process' local cache. Called for every update of a
+    task's result that reaches the process over AMQP, since it's about to
+    be cached in memcache too, if it isn't already."""
+    for task_cls in UserTask.__subclasses__():
+        if task_cls.task_key == task_key:
+            task = task_cls()
+            try:
+                args = task.cache_args(email, payload)
+            except (KeyError, TypeError):
+                return
+            cache_key = task.cache_key(*args)[1]
+            if cache_key:
+                local_cache.delete(cache_key)
+            return
+
+
 class UserTask(Task):
     abstract = True
     task_key = ''
+    cache_version = 1
     result_expires = 0
     result_fresh = 0
     polling = False
@@ -524,18 +858,90 @@ class UserTask(Task):
             self._ut_cache = MemcacheClient(config.MEMCACHED_HOST)
         return self._ut_cache
 
+    def cache_key(self, *args, **kwargs):
+        """Return the id string of the task with the given arguments and the
+        memcache key its result is cached under.
+
+        Keys look like 'mist:1:list_machines:1:<sha1 of id string>', so
+        their length doesn't depend on the arguments. If the key is still
+        too long for memcache, or contains whitespace, it is None and the
+        result isn't cached.
+
+        """
+        id_str = json.dumps([self.task_key, args, kwargs])
+        cache_key = 'mist:%d:%s:%d:%s' % (CACHE_KEY_VERSION, self.task_key,
+                                          self.cache_version,
+                                          sha1(id_str).hexdigest())
+        # leave room for the ':error' and ':lease' suffixes
+        if len(cache_key) + 6 > MEMCACHE_MAX_KEY_LENGTH or \
+                len(cache_key.split()) != 1:
+            cache_stats['rejected_keys'] += 1
+            log.error("Invalid memcache key for '%s', not caching", id_str)
+            cache_key = None
+        return id_str, cache_key
+
+    def cache_args(self, email, payload):
+        """Return the arguments of the run of this task that returned
+        payload, used to find its cached result"""
+        return email, payload['cloud_id']
+
     def smart_delay(self, *args,  **kwargs):
         """Return cached result if it exists, send job to celery if needed"""
         # check cache
-        id_str = json.dumps([self.task_key, args, kwargs])
-        cache_key = b64encode(id_str)
-        cached = self.memcache.get(cache_key)
+        id_str, cache_key = self.cache_key(*args, **kwargs)
+        cached = cache_get(self.memcache, cache_key) if cache_key else None
+        return self._smart_delay_cached(cached, id_str, *args, **kwargs)
+
+    @property
+    def lease_time(self):
+        """Secs a worker holds the lease to run the task for, a bit longer
+        than the task is allowed to run"""
+        return (self.soft_time_limit or 60) + 10
+
+    def _acquire_lease(self, cache_key, seq_id=''):
+        """Try to become the only worker running the task whose result is
+        cached under cache_key, for the next lease_time secs"""
+        lease_key = cache_key + ':lease'
+        if self.memcache.add(lease_key, seq_id or '-', time=self.lease_time):
+            return True
+        # add also fails if memcache is unreachable, don't stop on that
+        return self.memcache.get(lease_key) is None
+
+    def _execute_single_flight(self, *args, **kwargs):
+        """Execute the task synchronously, unless some worker is already
+        running it with the same arguments, in which case wait for its
+        result instead"""
+        id_str, cache_key = self.cache_key(*args, **kwargs)
+        if cache_key is None:
+            return self.execute(*args, **kwargs)
+        if self._acquire_lease(cache_key):
+            try:
+                return self.execute(*args, **kwargs)
+            finally:
+                self.memcache.delete(cache_key + ':lease')
+        amqp_log("%s: already running, waiting for result" % id_str)
+        cache_stats['single_flight_waits'] += 1
+        started_at = time()
+        while time() < started_at + self.lease_time:
+            sleep(0.5)
+            local_cache.delete(cache_key)
+            cached = cache_get(self.memcache, cache_key)
+            if cached and cached['timestamp'] >= started_at:
+                return cached['payload']
+            if not self.memcache.get(cache_key + ':lease'):
+                # the other worker failed or dropped it
+                break
+        return self.execute(*args, **kwargs)
+
+    def _smart_delay_cached(self, cached, id_str, *args, **kwargs):
+        """Return the payload of the cached result dict, if it hasn't
+        expired, and send job to celery if it's missing or not fresh"""
         if cached:
             age = time() - cached['timestamp']
             if age > self.result_fresh:
                 amqp_log("%s: scheduling task" % id_str)
                 if kwargs.pop('blocking', None):
-                    return self.execute(*args, **kwargs)
+                    return self._execute_single_flight(*args, **kwargs)
                 else:
                     self.delay(*args, **kwargs)
             if age < self.result_expires:
@@ -543,15 +949,29 @@ class UserTask(Task):
                 return cached['payload']
         else:
             if kwargs.pop('blocking', None):
-                return self.execute(*args, **kwargs)
+                return self._execute_single_flight(*args, **kwargs)
             else:
                 self.delay(*args, **kwargs)
 
     def clear_cache(self, *args, **kwargs):
-        id_str = json.dumps([self.task_key, args, kwargs])
-        cache_key = b64encode(id_str)
+        id_str, cache_key = self.cache_key(*args, **kwargs)
         log.info("Clearing cache for '%s'", id_str)
-        return self.memcache.delete(cache_key)
+        if cache_key:
+            return cache_delete(self.memcache, cache_key)
+
+    def get_cached(self, *args, **kwargs):
+        """Return cached result dict if it exists, without scheduling"""
+        id_str, cache_key = self.cache_key(*args, **kwargs)
+        if cache_key:
+            return cache_get(self.memcache, cache_key)
+
+    def set_cached(self, cached, *args, **kwargs):
+        """Overwrite cached result dict, eg after updating its payload"""
+        id_str, cache_key = self.cache_key(*args, **kwargs)
+        if cache_key:
+            return cache_set(self.memcache, cache_key, cached,
+                             time=self.result_expires)
+        return False
 
     def run(self, *args, **kwargs):
         email = args[0]
@@ -559,9 +979,18 @@ class UserTask(Task):
         # running multiple concurrent sequences of the same task with the
         # same arguments. it is empty on first run, constant afterwards
         seq_id = kwargs.pop('seq_id', '')
-        id_str = json.dumps([self.task_key, args, kwargs])
-        cache_key = b64encode(id_str)
-        cached_err = self.memcache.get(cache_key + 'error')
+        # scheduled is set by the poller, which only dispatches tasks that
+        # are due, for clouds someone is looking at
+        scheduled = kwargs.pop('scheduled', False)
+        id_str, cache_key = self.cache_key(*args, **kwargs)
+        if cache_key is None:
+            # result can't be cached, so there's no way to tell sequences
+            # apart, run once without polling
+            if amqp_user_listening(email):
+                data = self.execute(*args, **kwargs)
+                amqp_publish_user(email, routing_key=self.task_key, data=data)
+            return
+        cached_err = self.memcache.get(cache_key + ':error')
         if cached_err:
             # task has been failing recently
             if seq_id != cached_err['seq_id']:
@@ -572,13 +1001,13 @@ class UserTask(Task):
                     # taking over from other sequence
                     cached_err = None
                     # cached err will be deleted or overwritten in a while
-                    #self.memcache.delete(cache_key + 'error')
-        if not amqp_user_listening(email):
+                    #self.memcache.delete(cache_key + ':error')
+        if not scheduled and not amqp_user_listening(email):
             # noone is waiting for result, stop trying, but flush cached erros
-            self.memcache.delete(cache_key + 'error')
+            self.memcache.delete(cache_key + ':error')
             return
         # check cache to stop iteration if other sequence has started
-        cached = self.memcache.get(cache_key)
+        cached = cache_get(self.memcache, cache_key)
         if cached:
             if seq_id and seq_id != cached['seq_id']:
                 amqp_log("%s: found new cached seq_id [%s], "
@@ -586,14 +1015,34 @@ class UserTask(Task):
                                                          cached['seq_id'],
                                                          seq_id))
                 return
-            elif not seq_id and time() - cached['timestamp'] < self.result_fresh:
+            elif not seq_id and not scheduled and \
+                    time() - cached['timestamp'] < self.result_fresh:
                 amqp_log("%s: fresh task submitted with fresh cached result "
                          ", dropping" % id_str)
                 return
+        rerun = bool(seq_id)
         if not seq_id:
             # this task is called externally, not a rerun, create a seq_id
             amqp_log("%s: fresh task submitted [%s]" % (id_str, seq_id))
             seq_id = uuid4().hex
+        # single flight: only one worker at a time runs the task with the
+        # same arguments, the others drop since the result is published to
+        # the user anyway
+        if not self._acquire_lease(cache_key, seq_id):
+            cache_stats['single_flight_dropped'] += 1
+            if rerun and not scheduled:
+                # the lease may be held by a blocking call, which neither
+                # caches nor reschedules, so keep this sequence going. if
+                # another sequence holds it, this one stops on its next run
+                amqp_log("%s: already running, will rerun in %d secs [%s]" %
+                         (id_str, self.result_fresh, seq_id))
+                kwargs['seq_id'] = seq_id
+                self.apply_async(args, kwargs, countdown=self.result_fresh,
+                                 priority=config.CELERY_PRIORITY_PERIODIC)
+            else:
+                amqp_log("%s: already running, dropping [%s]" % (id_str,
+                                                                  seq_id))
+            return
         # actually run the task
         try:
             data = self.execute(*args, **kwargs)
@@ -608,29 +1057,46 @@ class UserTask(Task):
             x0 = cached_err['timestamps'][0]
             rel_points = [x - x0 for x in cached_err['timestamps']]
             rerun = self.error_rerun_handler(exc, rel_points, *args, **kwargs)
+            if scheduled:
+                # the poller dispatches the task again once it's due, a
+                # rerun would poll the cloud alongside it
+                rerun = None
             if rerun is not None:
-                self.memcache.set(cache_key + 'error', cached_err)
+                self.memcache.set(cache_key + ':error', cached_err)
                 kwargs['seq_id'] = seq_id
-                self.apply_async(args, kwargs, countdown=rerun)
+                self.apply_async(args, kwargs, countdown=rerun,
+                                 priority=config.CELERY_PRIORITY_PERIODIC)
             else:
-                self.memcache.delete(cache_key + 'error')
+                self.memcache.delete(cache_key + ':error')
             amqp_log("%s: error %r, rerun %s" % (id_str, exc, rerun))
+            self.memcache.delete(cache_key + ':lease')
             return
         else:
-            self.memcache.delete(cache_key + 'error')
+            self.memcache.delete(cache_key + ':error')
+        previous = cached
         cached = {'timestamp': time(), 'payload': data, 'seq_id': seq_id}
         ok = amqp_publish_user(email, routing_key=self.task_key, data=data)
         if not ok:
             # echange closed, no one gives a shit, stop repeating, why try?
             amqp_log("%s: exchange closed" % id_str)
+            self.memcache.delete(cache_key + ':lease')
             return
         kwargs['seq_id'] = seq_id
-        self.memcache.set(cache_key, cached)
-        if self.polling:
+        cache_set(self.memcache, cache_key, cached, time=self.result_expires)
+        # release the lease once the result is cached, if the worker dies
+        # before that it expires after lease_time
+        self.memcache.delete(cache_key + ':lease')
+        if scheduled:
+            # let the poller adapt the polling interval
+            changed = previous is None or \
+                _payload_digest(previous['payload']) != _payload_digest(data)
+            poller.report(email, self.task_key, args[1], changed)
+        elif self.polling and not config.POLLER_ENABLED:
             amqp_log("%s: will rerun in %d secs [%s]" % (id_str,
                                                          self.result_fresh,
                                                          seq_id))
-            self.apply_async(args, kwargs, countdown=self.result_fresh)
+            self.apply_async(args, kwargs, countdown=self.result_fresh,
+                             priority=config.CELERY_PRIORITY_PERIODIC)
 
     def execute(self, *args, **kwargs):
         raise NotImplementedError()
@@ -646,6 +1112,35 @@ class UserTask(Task):
             return 60 * 10  # Retry in 10mins after the third error
 
 
+def _payload_digest(payload):
+    return sha1(json.dumps(payload, sort_keys=True, default=str)).hexdigest()
+
+
+def smart_delay_many(calls):
+    """Batch version of UserTask.smart_delay.
+
+    calls is a list of (task, args) tuples, where task is a UserTask
+    instance. The cached results of all of them are fetched with a single
+    memcache get_multi, and only the tasks whose results are missing or no
+    longer fresh are sent to celery.
+
+    Returns a list with the cached payload, or None, of each call, in the
+    same order.
+
+    """
+    if not calls:
+        return []
+    id_strs, cache_keys = zip(*[task.cache_key(*args) for task, args in calls])
+    try:
+        cached = cache_get_multi(calls[0][0].memcache, cache_keys)
+    except Exception as exc:
+        log.error("Error in memcache get_multi: %r", exc)
+        cached = {}
+    return [task._smart_delay_cached(cached.get(cache_key), id_str, *args)
+            for (task, args), id_str, cache_key
+            in zip(calls, id_strs, cache_keys)]
+
+
 class ListSizes(UserTask):
     abstract = False
     task_key = 'list_sizes'
@@ -746,23 +1241,64 @@ class ListMachines(UserTask):
         user = user_from_email(email)
         machines = methods.list_machines(user, cloud_id)
         if multi_user:
+            mist_tags = self.get_mist_tags(user, cloud_id,
+                                           [machine['id']
+                                            for machine in machines])
             for machine in machines:
-                kwargs = {}
-                kwargs['cloud_id'] = cloud_id
-                kwargs['machine_id'] = machine.get('id')
-                from mist.core.methods import list_tags
-                mistio_tags = list_tags(user, resource_type='machine', **kwargs)
                 # optimized for js
-                for tag in mistio_tags:
+                tags = set((tag.get('key'), tag.get('value'))
+                           for tag in machine['tags'])
+                for tag in mist_tags.get(machine['id'], []):
                     for key, value in tag.items():
-                        tag_dict = {'key': key, 'value': value}
-                        if tag_dict not in machine['tags']:
-                            machine['tags'].append(tag_dict)
-                # FIXME: optimize!
+                        if (key, value) not in tags:
+                            tags.add((key, value))
+                            machine['tags'].append({'key': key,
+                                                    'value': value})
         log.warn('Returning list machines for user %s cloud %s'
                  % (email, cloud_id))
         return {'cloud_id': cloud_id, 'machines': machines}
 
+    def get_mist_tags(self, user, cloud_id, machine_ids):
+        """Return a dict mapping the given machine ids to their mist.io tags.
+
+        Tags are cached for config.MACHINE_TAGS_CACHE_TTL secs next to the
+        machine listing, so only the tags of machines that aren't in the
+        cache yet are fetched, with a single call to mist.core's
+        list_machines_tags, or with list_tags per machine if it's missing.
+
+        """
+        try:
+            from mist.core.methods import list_machines_tags
+        except ImportError:
+            from mist.core.methods import list_tags
+
+            def list_machines_tags(user, cloud_id, machine_ids):
+                return dict((machine_id, list_tags(user,
+                                                   resource_type='machine',
+                                                   cloud_id=cloud_id,
+                                                   machine_id=machine_id))
+                            for machine_id in machine_ids)
+
+        cache_key = self.cache_key(user.email, cloud_id)[1]
+        cached = {}
+        if cache_key and config.MACHINE_TAGS_CACHE_TTL:
+            cached = cache_get(self.memcache, cache_key + ':tags') or {}
+        missing = [machine_id for machine_id in machine_ids
+                   if machine_id not in cached]
+        if missing:
+            cached.update(list_machines_tags(user, cloud_id, missing))
+            if cache_key and config.MACHINE_TAGS_CACHE_TTL:
+                cache_set(self.memcache, cache_key + ':tags', cached,
+                          time=config.MACHINE_TAGS_CACHE_TTL)
+        return cached
+
+    def clear_mist_tags_cache(self, email, cloud_id):
+        """Drop the cached mist.io tags of a cloud's machines, eg after
+        changing them"""
+        cache_key = self.cache_key(email, cloud_id)[1]
+        if cache_key:
+            cache_delete(self.memcache, cache_key + ':tags')
+
     def error_rerun_handler(self, exc, errors, email, cloud_id):
         from mist.io.methods import notify_user
 
@@ -794,6 +1330,10 @@ class ProbeSSH(UserTask):
     polling = True
     soft_time_limit = 60
 
+    def cache_args(self, email, payload):
+        return (email, payload['cloud_id'], payload['machine_id'],
+                payload['host'])
+
     def execute(self, email, cloud_id, machine_id, host):
         user = user_from_email(email)
         from mist.io.methods import probe_ssh_only
@@ -817,6 +1357,10 @@ class Ping(UserTask):
     polling = True
     soft_time_limit = 30
 
+    def cache_args(self, email, payload):
+        return (email, payload['cloud_id'], payload['machine_id'],
+                payload['host'])
+
     def execute(self, email, cloud_id, machine_id, host):
         from mist.io import methods
         res = methods.ping(host)
@@ -829,6 +1373,108 @@ class Ping(UserTask):
         return self.result_fresh
 
 
+def _ping_targets(email, targets):
+    """Ping many machines at once with methods.ping_many, publishing each
+    machine's result to the user's sockjs connections and caching it like
+    Ping does. targets is a list of (cloud_id, machine_id, host) tuples."""
+    from mist.io.methods import ping_many
+    user = user_from_email(email)
+    task = Ping()
+    machines = {}
+    for cloud_id, machine_id, host in targets:
+        machines.setdefault(host, []).append((cloud_id, machine_id))
+
+    def publish(host, res):
+        for cloud_id, machine_id in machines[host]:
+            ping = {'cloud_id': cloud_id, 'machine_id': machine_id,
+                    'host': host, 'result': res}
+            amqp_publish_user(user, routing_key='ping', data=ping)
+            args = (email, cloud_id, machine_id, host)
+            cached = task.get_cached(*args)
+            # keep the seq_id of the periodic Ping tasks, if any
+            task.set_cached({'timestamp': time(), 'payload': ping,
+                             'seq_id': cached['seq_id'] if cached else ''},
+                            *args)
+
+    started_at = time()
+    results = ping_many(machines.keys(), publish)
+    log.info("Pinged %d hosts in %.2fs, %d unreachable", len(results),
+             time() - started_at, len([res for res in results.values()
+                                       if not res.get('packets_rx')]))
+    return results
+
+
+@app.task(soft_time_limit=120)
+def ping_many(email, targets):
+    """Ping many machines at once, eg the ones that just started running."""
+    _ping_targets(email, [tuple(target) for target in targets])
+
+
+class PingMachines(UserTask):
+    """Periodically ping all running machines of a cloud in a single task,
+    instead of running a Ping task per machine."""
+    abstract = False
+    task_key = 'ping_machines'
+    result_expires = 60 * 60 * 2
+    result_fresh = 60 * 15
+    polling = True
+    soft_time_limit = 120
+
+    def execute(self, email, cloud_id):
+        cached = ListMachines().get_cached(email, cloud_id)
+        targets = []
+        for machine in cached['payload']['machines'] if cached else []:
+            if machine.get('state') != 'running':
+                continue
+            ips = [ip for ip in machine.get('public_ips') or []
+                   if ':' not in ip]
+            if ips:
+                targets.append((cloud_id, machine['id'], ips[0]))
+        results = _ping_targets(email, targets)
+        return {'cloud_id': cloud_id, 'hosts': len(results)}
+
+    def error_rerun_handler(self, exc, errors, *args, **kwargs):
+        return self.result_fresh
+
+
+class ProbeMachines(UserTask):
+    """Periodically probe all running machines of a cloud that have keys
+    associated, in a single task. Dispatched by the poller, instead of
+    running a polling ProbeSSH task per machine."""
+    abstract = False
+    task_key = 'probe_machines'
+    result_expires = 60 * 60 * 2
+    result_fresh = 60 * 2
+    polling = False
+    soft_time_limit = 120
+
+    def execute(self, email, cloud_id):
+        user = user_from_email(email)
+        with_keys = set()
+        for keypair in user.keypairs.values():
+            for machine in keypair.machines:
+                if machine[0] == cloud_id:
+                    with_keys.add(machine[1])
+        cached = ListMachines().get_cached(email, cloud_id)
+        targets = []
+        for machine in cached['payload']['machines'] if cached else []:
+            if machine.get('state') != 'running' or \
+                    machine['id'] not in with_keys:
+                continue
+            ips = [ip for ip in machine.get('public_ips') or []
+                   if ':' not in ip]
+            if ips:
+                targets.append({'cloud_id': cloud_id,
+                                'machine_id': machine['id'],
+                                'host': ips[0]})
+        stats = _probe_targets(email, targets) if targets else {}
+        return {'cloud_id': cloud_id, 'hosts': len(targets),
+                'failed': stats.get('failed', 0)}
+
+    def error_rerun_handler(self, exc, errors, *args, **kwargs):
+        return None
+
+
 @app.task
 def deploy_collectd(email, cloud_id, machine_id, extra_vars):
     import mist.io.methods
@@ -859,8 +1505,10 @@ def create_machine_async(email, cloud_id, key_id, machine_name, location_id,
                          bare_metal=False, hourly=True,
                          cronjob={}):
     from multiprocessing.dummy import Pool as ThreadPool
-    from mist.io.methods import create_machine
+    from mist.io.methods import create_machine, create_machines
+    from mist.io.methods import supports_batch_create
     from mist.io.exceptions import MachineCreationError
+    from mist.io.ratelimit import get_controller
     log.warn('MULTICREATE ASYNC %d' % quantity)
 
     if multi_user:
@@ -882,10 +1530,45 @@ def create_machine_async(email, cloud_id, key_id, machine_name, location_id,
               persist=persist, quantity=quantity, key_id=key_id,
               machine_names=names)
 
-    THREAD_COUNT = 5
-    pool = ThreadPool(THREAD_COUNT)
-
     user = user_from_email(email)
+    cloud = user.clouds[cloud_id]
+    # limits the rate and concurrency of creation requests towards the cloud
+    controller = get_controller(cloud_id, cloud.provider)
+    start_time = time()
+
+    if quantity > 1 and supports_batch_create(cloud):
+        # create all machines with a single provider request
+        error = False
+        nodes = []
+        try:
+            nodes = create_machines(
+                user, cloud_id, key_id, names, location_id, image_id,
+                size_id, script, image_extra, disk, image_name, size_name,
+                location_name, monitoring, 22, script_id, script_params,
+                job_id, hostname=hostname, plugins=plugins,
+                post_script_id=post_script_id,
+                post_script_params=post_script_params,
+                cloud_init=cloud_init, cronjob=cronjob, controller=controller
+            )
+        except MachineCreationError as exc:
+            error = str(exc)
+        except Exception as exc:
+            error = repr(exc)
+        # nodes are returned in the order of the names, but the provider
+        # may have created fewer machines than requested
+        for i, name in enumerate(names):
+            node = nodes[i] if i < len(nodes) else {}
+            log_event(email, 'job', 'machine_creation_finished',
+                      job_id=job_id, cloud_id=cloud_id, machine_name=name,
+                      error=error or (not node and 'Machine not created'),
+                      machine_id=node.get('id', ''))
+        log.info("Created %d/%d machines in %.1f secs, cloud %s stats: %s",
+                 len(nodes), quantity, time() - start_time, cloud_id,
+                 controller.get_stats())
+        return
+
+    pool = ThreadPool(max(1, min(quantity, controller.max_concurrency)))
+
     specs = []
     for name in names:
         specs.append((
@@ -902,7 +1585,8 @@ def create_machine_async(email, cloud_id, key_id, machine_name, location_id,
              'disk_size': disk_size,
              'disk_path': disk_path,
              'project_id': project_id,
-             'cronjob': cronjob}
+             'cronjob': cronjob,
+             'controller': controller}
         ))
 
     def create_machine_wrapper(args_kwargs):
@@ -924,3 +1608,5 @@ def create_machine_async(email, cloud_id, key_id, machine_name, location_id,
     pool.map(create_machine_wrapper, specs)
     pool.close()
     pool.join()
+    log.info("Created %d machines in %.1f secs, cloud %s stats: %s",
+             quantity, time() - start_time, cloud_id, controller.get_stats())
@@ -0,0 +1,80 @@
+import socket
+
+import pytest
+
+from mist.io import helpers
+
+
+class FakeChannel(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def basic_publish(self, msg, exchange, routing_key):
+        if self.connection.broken:
+            raise socket.error(32, 'Broken pipe')
+        self.connection.published.append((exchange, routing_key, msg.body))
+
+
+class FakeConnection(object):
+    """An AMQP connection over a socketpair, the other end of which stands
+    for the broker"""
+
+    instances = []
+
+    def __init__(self, uri, confirm_publish=False):
+        self.sock, self.broker_sock = socket.socketpair()
+        self.connected = True
+        self.broken = False
+        self.published = []
+        self.instances.append(self)
+
+    def channel(self):
+        return FakeChannel(self)
+
+    def close(self):
+        self.connected = False
+        self.sock.close()
+
+    def kill(self):
+        """The broker restarted, closing its end of the connection"""
+        self.broker_sock.close()
+        self.broken = True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    FakeConnection.instances = []
+    monkeypatch.setattr(helpers, 'Connection', FakeConnection)
+    pool = helpers.AmqpPool(2)
+    monkeypatch.setattr(helpers, 'amqp_pool', pool)
+    return pool
+
+
+def test_001_publish_reuses_connection(pool):
+    helpers.amqp_publish('exchange', 'key', {'a': 1})
+    helpers.amqp_publish('exchange', 'key', {'a': 2})
+    assert len(FakeConnection.instances) == 1
+    assert len(FakeConnection.instances[0].published) == 2
+    assert pool.stats == {'connections': 1, 'channels': 1, 'reused': 1}
+
+
+def test_002_publish_after_broker_closed_pooled_connection(pool):
+    assert helpers.amqp_publish_user('user@example.com', 'key', {'a': 1})
+    FakeConnection.instances[0].kill()
+    assert helpers.amqp_publish_user('user@example.com', 'key', {'a': 2})
+    assert len(FakeConnection.instances) == 2
+    stale, new = FakeConnection.instances
+    assert not stale.connected
+    assert [body for exchange, key, body in new.published] == ['{"a": 2}']
+
+
+def test_003_publish_failure_not_retried(pool):
+    helpers.amqp_publish('exchange', 'key', {'a': 1})
+    connection = FakeConnection.instances[0]
+    # the broker went away, but the socket doesn't show it yet
+    connection.broken = True
+    with pytest.raises(socket.error):
+        helpers.amqp_publish('exchange', 'key', {'a': 2})
+    # the message may have been published, so it's never sent twice
+    assert len(FakeConnection.instances) == 1
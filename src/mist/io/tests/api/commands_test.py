@@ -0,0 +1,44 @@
+import json
+import requests
+
+
+def test_001_run_command_with_no_command(pretty_print, mist_io):
+    response = mist_io.run_command(
+        [{'cloud_id': 'cloud', 'machine_id': 'machine'}], ''
+    ).post()
+    assert response.status_code == requests.codes.bad_request, \
+        response.content
+    print "Success!!!"
+
+
+def test_002_run_command_with_no_targets(pretty_print, mist_io):
+    response = mist_io.run_command([], 'uptime').post()
+    assert response.status_code == requests.codes.bad_request, \
+        response.content
+    response = mist_io.run_command({'cloud_id': 'cloud',
+                                    'machine_id': 'machine'},
+                                   'uptime').post()
+    assert response.status_code == requests.codes.bad_request, \
+        response.content
+    print "Success!!!"
+
+
+def test_003_run_command_with_wrong_targets(pretty_print, mist_io):
+    for target in ({'cloud_id': 'cloud'}, {'machine_id': 'machine'},
+                   ['cloud'], 'machine'):
+        response = mist_io.run_command(
+            [{'cloud_id': 'cloud', 'machine_id': 'machine'}, target],
+            'uptime'
+        ).post()
+        assert response.status_code == requests.codes.bad_request, \
+            response.content
+    print "Success!!!"
+
+
+def test_004_run_command(pretty_print, mist_io):
+    # machines that can't be found are reported over the sockjs channel,
+    # so the job is started anyway
+    response = mist_io.run_command([['cloud', 'machine']], 'uptime').post()
+    assert response.status_code == requests.codes.ok, response.content
+    assert json.loads(response.content).get('job_id'), response.content
+    print "Success!!!"
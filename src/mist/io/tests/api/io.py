@@ -185,6 +185,39 @@ class MistIoApi(object):
         req.delete = req.unavailable_api_call
         return req
 
+    def bulk_machine_action(self, cloud_id, machine_ids, action, cookie=None,
+                            csrf_token=None, api_token=None):
+        uri = self.uri + "/clouds/" + cloud_id + "/machines/actions"
+        payload = {'machines': machine_ids, 'action': action}
+        req = MistRequests(uri=uri, data=json.dumps(payload), cookie=cookie,
+                           csrf_token=csrf_token, api_token=api_token)
+        req.get = req.unavailable_api_call
+        req.put = req.unavailable_api_call
+        req.delete = req.unavailable_api_call
+        return req
+
+    def set_machines_tags(self, cloud_id, machine_ids, tags, cookie=None,
+                          csrf_token=None, api_token=None):
+        uri = self.uri + "/clouds/" + cloud_id + "/machines/tags"
+        payload = {'machines': machine_ids, 'tags': tags}
+        req = MistRequests(uri=uri, data=json.dumps(payload), cookie=cookie,
+                           csrf_token=csrf_token, api_token=api_token)
+        req.get = req.unavailable_api_call
+        req.put = req.unavailable_api_call
+        req.delete = req.unavailable_api_call
+        return req
+
+    def run_command(self, targets, command, cookie=None, csrf_token=None,
+                    api_token=None):
+        payload = {'targets': targets, 'command': command}
+        req = MistRequests(uri=self.uri + "/commands",
+                           data=json.dumps(payload), cookie=cookie,
+                           csrf_token=csrf_token, api_token=api_token)
+        req.get = req.unavailable_api_call
+        req.put = req.unavailable_api_call
+        req.delete = req.unavailable_api_call
+        return req
+
     def list_keys(self, cookie=None, csrf_token=None, api_token=None):
         req = MistRequests(uri=self.uri + "/keys", cookie=cookie,
                            csrf_token=csrf_token, api_token=api_token)
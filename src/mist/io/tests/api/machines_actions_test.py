@@ -0,0 +1,69 @@
+import json
+import string
+import random
+import requests
+
+
+def get_random_cloud_id(existing_clouds):
+    cloud_ids = [cloud['id'] for cloud in existing_clouds]
+    while True:
+        random_cloud_id = ''.join([random.choice(string.ascii_letters +
+                                                 string.digits) for _ in
+                                   range(6)])
+        if random_cloud_id not in cloud_ids:
+            return random_cloud_id
+
+
+def test_001_bulk_machine_action_with_no_action(pretty_print, cache,
+                                                 mist_io):
+    response = mist_io.list_clouds().get()
+    assert response.status_code == requests.codes.ok, response.content
+    cache.set('machines_actions_tests/cloud_id',
+              get_random_cloud_id(json.loads(response.content)))
+    response = mist_io.bulk_machine_action(
+        cache.get('machines_actions_tests/cloud_id', ''), ['machine'], ''
+    ).post()
+    assert response.status_code == requests.codes.bad_request, \
+        response.content
+    print "Success!!!"
+
+
+def test_002_bulk_machine_action_with_no_machines(pretty_print, cache,
+                                                   mist_io):
+    response = mist_io.bulk_machine_action(
+        cache.get('machines_actions_tests/cloud_id', ''), [], 'reboot'
+    ).post()
+    assert response.status_code == requests.codes.bad_request, \
+        response.content
+    print "Success!!!"
+
+
+def test_003_bulk_machine_action_with_machines_not_a_list(pretty_print,
+                                                          cache, mist_io):
+    response = mist_io.bulk_machine_action(
+        cache.get('machines_actions_tests/cloud_id', ''), 'machine', 'reboot'
+    ).post()
+    assert response.status_code == requests.codes.bad_request, \
+        response.content
+    print "Success!!!"
+
+
+def test_004_bulk_machine_action_with_wrong_action(pretty_print, cache,
+                                                    mist_io):
+    response = mist_io.bulk_machine_action(
+        cache.get('machines_actions_tests/cloud_id', ''), ['machine'],
+        'explode'
+    ).post()
+    assert response.status_code == requests.codes.bad_request, \
+        response.content
+    print "Success!!!"
+
+
+def test_005_bulk_machine_action_with_wrong_cloud_id(pretty_print, cache,
+                                                      mist_io):
+    response = mist_io.bulk_machine_action(
+        cache.get('machines_actions_tests/cloud_id', ''), ['machine'],
+        'reboot'
+    ).post()
+    assert response.status_code == requests.codes.not_found, response.content
+    print "Success!!!"
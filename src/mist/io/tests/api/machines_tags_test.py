@@ -0,0 +1,66 @@
+import json
+import string
+import random
+import requests
+
+
+def get_random_cloud_id(existing_clouds):
+    cloud_ids = [cloud['id'] for cloud in existing_clouds]
+    while True:
+        random_cloud_id = ''.join([random.choice(string.ascii_letters +
+                                                 string.digits) for _ in
+                                   range(6)])
+        if random_cloud_id not in cloud_ids:
+            return random_cloud_id
+
+
+def test_001_set_machines_tags_with_no_machines(pretty_print, cache,
+                                                 mist_io):
+    response = mist_io.list_clouds().get()
+    assert response.status_code == requests.codes.ok, response.content
+    cache.set('machines_tags_tests/cloud_id',
+              get_random_cloud_id(json.loads(response.content)))
+    response = mist_io.set_machines_tags(
+        cache.get('machines_tags_tests/cloud_id', ''), None,
+        [{'env': 'dev'}]
+    ).post()
+    assert response.status_code == requests.codes.bad_request, \
+        response.content
+    response = mist_io.set_machines_tags(
+        cache.get('machines_tags_tests/cloud_id', ''), [], [{'env': 'dev'}]
+    ).post()
+    assert response.status_code == requests.codes.bad_request, \
+        response.content
+    print "Success!!!"
+
+
+def test_002_set_machines_tags_with_tags_not_a_list(pretty_print, cache,
+                                                     mist_io):
+    response = mist_io.set_machines_tags(
+        cache.get('machines_tags_tests/cloud_id', ''), ['machine'],
+        {'env': 'dev'}
+    ).post()
+    assert response.status_code == requests.codes.bad_request, \
+        response.content
+    print "Success!!!"
+
+
+def test_003_set_machines_tags_per_machine_with_tags_not_a_list(
+        pretty_print, cache, mist_io):
+    response = mist_io.set_machines_tags(
+        cache.get('machines_tags_tests/cloud_id', ''),
+        {'machine1': [{'env': 'dev'}], 'machine2': 'env=dev'}, None
+    ).post()
+    assert response.status_code == requests.codes.bad_request, \
+        response.content
+    print "Success!!!"
+
+
+def test_004_set_machines_tags_with_wrong_cloud_id(pretty_print, cache,
+                                                    mist_io):
+    response = mist_io.set_machines_tags(
+        cache.get('machines_tags_tests/cloud_id', ''), ['machine'],
+        [{'env': 'dev'}]
+    ).post()
+    assert response.status_code == requests.codes.not_found, response.content
+    print "Success!!!"
@@ -0,0 +1,63 @@
+import threading
+
+from libcloud.compute.base import Node
+
+from mist.io import methods
+from mist.io import ratelimit
+
+
+class FakeCloud(object):
+    provider = 'ec2_us_east'
+
+
+class FakeUser(object):
+    email = 'user@example.com'
+    clouds = {'cloud': FakeCloud()}
+
+
+class ThrottlingDriver(object):
+    """Throttles the first `throttled` reboot requests, like EC2 does"""
+
+    type = 'ec2'
+
+    def __init__(self, state):
+        self.state = state
+
+    def list_nodes(self):
+        return [Node('i-%d' % i, 'machine-%d' % i, 0, [], [], self)
+                for i in range(4)]
+
+    def reboot_node(self, node):
+        with self.state['lock']:
+            self.state['calls'].append(node.id)
+            if self.state['throttled']:
+                self.state['throttled'] -= 1
+                raise Exception('RequestLimitExceeded: Request limit '
+                                'exceeded.')
+        return True
+
+
+def test_001_bulk_action_backs_off_when_throttled(monkeypatch):
+    state = {'lock': threading.Lock(), 'calls': [], 'throttled': 2}
+    controller = ratelimit.ConcurrencyController(
+        'cloud', rate=1024, burst=1024, concurrency=4, max_concurrency=4,
+        retries=3, backoff=0.01)
+    monkeypatch.setattr(methods, 'connect_provider',
+                        lambda cloud: ThrottlingDriver(state))
+    monkeypatch.setattr(ratelimit, 'get_controller',
+                        lambda cloud_id, provider: controller)
+    monkeypatch.setattr(methods.poller, 'boost', lambda *args: None)
+
+    machine_ids = ['i-%d' % i for i in range(4)]
+    results = methods.bulk_machine_action(FakeUser(), 'cloud', machine_ids,
+                                          'reboot')
+    assert results == dict((machine_id, {'success': True})
+                           for machine_id in machine_ids)
+    # the throttled reboots were retried
+    assert sorted(set(state['calls'])) == machine_ids
+    assert len(state['calls']) == 6
+    stats = controller.get_stats()
+    assert stats['throttled'] == 2
+    assert stats['failed'] == 0
+    # and the concurrency shrank
+    assert stats['concurrency_limit'] < 4
@@ -0,0 +1,196 @@
+import os
+
+import pytest
+
+from mist.io import tasks
+from mist.io.tests.helpers.fake_memcache import FakeMemcache
+
+
+ITEM_SIZE = 4096
+
+
+@pytest.fixture
+def memcache(monkeypatch):
+    monkeypatch.setattr(tasks.config, 'MEMCACHED_COMPRESS_MIN_SIZE', 512)
+    monkeypatch.setattr(tasks.config, 'MEMCACHED_ITEM_SIZE', ITEM_SIZE)
+    monkeypatch.setattr(tasks.config, 'MEMCACHED_MAX_CACHED_SIZE',
+                        64 * ITEM_SIZE)
+    tasks.local_cache.clear()
+    # chunk values above 3KB, leaving the usual 1KB room for item overhead
+    return FakeMemcache(item_size=ITEM_SIZE)
+
+
+def machines(count):
+    """A listing that doesn't compress well, like real ones with ids,
+    ips and extra metadata"""
+    return {'cloud_id': 'cloud',
+            'machines': [{'id': os.urandom(16).encode('hex'),
+                          'name': 'machine-%d' % i,
+                          'extra': {'blob': os.urandom(64).encode('hex')}}
+                         for i in range(count)]}
+
+
+def test_001_encode_decode_small():
+    value = {'timestamp': 1.5, 'payload': {'a': [1, 2]}, 'seq_id': u'x'}
+    data, size = tasks._cache_encode(value)
+    assert data.startswith(tasks.CACHE_JSON)
+    assert size == len(data) - len(tasks.CACHE_JSON)
+    assert tasks._cache_decode(data) == value
+
+
+def test_002_encode_decode_compressed(memcache):
+    value = {'payload': ['same value'] * 1000}
+    data, size = tasks._cache_encode(value)
+    assert data.startswith(tasks.CACHE_ZLIB)
+    assert len(data) < size
+    assert tasks._cache_decode(data) == value
+
+
+def test_003_decode_legacy_values():
+    # values cached before the markers were introduced, or pickled by
+    # memcache, are returned as they are
+    legacy = {'timestamp': 1, 'payload': []}
+    assert tasks._cache_decode(legacy) is legacy
+    assert tasks._cache_decode('plain string') == 'plain string'
+    assert tasks._cache_decode(None) is None
+
+
+def test_004_encode_not_json_serializable():
+    value = {'payload': set([1, 2])}
+    data, size = tasks._cache_encode(value)
+    assert data is value
+    assert size == 0
+
+
+def test_005_set_get_small(memcache):
+    value = {'timestamp': 1.0, 'payload': {'a': 1}, 'seq_id': 'x'}
+    assert tasks.cache_set(memcache, 'key', value)
+    assert memcache.data['key'].startswith(tasks.CACHE_JSON)
+    tasks.local_cache.clear()
+    assert tasks.cache_get(memcache, 'key') == value
+    assert tasks.cache_get(memcache, 'missing') is None
+
+
+def test_006_chunk_round_trip(memcache):
+    value = {'timestamp': 1.0, 'payload': machines(200), 'seq_id': 'y'}
+    assert tasks.cache_set(memcache, 'key', value)
+    assert memcache.data['key'].startswith(tasks.CACHE_CHUNKS)
+    chunk_keys = [key for key in memcache.data if key.startswith('key:')]
+    assert len(chunk_keys) > 1
+    assert all(len(memcache.data[key]) <= ITEM_SIZE for key in chunk_keys)
+
+    tasks.local_cache.clear()
+    memcache.round_trips = 0
+    assert tasks.cache_get(memcache, 'key') == value
+    # one for the manifest and one for all of its chunks
+    assert memcache.round_trips == 2
+
+
+def test_007_chunks_of_many_keys(memcache):
+    values = {'big1': machines(100), 'big2': machines(150), 'small': [1]}
+    for key, value in values.items():
+        assert tasks.cache_set(memcache, key, value)
+    tasks.local_cache.clear()
+    memcache.round_trips = 0
+    assert tasks.cache_get_multi(memcache, values.keys() + ['x']) == values
+    assert memcache.round_trips == 2
+
+
+def test_008_missing_chunk(memcache):
+    assert tasks.cache_set(memcache, 'key', machines(200))
+    assert tasks.cache_set(memcache, 'other', machines(100))
+    tasks.local_cache.clear()
+    # memcache evicted one chunk of key
+    evicted = sorted(k for k in memcache.data if k.startswith('key:'))[1]
+    del memcache.data[evicted]
+    missing_chunks = tasks.cache_stats['missing_chunks']
+    ret = tasks.cache_get_multi(memcache, ['key', 'other'])
+    assert ret.keys() == ['other']
+    assert tasks.cache_stats['missing_chunks'] == missing_chunks + 1
+
+
+def test_009_overwrite_chunked_value(memcache):
+    first, second = machines(200), machines(210)
+    assert tasks.cache_set(memcache, 'key', first)
+    assert tasks.cache_set(memcache, 'key', second)
+    tasks.local_cache.clear()
+    # the chunks of the new value never mix with those of the old one
+    assert tasks.cache_get(memcache, 'key') == second
+
+
+def test_010_too_large(memcache):
+    assert not tasks.cache_set(memcache, 'key', machines(10000))
+    assert 'key' not in memcache.data
+
+
+def test_011_decode_error(memcache):
+    memcache.data['key'] = tasks.CACHE_ZLIB + 'not compressed'
+    assert tasks.cache_get(memcache, 'key') is None
+
+
+def test_012_local_cache_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(tasks, 'time', lambda: now[0])
+    cache = tasks.LocalCache(ttl=5, max_size=1024)
+    cache.set('key', 'value')
+    now[0] += 4
+    assert cache.get('key') == 'value'
+    now[0] += 2
+    assert cache.get('key') is None
+    assert cache.size == 0 and not cache.items
+
+
+def test_013_local_cache_lru_eviction():
+    cache = tasks.LocalCache(ttl=60, max_size=100)
+    for key in 'abcd':
+        cache.set(key, key * 25)
+    assert cache.get('a') == 'a' * 25
+    # over max_size, the least recently used entry goes
+    cache.set('e', 'e' * 25)
+    assert cache.get('b') is None
+    assert [cache.get(key) for key in 'acde'] == [k * 25 for k in 'acde']
+    assert cache.size == 100
+    # values larger than a quarter of max_size are never cached
+    cache.set('a', 'x' * 26)
+    assert cache.get('a') is None
+    assert cache.size == 75
+
+
+def test_014_local_cache_disabled():
+    cache = tasks.LocalCache(ttl=0, max_size=100)
+    cache.set('key', 'value')
+    assert cache.get('key') is None
+
+
+def test_015_local_cache_in_front_of_memcache(memcache):
+    value = {'timestamp': 1.0, 'payload': machines(10), 'seq_id': 'x'}
+    assert tasks.cache_set(memcache, 'key', value)
+    memcache.round_trips = 0
+    first = tasks.cache_get(memcache, 'key')
+    assert first == value
+    assert memcache.round_trips == 0
+    # every hit is a new copy
+    first['payload']['machines'] = []
+    assert tasks.cache_get(memcache, 'key') == value
+
+    # a worker updated the value
+    memcache.data['key'] = tasks._cache_encode([1])[0]
+    assert tasks.cache_get(memcache, 'key') == value
+    tasks.local_cache.delete('key')
+    assert tasks.cache_get(memcache, 'key') == [1]
+    assert memcache.round_trips == 1
+
+    tasks.cache_delete(memcache, 'key')
+    assert tasks.cache_get(memcache, 'key') is None
+
+
+def test_016_invalidate_local_cache(memcache):
+    task = tasks.ListMachines()
+    cache_key = task.cache_key('user@example.com', 'cloud')[1]
+    assert tasks.cache_set(memcache, cache_key, {'payload': 'old'})
+    assert tasks.local_cache.get(cache_key) is not None
+    tasks.invalidate_local_cache('list_machines', 'user@example.com',
+                                 {'cloud_id': 'cloud', 'machines': []})
+    assert tasks.local_cache.get(cache_key) is None
+    # payloads that don't identify the task are ignored
+    tasks.invalidate_local_cache('list_machines', 'user@example.com', [])
@@ -0,0 +1,135 @@
+from libcloud.compute.base import Node
+from libcloud.compute.types import Provider
+
+from mist.io import methods
+from mist.io import ratelimit
+from mist.io import tasks
+
+
+class FakeKeypair(object):
+    default = True
+    private = 'private'
+    public = 'public'
+
+
+class FakeUser(object):
+    email = 'user@example.com'
+    clouds = {'cloud': object()}
+    keypairs = {'key': FakeKeypair()}
+
+
+class FakeDriver(object):
+    type = Provider.VULTR
+
+
+class ThrottledError(Exception):
+    pass
+
+
+def create_machine(monkeypatch, throttle_create=0, throttle_associate=0):
+    """Run create_machine in Vultr through a controller, recording the
+    provider requests and the post create steps"""
+    calls = {'create': 0, 'associate': 0, 'post_deploy': 0}
+
+    def create(conn, public_key, machine_name, *args):
+        calls['create'] += 1
+        if calls['create'] <= throttle_create:
+            raise ThrottledError('RequestLimitExceeded')
+        return Node('node-%d' % calls['create'], machine_name, 0, [], [],
+                    conn)
+
+    def associate_key(*args, **kwargs):
+        calls['associate'] += 1
+        if calls['associate'] <= throttle_associate:
+            raise ThrottledError('RequestLimitExceeded')
+
+    def post_deploy(*args, **kwargs):
+        calls['post_deploy'] += 1
+
+    monkeypatch.setattr(methods, 'connect_provider',
+                        lambda cloud: FakeDriver())
+    monkeypatch.setattr(methods, '_create_machine_vultr', create)
+    monkeypatch.setattr(methods, 'associate_key', associate_key)
+    monkeypatch.setattr(methods.poller, 'boost', lambda *args: None)
+    monkeypatch.setattr(tasks.post_deploy_steps, 'delay', post_deploy)
+
+    controller = ratelimit.ConcurrencyController(
+        'cloud', rate=1024, burst=1024, concurrency=2, max_concurrency=2,
+        retries=3, backoff=0.01)
+    try:
+        ret = methods.create_machine(FakeUser(), 'cloud', 'key', 'machine',
+                                     'location', 'image', 'size', '', {}, 0,
+                                     'image', 'size', 'location', [], False,
+                                     controller=controller)
+    except Exception as exc:
+        ret = exc
+    return ret, calls, controller
+
+
+def test_001_create_machine_retries_throttled_create(monkeypatch):
+    ret, calls, controller = create_machine(monkeypatch, throttle_create=2)
+    assert ret['id'] == 'node-3'
+    assert calls == {'create': 3, 'associate': 1, 'post_deploy': 1}
+    assert controller.get_stats()['throttled'] == 2
+
+
+def test_002_create_machine_never_retries_post_create_steps(monkeypatch):
+    ret, calls, controller = create_machine(monkeypatch,
+                                            throttle_associate=1)
+    # the machine exists, it must not be created again
+    assert isinstance(ret, ThrottledError)
+    assert calls == {'create': 1, 'associate': 1, 'post_deploy': 0}
+    assert controller.get_stats()['throttled'] == 0
+
+
+class FakeDigitalOceanCloud(object):
+    provider = Provider.DIGITAL_OCEAN
+    apikey = apisecret = 'token'
+
+
+class FakeResponse(object):
+
+    def __init__(self, obj):
+        self.object = obj
+
+
+class FakeDigitalOceanDriver(object):
+    """Answers the batch create request of _create_machines_digital_ocean"""
+
+    type = Provider.DIGITAL_OCEAN
+
+    def __init__(self):
+        self.connection = self
+        self.requests = []
+
+    def request(self, path, data=None, method='GET'):
+        self.requests.append((path, method))
+        return FakeResponse({'droplets': [{'id': i} for i in range(3)]})
+
+    def _to_node(self, droplet):
+        return Node(str(droplet['id']), 'machine-%d' % droplet['id'], 0,
+                    [], [], self)
+
+
+def test_003_create_machines_digital_ocean(monkeypatch):
+    conn = FakeDigitalOceanDriver()
+    user = FakeUser()
+    monkeypatch.setattr(user, 'clouds', {'cloud': FakeDigitalOceanCloud()})
+    monkeypatch.setattr(methods, 'connect_provider', lambda cloud: conn)
+    monkeypatch.setattr(methods, '_prepare_digital_ocean_create',
+                        lambda *args: ([1], False))
+    associated = []
+    monkeypatch.setattr(methods, '_associate_key_many',
+                        lambda user, key_id, cloud_id, machine_ids, port:
+                        associated.extend(machine_ids))
+    monkeypatch.setattr(methods.poller, 'boost', lambda *args: None)
+    monkeypatch.setattr(tasks.post_deploy_steps, 'delay',
+                        lambda *args, **kwargs: None)
+
+    ret = methods.create_machines(user, 'cloud', 'key',
+                                  ['machine-0', 'machine-1', 'machine-2'],
+                                  'location', 'image', 'size', '', {}, 0,
+                                  'image', 'size', 'location', False)
+    assert [machine['id'] for machine in ret] == ['0', '1', '2']
+    assert conn.requests == [('/v2/droplets', 'POST')]
+    assert associated == ['0', '1', '2']
@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+from mist.io.shell import DockerShell
+from mist.io.tests.helpers.fake_docker import FakeDockerServer
+
+
+@pytest.fixture
+def docker_shell(request):
+    server = FakeDockerServer()
+    server.start()
+    request.addfinalizer(server.stop)
+    shell = DockerShell('127.0.0.1')
+    shell.configure_api(server.url, 'container')
+    return shell
+
+
+def test_001_command_output_and_exit_code(docker_shell):
+    retval, output = docker_shell.command('echo hello; exit 3')
+    assert retval == 3
+    assert output == 'hello\n'
+
+
+def test_002_command_separate_streams(docker_shell):
+    retval, stdout, stderr = docker_shell.command('echo out; echo err >&2',
+                                                  pty=False)
+    assert retval == 0
+    assert stdout == 'out\n'
+    assert stderr == 'err\n'
+
+
+def test_003_command_large_output(docker_shell):
+    retval, output = docker_shell.command('seq 1 100000')
+    assert retval == 0
+    assert output.splitlines() == [str(i) for i in range(1, 100001)]
+
+
+def test_004_command_latency(docker_shell):
+    runs = 50
+    start = time.time()
+    for i in range(runs):
+        retval, output = docker_shell.command('echo %d' % i)
+        assert (retval, output) == (0, '%d\n' % i)
+    latency = (time.time() - start) / runs
+    print "Average command latency: %.1f ms" % (latency * 1000)
+    # the old attach based implementation always slept for 1 sec
+    assert latency < 1
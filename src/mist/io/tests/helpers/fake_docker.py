@@ -0,0 +1,109 @@
+"""A fake docker remote API server, implementing just the exec API.
+
+Commands are run locally with /bin/sh and their output is streamed back
+multiplexed, like docker does for containers started without a tty.
+
+Use it like:
+server = FakeDockerServer()
+server.start()
+shell = DockerShell('127.0.0.1')
+shell.configure_api(server.url, 'container')
+print shell.command('uptime')
+server.stop()
+
+"""
+
+import os
+import json
+import uuid
+import struct
+import threading
+import subprocess
+import SocketServer
+import BaseHTTPServer
+
+
+class FakeDockerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or '{}')
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'containers' and \
+                parts[2] == 'exec':
+            exec_id = uuid.uuid4().hex
+            self.server.execs[exec_id] = {'Cmd': self._read_json()['Cmd'],
+                                          'Running': False, 'ExitCode': None}
+            self._send_json({'Id': exec_id}, status=201)
+        elif len(parts) == 3 and parts[0] == 'exec' and parts[2] == 'start':
+            self._read_json()
+            self._start_exec(self.server.execs[parts[1]])
+        else:
+            self._send_json({'message': 'not found'}, status=404)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'exec' and parts[2] == 'json':
+            info = self.server.execs[parts[1]]
+            self._send_json({'Running': info['Running'],
+                             'ExitCode': info['ExitCode']})
+        else:
+            self._send_json({'message': 'not found'}, status=404)
+
+    def _start_exec(self, info):
+        info['Running'] = True
+        proc = subprocess.Popen(info['Cmd'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        self.end_headers()
+        lock = threading.Lock()
+
+        def pipe(stream, stream_type):
+            for data in iter(lambda: os.read(stream.fileno(), 4096), ''):
+                with lock:
+                    self.wfile.write(struct.pack('>BxxxL', stream_type,
+                                                 len(data)) + data)
+                    self.wfile.flush()
+
+        stderr_thread = threading.Thread(target=pipe, args=(proc.stderr, 2))
+        stderr_thread.start()
+        pipe(proc.stdout, 1)
+        stderr_thread.join()
+        info['ExitCode'] = proc.wait()
+        info['Running'] = False
+
+
+class FakeDockerServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           FakeDockerHandler)
+        self.execs = {}
+        self.url = 'http://%s:%s' % self.server_address
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,61 @@
+"""A fake, in-process memcache client, with the part of the python-memcached
+client API used by mist.io.
+
+Like memcached, it refuses to store values larger than item_size bytes.
+Expiration times are ignored.
+
+Use it like:
+memcache = FakeMemcache(item_size=4096)
+memcache.set('key', 'value')
+print memcache.get_multi(['key'])
+
+"""
+
+
+class FakeMemcache(object):
+
+    def __init__(self, item_size=1024 * 1024):
+        self.item_size = item_size
+        self.data = {}
+        self.round_trips = 0
+
+    def _fits(self, value):
+        return not isinstance(value, str) or len(value) <= self.item_size
+
+    def get(self, key):
+        self.round_trips += 1
+        return self.data.get(key)
+
+    def get_multi(self, keys):
+        self.round_trips += 1
+        return dict((key, self.data[key]) for key in keys if key in self.data)
+
+    def set(self, key, value, time=0):
+        self.round_trips += 1
+        if not self._fits(value):
+            return False
+        self.data[key] = value
+        return True
+
+    def set_multi(self, mapping, time=0):
+        """Return the list of keys that failed to be stored"""
+        self.round_trips += 1
+        failed = []
+        for key, value in mapping.items():
+            if self._fits(value):
+                self.data[key] = value
+            else:
+                failed.append(key)
+        return failed
+
+    def add(self, key, value, time=0):
+        self.round_trips += 1
+        if key in self.data or not self._fits(value):
+            return False
+        self.data[key] = value
+        return True
+
+    def delete(self, key, time=0):
+        self.round_trips += 1
+        self.data.pop(key, None)
+        return True
@@ -0,0 +1,155 @@
+from libcloud.compute.types import Provider
+
+from mist.io import methods
+
+
+class Resource(object):
+
+    def __init__(self, **kwargs):
+        self.extra = {}
+        self.__dict__.update(kwargs)
+
+
+def network(network_id, subnets=(), public=False):
+    return Resource(id=network_id, name=network_id, status='ACTIVE',
+                    router_external=public, subnets=list(subnets))
+
+
+def subnet(subnet_id):
+    return Resource(id=subnet_id, name=subnet_id, cidr='10.0.0.0/24',
+                    enable_dhcp=True, dns_nameservers=[],
+                    allocation_pools=[], gateway_ip='10.0.0.1',
+                    ip_version=4)
+
+
+def floating_ip(ip_id, network_id, fixed_ip=None, tenant_id='tenant'):
+    return Resource(id=ip_id, floating_network_id=network_id,
+                    floating_ip_address='172.24.4.%s' % ip_id,
+                    fixed_ip_address=fixed_ip, status='ACTIVE',
+                    port_id=None, extra={'tenant_id': tenant_id})
+
+
+def node(node_id, private_ips):
+    return Resource(id=node_id, private_ips=private_ips)
+
+
+def test_001_networks_to_dict():
+    networks = [network('ext', ['s-ext'], public=True),
+                network('net1', ['s1', 's2']),
+                network('net2')]
+    subnets = [subnet('s-ext'), subnet('s1'), subnet('s2'), subnet('other')]
+    floating_ips = [floating_ip('1', 'ext', '10.0.0.5'),
+                    floating_ip('2', 'ext'),
+                    floating_ip('3', 'elsewhere', '10.0.0.6')]
+    nodes = [node('vm1', ['10.0.0.5']), node('vm2', ['10.0.0.6'])]
+
+    public, private = methods.openstack_networks_to_dict(
+        networks, subnets, floating_ips, nodes
+    )
+    assert [net['id'] for net in public] == ['ext']
+    assert [net['id'] for net in private] == ['net1', 'net2']
+    assert public[0]['public'] and not private[0]['public']
+    assert [s['id'] for s in public[0]['subnets']] == ['s-ext']
+    assert [s['id'] for s in private[0]['subnets']] == ['s1', 's2']
+    assert private[1]['subnets'] == []
+    # floating ips of the network only, mapped to the nodes they belong to
+    assert [(ip['id'], ip['node_id']) for ip in public[0]['floating_ips']] \
+        == [('1', 'vm1'), ('2', '')]
+    assert private[0]['floating_ips'] == []
+
+
+def test_002_networks_to_dict_matches_single_network():
+    # the same as openstack_network_to_dict filtering per network
+    networks = [network('ext%d' % i, ['s%d' % i], public=True)
+                for i in range(5)] + [network('net', ['s0', 's1'])]
+    subnets = [subnet('s%d' % i) for i in range(5)]
+    floating_ips = [floating_ip(str(i), 'ext%d' % (i % 5), '10.0.0.%d' % i)
+                    for i in range(20)]
+    nodes = [node('vm%d' % i, ['10.0.0.%d' % i]) for i in range(0, 20, 2)]
+
+    public, private = methods.openstack_networks_to_dict(
+        networks, subnets, floating_ips, nodes
+    )
+    assert public == [
+        methods.openstack_network_to_dict(net, subnets, floating_ips, nodes)
+        for net in networks[:5]
+    ]
+    assert private == [methods.openstack_network_to_dict(networks[5],
+                                                         subnets)]
+
+
+class FakeOpenStackConnection(object):
+
+    def __init__(self, auth_token=None):
+        self.tenant_id = 'tenant'
+        self.auth_token = auth_token
+        self.service_catalog = 'catalog' if auth_token else None
+
+
+class FakeOpenStackDriver(object):
+
+    type = Provider.OPENSTACK
+
+    def __init__(self, calls, floating_ips=()):
+        self.calls = calls
+        self.floating_ips = list(floating_ips)
+        self.connection = FakeOpenStackConnection()
+
+    def _call(self, method):
+        self.calls.append((method, self.connection.auth_token))
+
+    def ex_list_floating_ips(self):
+        self._call('ex_list_floating_ips')
+        # authenticates the connection
+        self.connection.auth_token = 'token'
+        self.connection.service_catalog = 'catalog'
+        return self.floating_ips
+
+    def ex_list_networks(self):
+        self._call('ex_list_networks')
+        return [network('ext', public=True)]
+
+    def ex_list_subnets(self):
+        self._call('ex_list_subnets')
+        return []
+
+    def ex_list_routers(self):
+        self._call('ex_list_routers')
+        return []
+
+    def list_nodes(self):
+        self._call('list_nodes')
+        return [node('vm1', ['10.0.0.5'])]
+
+
+class FakeUser(object):
+    clouds = {'cloud': object()}
+
+
+def list_networks(monkeypatch, floating_ips):
+    calls = []
+    monkeypatch.setattr(methods, 'connect_provider',
+                        lambda cloud: FakeOpenStackDriver(calls,
+                                                          floating_ips))
+    return methods.list_networks(FakeUser(), 'cloud'), calls
+
+
+def test_003_list_networks_without_floating_ips(monkeypatch):
+    ret, calls = list_networks(monkeypatch, [])
+    assert [net['id'] for net in ret['public']] == ['ext']
+    assert 'list_nodes' not in [method for method, token in calls]
+    # only the first call authenticates
+    assert sorted(calls) == [('ex_list_floating_ips', None),
+                             ('ex_list_networks', 'token'),
+                             ('ex_list_routers', 'token'),
+                             ('ex_list_subnets', 'token')]
+
+
+def test_004_list_networks_with_floating_ips(monkeypatch):
+    ret, calls = list_networks(monkeypatch, [
+        floating_ip('1', 'ext', '10.0.0.5'),
+        floating_ip('2', 'ext', '10.0.0.6', tenant_id='other tenant'),
+    ])
+    assert ('list_nodes', 'token') in calls
+    floating_ips = ret['public'][0]['floating_ips']
+    assert [(ip['id'], ip['node_id']) for ip in floating_ips] == [('1', 'vm1')]
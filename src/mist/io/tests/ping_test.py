@@ -0,0 +1,80 @@
+import sys
+import time
+
+import pytest
+
+from mist.io import methods
+
+
+# prints the output of ping -q for hosts named up*, loses half the packets
+# of lossy* hosts, prints nothing for down* and hangs for slow* hosts
+FAKE_PING = r"""
+import sys
+import time
+host = sys.argv[-1]
+if host.startswith('up'):
+    print 'PING %s (10.0.0.1) 56(84) bytes of data.' % host
+    print
+    print '--- %s ping statistics ---' % host
+    print '10 packets transmitted, 10 received, 0% packet loss, time 3603ms'
+    print 'rtt min/avg/max/mdev = 0.031/0.045/0.066/0.010 ms'
+elif host.startswith('lossy'):
+    print '--- %s ping statistics ---' % host
+    print '10 packets transmitted, 5 received, 50% packet loss, time 3600ms'
+    print 'rtt min/avg/max/mdev = 10.100/20.200/30.300/5.000 ms'
+elif host.startswith('slow'):
+    time.sleep(30)
+sys.exit(0)
+"""
+
+
+@pytest.fixture
+def fake_ping(tmpdir, monkeypatch):
+    script = tmpdir.join('ping.py')
+    script.write(FAKE_PING)
+    monkeypatch.setattr(methods, 'PING_COMMAND', [sys.executable,
+                                                  str(script)])
+    monkeypatch.setattr(methods.config, 'PING_TIMEOUT', 2)
+    monkeypatch.setattr(methods.config, 'PING_CONCURRENCY', 4)
+
+
+def test_001_ping_many_parses_output(fake_ping):
+    results = methods.ping_many(['up1', 'lossy1', 'down1'])
+    assert results['up1'] == {'packets_tx': 10, 'packets_rx': 10,
+                              'packets_loss': 0.0, 'rtt_min': 0.031,
+                              'rtt_avg': 0.045, 'rtt_max': 0.066}
+    assert results['lossy1']['packets_loss'] == 0.5
+    assert results['lossy1']['rtt_max'] == 30.3
+    assert results['down1'] == {}
+
+
+def test_002_ping_many_more_hosts_than_concurrency(fake_ping):
+    hosts = ['up%d' % i for i in range(10)] + ['up0', 'down0']
+    called = []
+    results = methods.ping_many(hosts, lambda host, result:
+                                called.append(host))
+    assert sorted(results) == sorted(set(hosts))
+    assert all(results['up%d' % i]['packets_rx'] == 10 for i in range(10))
+    # once per host, even if given twice
+    assert sorted(called) == sorted(set(hosts))
+
+
+def test_003_ping_many_kills_hanging_pings(fake_ping):
+    started_at = time.time()
+    results = methods.ping_many(['slow1', 'up1', 'slow2'])
+    assert time.time() - started_at < 10
+    assert results['slow1'] == results['slow2'] == {}
+    assert results['up1']['packets_rx'] == 10
+
+
+def test_004_ping(fake_ping):
+    assert methods.ping('up1')['rtt_avg'] == 0.045
+    assert methods.ping('down1') == {}
+
+
+def test_005_ping_many_callback_errors(fake_ping):
+    def callback(host, result):
+        raise Exception('broken callback')
+
+    results = methods.ping_many(['up1', 'up2'], callback)
+    assert results['up1']['packets_rx'] == results['up2']['packets_rx'] == 10
@@ -0,0 +1,103 @@
+import subprocess
+
+import pytest
+
+from mist.io.methods import PROBE_COMMAND, parse_probe_output
+
+
+LINUX_OUTPUT = """mist-probe-v1
+loadavg=0.08 0.03 0.05 1/123 4567
+users=2
+uptime=12345.67 23456.78
+cores=4
+inet=127.0.0.1 00:00:00:00:00:00
+inet=10.0.0.5 02:42:ac:11:00:02
+inet=54.12.34.56 06:1a:2b:3c:4d:5e
+df-begin
+Filesystem      Size  Used Avail Use% Mounted on
+/dev/xvda1      7.8G  1.2G  6.2G  17% /
+df-end
+"""
+
+IFCONFIG_OUTPUT = """mist-probe-v1
+loadavg=0.50 0.40 0.30
+users=1
+uptime=600
+cores=2
+ifconfig-begin
+em0: flags=8843<UP,BROADCAST,RUNNING,SIMPLEX,MULTICAST> metric 0 mtu 1500
+\tether 52:54:00:12:34:56
+\tinet 192.168.1.10 netmask 0xffffff00 broadcast 192.168.1.255
+lo0: flags=8049<UP,LOOPBACK,RUNNING,MULTICAST> metric 0 mtu 16384
+\tinet 127.0.0.1 netmask 0xff000000
+eth1      Link encap:Ethernet  HWaddr 52:54:00:ab:cd:ef
+          inet addr:8.8.4.4  Bcast:8.8.4.255  Mask:255.255.255.0
+ifconfig-end
+df-begin
+Filesystem 1K-blocks Used Available Capacity Mounted on
+df-end
+"""
+
+
+def test_001_parse_linux_output():
+    result = parse_probe_output(LINUX_OUTPUT)
+    assert result['loadavg'] == ['0.08', '0.03', '0.05']
+    assert result['users'] == '2'
+    assert result['uptime'] == '12345.67 23456.78'
+    assert result['cores'] == '4'
+    assert result['pub_ips'] == ['54.12.34.56']
+    assert result['priv_ips'] == ['10.0.0.5']
+    assert result['macs'] == {'10.0.0.5': '02:42:ac:11:00:02',
+                              '54.12.34.56': '06:1a:2b:3c:4d:5e'}
+    assert result['df'].splitlines()[1].startswith('/dev/xvda1')
+
+
+def test_002_parse_ifconfig_fallback():
+    result = parse_probe_output(IFCONFIG_OUTPUT)
+    assert result['macs'] == {'192.168.1.10': '52:54:00:12:34:56',
+                              '8.8.4.4': '52:54:00:ab:cd:ef'}
+    assert result['pub_ips'] == ['8.8.4.4']
+    assert result['priv_ips'] == ['192.168.1.10']
+    assert result['df'].startswith('Filesystem')
+
+
+def test_003_parse_crlf_output():
+    result = parse_probe_output(LINUX_OUTPUT.replace('\n', '\r\n'))
+    assert result['cores'] == '4'
+    assert result['pub_ips'] == ['54.12.34.56']
+
+
+def test_004_parse_truncated_output():
+    # the connection dropped in the middle of the df section
+    output = LINUX_OUTPUT[:LINUX_OUTPUT.index('/dev/xvda1') + 5]
+    result = parse_probe_output(output)
+    assert result['cores'] == '4'
+    assert result['pub_ips'] == ['54.12.34.56']
+    assert result['df'].splitlines() == ['Filesystem      Size  Used Avail '
+                                         'Use% Mounted on', '/dev/']
+
+    # only the first few lines made it
+    output = LINUX_OUTPUT[:LINUX_OUTPUT.index('users=')]
+    result = parse_probe_output(output)
+    assert result['loadavg'] == ['0.08', '0.03', '0.05']
+    assert result['users'] == ''
+    assert result['cores'] == ''
+    assert result['pub_ips'] == result['priv_ips'] == []
+    assert result['df'] == ''
+
+
+def test_005_parse_unexpected_output():
+    for output in ('', 'Please login as the user "ubuntu"',
+                   LINUX_OUTPUT.replace('mist-probe-v1', 'mist-probe')):
+        with pytest.raises(ValueError):
+            parse_probe_output(output)
+
+
+def test_006_parse_local_probe():
+    # the probe command, as run over ssh, on the machine running the tests
+    output = subprocess.check_output(PROBE_COMMAND, shell=True)
+    result = parse_probe_output(output)
+    assert len(result['loadavg']) == 3
+    assert int(result['cores']) > 0
+    assert float(result['uptime'].split()[0]) > 0
+    assert '127.0.0.1' not in result['macs']
@@ -0,0 +1,194 @@
+import time
+import threading
+
+import pytest
+
+from mist.io import ratelimit
+
+
+class FakeClock(object):
+    """Replaces time and sleep in mist.io.ratelimit, sleeping advances it.
+    Rates in the tests are powers of two, so that refills are exact"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.slept.append(secs)
+        self.now += secs
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit, 'time', clock.time)
+    monkeypatch.setattr(ratelimit, 'sleep', clock.sleep)
+    return clock
+
+
+class ThrottledError(Exception):
+    pass
+
+
+def test_001_is_throttle_error():
+    assert ratelimit.is_throttle_error(
+        Exception('RequestLimitExceeded: Request limit exceeded.'))
+    assert ratelimit.is_throttle_error(Exception('429 Too Many Requests'))
+    assert ratelimit.is_throttle_error(Exception('overLimit'))
+    assert not ratelimit.is_throttle_error(Exception('InvalidAMIID'))
+    exc = Exception('wrapped')
+    exc.orig_exc = Exception('Throttling: Rate exceeded')
+    assert ratelimit.is_throttle_error(exc)
+
+
+def test_002_token_bucket_burst_then_rate(clock):
+    bucket = ratelimit.TokenBucket(rate=2, burst=3)
+    for i in range(3):
+        bucket.acquire()
+    assert clock.slept == []
+    # then one token every 1 / rate secs
+    started_at = clock.now
+    for i in range(4):
+        bucket.acquire()
+    assert clock.now - started_at == pytest.approx(2)
+
+
+def test_003_token_bucket_refill_capped_at_burst(clock):
+    bucket = ratelimit.TokenBucket(rate=8, burst=2)
+    clock.now += 60
+    for i in range(2):
+        bucket.acquire()
+    assert clock.slept == []
+    bucket.acquire()
+    assert sum(clock.slept) == pytest.approx(0.125)
+
+
+def test_004_token_bucket_drain(clock):
+    bucket = ratelimit.TokenBucket(rate=1, burst=5)
+    bucket.drain()
+    bucket.acquire()
+    assert sum(clock.slept) == pytest.approx(1)
+
+
+def test_005_controller_additive_increase(clock):
+    controller = ratelimit.ConcurrencyController(
+        'cloud', rate=1024, burst=1024, concurrency=2, max_concurrency=4)
+    for i in range(2):
+        assert controller.run(lambda x: x * 2, i) == i * 2
+    # a full window of 2 successful calls adds one
+    assert int(controller.limit) == 3
+    for i in range(20):
+        controller.run(lambda: None)
+    assert int(controller.limit) == 4
+    stats = controller.get_stats()
+    assert stats['succeeded'] == 22
+    assert stats['per_minute'] == 22
+    assert stats['in_flight'] == 0
+
+
+def test_006_controller_throttled_retries(clock):
+    controller = ratelimit.ConcurrencyController(
+        'cloud', rate=1024, burst=1024, concurrency=8, max_concurrency=10,
+        retries=3, backoff=1)
+    calls = []
+
+    def func():
+        calls.append(clock.now)
+        if len(calls) < 3:
+            raise ThrottledError('RequestLimitExceeded')
+        return 'ok'
+
+    assert controller.run(func) == 'ok'
+    assert len(calls) == 3
+    # multiplicative decrease on every throttled call
+    assert int(controller.limit) == 2
+    assert controller.get_stats()['throttled'] == 2
+    # backed off before retrying
+    assert calls[1] > calls[0] and calls[2] > calls[1]
+
+
+def test_007_controller_gives_up(clock):
+    controller = ratelimit.ConcurrencyController(
+        'cloud', rate=1024, burst=1024, concurrency=4, max_concurrency=10,
+        retries=2, backoff=1)
+
+    def throttled():
+        raise ThrottledError('429 Too Many Requests')
+
+    with pytest.raises(ThrottledError):
+        controller.run(throttled)
+    stats = controller.get_stats()
+    assert stats['throttled'] == 3
+    assert stats['failed'] == 1
+    assert stats['concurrency_limit'] == 1
+
+    # other errors are raised right away
+    def broken():
+        raise ValueError('InvalidAMIID')
+
+    with pytest.raises(ValueError):
+        controller.run(broken)
+    assert controller.get_stats()['throttled'] == 3
+    assert controller.get_stats()['failed'] == 2
+
+
+def test_008_controller_limits_concurrency():
+    controller = ratelimit.ConcurrencyController(
+        'cloud', rate=1024, burst=1024, concurrency=3, max_concurrency=3)
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def func():
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    threads = [threading.Thread(target=controller.run, args=(func, ))
+               for i in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max_running[0] == 3
+    assert controller.get_stats()['succeeded'] == 12
+
+
+def test_009_provider_limits():
+    ec2 = ratelimit.get_provider_limits('ec2_us_east')
+    assert ec2['rate'] == 5 and ec2['max_concurrency'] == 20
+    assert ec2['min_concurrency'] == 1
+    rackspace = ratelimit.get_provider_limits('rackspace_first_gen')
+    assert rackspace['concurrency'] == 3
+    assert ratelimit.get_provider_limits('unknown') == \
+        ratelimit.config.BULK_CONCURRENCY['default']
+
+
+def test_010_controller_per_cloud():
+    controller = ratelimit.get_controller('test-cloud', 'ec2_us_east')
+    assert ratelimit.get_controller('test-cloud', 'ec2_us_east') is controller
+    assert ratelimit.get_controller('other-cloud', 'ec2_us_east') \
+        is not controller
+
+
+def test_011_is_throttle_error_http_status():
+    exc = Exception('Too busy')
+    exc.code = 429
+    assert ratelimit.is_throttle_error(exc)
+    wrapper = Exception('Error while attempting to reboot machine')
+    wrapper.orig_exc = exc
+    assert ratelimit.is_throttle_error(wrapper)
+    exc.code = 500
+    assert not ratelimit.is_throttle_error(wrapper)
+    # ids, ips and sizes that happen to contain 429
+    assert not ratelimit.is_throttle_error(
+        Exception("InvalidInstanceID.NotFound: i-0429abcd"))
+    assert not ratelimit.is_throttle_error(Exception('Size s-429gb not available'))
+
@@ -0,0 +1,64 @@
+from mist.io.shell import TransportPool
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def is_authenticated(self):
+        return self.active
+
+    def set_keepalive(self, keepalive):
+        pass
+
+    def close(self):
+        self.active = False
+
+
+KEY = ('host', 22, 'root', 'key', None)
+
+
+def test_001_shared_transport():
+    pool = TransportPool(idle_timeout=60, keepalive=30, max_size=4)
+    transport = FakeTransport()
+    assert pool.add(KEY, transport)
+    assert pool.acquire(KEY) is transport
+    pool.release(KEY)
+    pool.release(KEY)
+    assert pool.get_stats()['in_use'] == 0
+    # still pooled after its last user released it
+    assert pool.acquire(KEY) is transport
+    assert pool.get_stats()['hits'] == 2
+
+
+def test_002_close_waits_for_other_users():
+    pool = TransportPool(idle_timeout=60, keepalive=30, max_size=4)
+    transport = FakeTransport()
+    assert pool.add(KEY, transport)
+    assert pool.acquire(KEY) is transport
+    # a failed login discards the transport another shell is using
+    pool.release(KEY, close=True)
+    assert transport.is_active()
+    # no longer handed out, and a new transport with the same key isn't
+    # pooled until the discarded one is gone
+    assert pool.acquire(KEY) is None
+    assert not pool.add(KEY, FakeTransport())
+    pool.release(KEY)
+    assert not transport.is_active()
+    assert pool.get_stats()['size'] == 0
+    new_transport = FakeTransport()
+    assert pool.add(KEY, new_transport)
+    assert pool.acquire(KEY) is new_transport
+
+
+def test_003_close_last_user():
+    pool = TransportPool(idle_timeout=60, keepalive=30, max_size=4)
+    transport = FakeTransport()
+    assert pool.add(KEY, transport)
+    pool.release(KEY, close=True)
+    assert not transport.is_active()
+    assert pool.get_stats()['size'] == 0
@@ -0,0 +1,180 @@
+from mist.io import methods
+from mist.io import tasks
+
+
+class FakeEC2Connection(object):
+    """Records the requests _ec2_batch_tags sends"""
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, path, params=None):
+        self.requests.append(params)
+
+
+class FakeEC2Driver(object):
+
+    type = 'ec2_us_east'
+    path = '/'
+
+    def __init__(self, tags=None, fail_listing=False):
+        self.connection = FakeEC2Connection()
+        self.tags = tags or {}
+        self.fail_listing = fail_listing
+        self.described = []
+
+    def list_nodes(self, ex_node_ids=None):
+        if self.fail_listing:
+            raise Exception('InvalidInstanceID.NotFound')
+        return [FakeNode(node_id, self.tags[node_id])
+                for node_id in ex_node_ids if node_id in self.tags]
+
+    def ex_describe_tags(self, node):
+        self.described.append(node.id)
+        if node.id not in self.tags:
+            raise Exception('InvalidInstanceID.NotFound')
+        return self.tags[node.id]
+
+
+class FakeNode(object):
+
+    def __init__(self, node_id, tags):
+        self.id = node_id
+        self.extra = {'tags': tags}
+
+
+def test_001_diff_tags():
+    current = {'env': 'dev', 'team': 'ops', 'old': 'x'}
+    desired = {'env': 'prod', 'team': 'ops', 'new': 'y'}
+    to_add, to_remove = methods._diff_tags(current, desired)
+    assert to_add == {'env': 'prod', 'new': 'y'}
+    assert to_remove == {'old': 'x'}
+
+
+def test_002_diff_tags_unchanged():
+    tags = {'env': 'dev'}
+    assert methods._diff_tags(tags, dict(tags)) == ({}, {})
+    assert methods._diff_tags({}, {}) == ({}, {})
+    assert methods._diff_tags({}, tags) == (tags, {})
+    assert methods._diff_tags(tags, {}) == ({}, tags)
+
+
+def test_003_ec2_batch_create_tags():
+    conn = FakeEC2Driver()
+    methods._ec2_batch_tags(conn, 'CreateTags', ['i-1', 'i-2'],
+                            {'env': 'prod', 'app': 'web'})
+    assert conn.connection.requests == [{
+        'Action': 'CreateTags',
+        'ResourceId.1': 'i-1', 'ResourceId.2': 'i-2',
+        'Tag.1.Key': 'app', 'Tag.1.Value': 'web',
+        'Tag.2.Key': 'env', 'Tag.2.Value': 'prod',
+    }]
+
+
+def test_004_ec2_batch_delete_tags():
+    conn = FakeEC2Driver()
+    methods._ec2_batch_tags(conn, 'DeleteTags', ['i-1'], {'env': None})
+    # values are left out, so the tag goes whatever its value
+    assert conn.connection.requests == [{
+        'Action': 'DeleteTags', 'ResourceId.1': 'i-1', 'Tag.1.Key': 'env',
+    }]
+
+
+def test_005_ec2_batch_tags_splits_requests():
+    conn = FakeEC2Driver()
+    machine_ids = ['i-%d' % i for i in range(methods.EC2_TAGS_BATCH_SIZE * 2
+                                             + 1)]
+    methods._ec2_batch_tags(conn, 'CreateTags', machine_ids, {'env': 'prod'})
+    requests = conn.connection.requests
+    assert len(requests) == 3
+    sent = [params[key] for params in requests for key in sorted(
+        (key for key in params if key.startswith('ResourceId.')),
+        key=lambda key: int(key.split('.')[1])
+    )]
+    assert sent == machine_ids
+    assert all(params['Tag.1.Key'] == 'env' for params in requests)
+
+
+def test_006_ec2_current_tags():
+    conn = FakeEC2Driver(tags={'i-1': {u'Name': u'web', u'env': u'prod'},
+                               'i-2': {}})
+    tags = methods._ec2_current_tags(conn, ['i-1', 'i-2'])
+    assert tags == {'i-1': {'env': 'prod'}, 'i-2': {}}
+    assert conn.described == []
+
+
+def test_007_ec2_current_tags_one_by_one():
+    conn = FakeEC2Driver(tags={'i-1': {'env': 'prod'}}, fail_listing=True)
+    tags = methods._ec2_current_tags(conn, ['i-1', 'i-gone'])
+    assert tags['i-1'] == {'env': 'prod'}
+    assert isinstance(tags['i-gone'], Exception)
+    assert sorted(conn.described) == ['i-1', 'i-gone']
+
+
+def test_008_apply_tags_diff():
+    tags = [{'key': u'env', 'value': u'dev'}, {'key': u'vdc', 'value': u'x'},
+            {'key': u'old', 'value': u'y'}]
+    assert methods._apply_tags_diff(tags, {'env': 'prod'}, {'old': 'y'}) == [
+        {'key': u'vdc', 'value': u'x'}, {'key': 'env', 'value': 'prod'}
+    ]
+    assert methods._apply_tags_diff(tags, {}, {}) == tags
+
+
+class FakeUser(object):
+    email = 'user@example.com'
+    clouds = {'cloud': object()}
+
+
+def cached_listing(monkeypatch, machines):
+    """Replace the cache of ListMachines with a dict holding machines"""
+    cache = {'payload': {'cloud_id': 'cloud', 'machines': machines}}
+    monkeypatch.setattr(tasks.ListMachines, 'get_cached',
+                        lambda self, email, cloud_id: cache)
+    monkeypatch.setattr(tasks.ListMachines, 'set_cached',
+                        lambda self, value, email, cloud_id:
+                        cache.update(value))
+    monkeypatch.setattr(tasks.ListMachines, 'clear_mist_tags_cache',
+                        lambda self, email, cloud_id: None)
+    return cache
+
+
+def test_009_set_tags_updates_cached_listing(monkeypatch):
+    conn = FakeEC2Driver(tags={'i-1': {'Name': 'web', 'env': 'dev',
+                                       'old': 'x'}})
+    monkeypatch.setattr(methods, 'connect_provider', lambda cloud: conn)
+    cache = cached_listing(monkeypatch, [{
+        'id': 'i-1',
+        'tags': [{'key': u'env', 'value': u'dev'},
+                 {'key': u'old', 'value': u'x'},
+                 {'key': u'mist', 'value': u'tag'}],
+    }])
+    errors = methods._set_tags(FakeUser(), 'cloud',
+                               {'i-1': [{'env': 'prod'}]})
+    assert errors == {'i-1': None}
+    # only the changes are applied, other tags stay in the listing
+    tags = cache['payload']['machines'][0]['tags']
+    assert sorted((tag['key'], tag['value']) for tag in tags) == \
+        [('env', 'prod'), ('mist', 'tag')]
+
+
+def test_010_set_tags_keeps_derived_tags(monkeypatch):
+    class FakeVCloudDriver(object):
+        type = 'vcloud'
+
+    monkeypatch.setattr(methods, 'connect_provider',
+                        lambda cloud: FakeVCloudDriver())
+    monkeypatch.setattr(methods, '_set_machine_metadata',
+                        lambda *args: None)
+    cache = cached_listing(monkeypatch, [{
+        'id': 'vm-1',
+        'extra': {'vdc': 'dc1', 'metadata': {'env': 'dev', 'old': 'x'}},
+        'tags': [{'key': u'env', 'value': u'dev'},
+                 {'key': u'old', 'value': u'x'},
+                 {'key': u'vdc', 'value': u'dc1'}],
+    }])
+    errors = methods._set_tags(FakeUser(), 'cloud',
+                               {'vm-1': [{'env': 'prod'}, {'app': 'web'}]})
+    assert errors == {'vm-1': None}
+    tags = cache['payload']['machines'][0]['tags']
+    assert sorted((tag['key'], tag['value']) for tag in tags) == \
+        [('app', 'web'), ('env', 'prod'), ('vdc', 'dc1')]
@@ -0,0 +1,42 @@
+import pytest
+
+from mist.io import tasks
+from mist.io.tests.helpers.fake_memcache import FakeMemcache
+
+
+@pytest.fixture
+def task(monkeypatch):
+    """A ListMachines task that fails, recording its reruns"""
+    task = tasks.ListMachines()
+    task._ut_cache = FakeMemcache()
+    task.reruns = []
+    tasks.local_cache.clear()
+
+    def execute(*args, **kwargs):
+        raise Exception('cloud unavailable')
+
+    monkeypatch.setattr(task, 'execute', execute)
+    monkeypatch.setattr(task, 'apply_async',
+                        lambda args, kwargs, **options:
+                        task.reruns.append((args, kwargs, options)))
+    monkeypatch.setattr(tasks, 'amqp_user_listening', lambda email: True)
+    monkeypatch.setattr(tasks, 'amqp_log', lambda msg: None)
+    return task
+
+
+def test_001_failed_run_reruns(task):
+    task.run('user@example.com', 'cloud')
+    assert len(task.reruns) == 1
+    args, kwargs, options = task.reruns[0]
+    assert args == ('user@example.com', 'cloud')
+    assert kwargs['seq_id'] and 'scheduled' not in kwargs
+    assert options['countdown'] > 0
+
+
+def test_002_failed_scheduled_run_left_to_poller(task):
+    task.run('user@example.com', 'cloud', scheduled=True)
+    assert task.reruns == []
+    cache_key = task.cache_key('user@example.com', 'cloud')[1]
+    # nor does it stop the next run from retrying
+    assert task.memcache.get(cache_key + ':error') is None
+    assert task.memcache.get(cache_key + ':lease') is None
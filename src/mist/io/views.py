@@ -10,6 +10,7 @@ be performed inside the corresponding method functions.
 """
 
 import re
+import uuid
 import requests
 import json
 
@@ -25,6 +26,7 @@ except ImportError:
     from pyramid.view import view_config
 
 from mist.io import methods
+from mist.io import tasks
 from mist.io.model import Keypair
 import mist.io.exceptions as exceptions
 from mist.io.exceptions import *
@@ -979,6 +981,47 @@ def machine_actions(request):
     raise BadRequestError()
 
 
+@view_config(route_name='api_v1_machines_action', request_method='POST', renderer='json')
+@view_config(route_name='machines_action', request_method='POST', renderer='json')
+def bulk_machine_action(request):
+    """
+    Call an action on many machines
+    Calls the same action on many machines of a cloud at once and returns
+    the result of the action for each machine
+    ---
+    cloud:
+      in: path
+      required: true
+      type: string
+    machines:
+      items:
+        type: string
+      required: true
+      type: array
+    action:
+      enum:
+      - start
+      - stop
+      - reboot
+      - destroy
+      - undefine
+      - suspend
+      - resume
+      required: true
+      type: string
+    """
+    cloud_id = request.matchdict['cloud']
+    user = user_from_request(request)
+    params = params_from_request(request)
+    action = params.get('action', '')
+    machine_ids = params.get('machines')
+    if not action:
+        raise RequiredParameterMissingError('action')
+    if not machine_ids or type(machine_ids) != list:
+        raise BadRequestError('machines should be a list of machine ids')
+    return methods.bulk_machine_action(user, cloud_id, machine_ids, action)
+
+
 @view_config(route_name='api_v1_machine_rdp', request_method='GET', renderer='json')
 @view_config(route_name='machine_rdp', request_method='GET', renderer='json')
 def machine_rdp(request):
@@ -1060,6 +1103,51 @@ def set_machine_tags(request):
     return OK
 
 
+@view_config(route_name='api_v1_machines_tags', request_method='POST', renderer='json')
+@view_config(route_name='machines_tags', request_method='POST', renderer='json')
+def set_machines_tags(request):
+    """
+    Set tags on many machines
+    Set tags for many machines of a cloud at once. Either give the list of
+    machine ids and the tags to set on all of them, or a mapping of machine
+    ids to the tags of each machine. Only the tags that changed are sent to
+    the provider. Returns the result for each machine
+    ---
+    cloud:
+      in: path
+      required: true
+      type: string
+    machines:
+      required: true
+      type: array or object
+    tags:
+      items:
+        type: object
+      type: array
+    """
+    cloud_id = request.matchdict['cloud']
+    params = params_from_request(request)
+    machines = params.get('machines')
+    if type(machines) == list:
+        tags = params.get('tags')
+        if type(tags) != list:
+            raise BadRequestError('tags should be list of tags')
+        machines_tags = dict((machine_id, tags) for machine_id in machines)
+    elif type(machines) == dict:
+        machines_tags = machines
+        for tags in machines_tags.values():
+            if type(tags) != list:
+                raise BadRequestError('tags should be list of tags')
+    else:
+        raise BadRequestError('machines should be a list of machine ids or '
+                              'a dict of machine ids to tags')
+    if not machines_tags:
+        raise RequiredParameterMissingError('machines')
+
+    user = user_from_request(request)
+    return methods.set_machines_tags(user, cloud_id, machines_tags)
+
+
 @view_config(route_name='api_v1_machine_tag', request_method='DELETE', renderer='json')
 @view_config(route_name='machine_tag', request_method='DELETE', renderer='json')
 def delete_machine_tag(request):
@@ -1761,6 +1849,50 @@ def undeploy_plugin(request):
     # return resp.json()
 
 
+@view_config(route_name='api_v1_commands', request_method='POST', renderer='json')
+@view_config(route_name='commands', request_method='POST', renderer='json')
+def run_command(request):
+    """
+    Run a command on many machines
+    Run the same command over SSH on many machines, given a list of
+    targets with the cloud and machine id of each machine and optionally its
+    host. The command runs in the background and the output and exit status
+    of each machine are sent over the main sockjs channel as 'command'
+    messages as soon as they're available, followed by a 'command_finished'
+    message with the aggregate timing. Returns the job id included in all
+    of them
+    ---
+    command:
+      required: true
+      type: string
+    targets:
+      items:
+        type: object
+      required: true
+      type: array
+    """
+    user = user_from_request(request)
+    params = params_from_request(request)
+    command = params.get('command')
+    targets = params.get('targets')
+    if not command:
+        raise RequiredParameterMissingError('command')
+    if not targets or type(targets) != list:
+        raise BadRequestError('targets should be a list of machines')
+    for i, target in enumerate(targets):
+        # also accept [cloud_id, machine_id] pairs
+        if type(target) == list and len(target) == 2:
+            targets[i] = target = {'cloud_id': target[0],
+                                   'machine_id': target[1]}
+        if type(target) != dict or not target.get('cloud_id') or \
+                not target.get('machine_id'):
+            raise BadRequestError('each target should have a cloud_id and '
+                                  'a machine_id')
+    job_id = uuid.uuid4().hex
+    tasks.ssh_command_many.delay(user.email, job_id, targets, command)
+    return {'job_id': job_id}
+
+
 @view_config(route_name='api_v1_rules', request_method='POST', renderer='json')
 @view_config(route_name='rules', request_method='POST', renderer='json')
 def update_rule(request):